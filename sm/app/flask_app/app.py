@@ -1,24 +1,75 @@
+from auth.hashing import init_password_hasher
 from auth.routes import auth_bp
+from auth.utils import init_token_cache
+from billing.commands import billing_cli
+from billing.routes import billing_bp
+from bench import bench_cli
+from cache import cache, init_cache
 from config import Config
+from database import init_db
+from db_commands import db_cli
 from flask import Flask
-from flask_bcrypt import Bcrypt
+from instrumentation import init_instrumentation
+from json_provider import init_json
 from meters.routes import meters_bp
 from consumption.routes import consumption_bp
+from consumption.commands import (anomalies_cli, import_cli, ingest_cli, partitions_cli,
+                                  rollups_cli)
+from consumption.feed import feed_broker, init_feed
+from consumption.hot_store import hot_store, init_hot_store
+from consumption.ingest import ingest_queue, init_ingest
+from rate_limit import init_limiter
 from user.routes import user_bp
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
-def create_app():
-    """Create and configure a new Flask app instance."""
-    app = Flask(__name__)
-    Bcrypt(app)
+def create_app(config: dict = None):
+    """Create and configure a new Flask app instance.
 
+    Args:
+        config: Settings overriding the ones from Config
+    """
+    app = Flask(__name__)
     app.config.from_object(Config)
+    if config:
+        app.config.update(config)
+    init_json(app)
+    # Lets commands create further instances, e.g. the server of bench run
+    app.extensions['create_app'] = create_app
+
+    # Requests arrive through the Apache proxy
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
+    # Set up the database connection pool, the instrumentation, the caches,
+    # the password hasher, the rate limiter, the duplicate filter, the live
+    # feed, the hot store and the ingest queue
+    init_db(app, cache=cache)
+    init_instrumentation(app, cache=cache, feed_broker=feed_broker, hot_store=hot_store,
+                         ingest_queue=ingest_queue)
+    init_cache(app)
+    init_token_cache(app)
+    init_password_hasher(app)
+    init_limiter(app)
+    init_feed(app)
+    init_hot_store(app)
+    init_ingest(app)
 
     # Register Blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(user_bp, url_prefix='/user')
     app.register_blueprint(meters_bp, url_prefix='/meters')
     app.register_blueprint(consumption_bp, url_prefix='/consumption')
+    app.register_blueprint(billing_bp, url_prefix='/billing')
+
+    # Register CLI commands
+    app.cli.add_command(anomalies_cli)
+    app.cli.add_command(bench_cli)
+    app.cli.add_command(billing_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(import_cli)
+    app.cli.add_command(ingest_cli)
+    app.cli.add_command(partitions_cli)
+    app.cli.add_command(rollups_cli)
 
     return app
 
@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from config import worker_processes
+from instrumentation import span
+
+BCRYPT_COST = re.compile(r'^\$2[abxy]?\$(\d{2})\$')
+
+# Workers are not forked from the gunicorn worker, whose other threads may
+# hold locks that would stay locked in the child. A fork server (or spawn
+# where there is none) starts them from a single-threaded process
+START_METHOD = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                else 'spawn')
+
+
+class HasherBusyError(Exception):
+    """Raised when too many password hashing jobs are pending."""
+
+
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password(password_hash: str, password: str) -> bool:
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'),
+                              password_hash.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool so requests do not block on it.
+
+    At most ``max_pending`` jobs may be queued or running. Further calls
+    raise HasherBusyError instead of piling up behind the pool.
+    """
+
+    def __init__(self, rounds: int = 12, workers: int = None,
+                 max_pending: int = 64, timeout: float = 30):
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self.configure(rounds, workers, max_pending, timeout)
+
+    def configure(self, rounds: int, workers: int = None,
+                  max_pending: int = 64, timeout: float = 30):
+        """Apply new settings. A running pool is shut down."""
+        self.shutdown()
+        self.rounds = rounds
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def _get_executor(self):
+        # Pools do not survive a fork, so each worker process creates its own
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                context = multiprocessing.get_context(START_METHOD)
+                if START_METHOD == 'forkserver':
+                    context.set_forkserver_preload([__name__])
+                # Kept for the life of the process, shut down by shutdown()
+                self._executor = ProcessPoolExecutor(  # pylint: disable=consider-using-with
+                    max_workers=self.workers, mp_context=context)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, function, *args):
+        if self.workers == 0:
+            with span('bcrypt'):
+                return function(*args)
+
+        if not self._pending.acquire(blocking=False):
+            raise HasherBusyError("Too many pending password operations")
+        try:
+            with span('bcrypt'):
+                return self._get_executor().submit(function, *args).result(self.timeout)
+        finally:
+            self._pending.release()
+
+    def hash_password(self, password: str) -> str:
+        """Hash a password with the configured cost factor."""
+        return self._run(_hash_password, password, self.rounds)
+
+    def check_password(self, password_hash: str, password: str) -> bool:
+        """Check a password against a bcrypt hash."""
+        return self._run(_check_password, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Check if a hash was not created with the configured cost factor."""
+        match = BCRYPT_COST.match(password_hash)
+        return match is None or int(match.group(1)) != self.rounds
+
+    def shutdown(self):
+        """Stop the pool of this process, pending jobs are cancelled."""
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
+
+
+def init_password_hasher(app):
+    """Configure the password hasher from the app config.
+
+    Every server process has its own pool, so by default the cores are
+    split between them.
+    """
+    workers = app.config['BCRYPT_WORKERS']
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // worker_processes(app.config))
+    password_hasher.configure(
+        rounds=app.config['BCRYPT_LOG_ROUNDS'],
+        workers=workers,
+        max_pending=app.config['BCRYPT_MAX_PENDING'],
+        timeout=app.config['BCRYPT_TIMEOUT'])
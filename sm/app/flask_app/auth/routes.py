@@ -1,16 +1,15 @@
-from auth.utils import (create_token, error_response, get_data_from_token,
+from auth.hashing import HasherBusyError, password_hasher
+from auth.utils import (busy_response, create_token, error_response,
+                        get_data_from_token,
                         get_user_id_for_username, require_auth,
                         require_special_auth, user_is_authorized,
                         validate_email, validate_password,
                         validate_request_data)
+from cache import ALL_METERS_KEY, cache, user_key, user_meters_key
 from database import get_db_connection
-from flask import Blueprint, jsonify, request
-from flask_bcrypt import Bcrypt
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from flask import Blueprint, current_app, jsonify, request
+from rate_limit import limiter
 
-bcrypt = Bcrypt()
-limiter = Limiter(get_remote_address)
 auth_bp = Blueprint('auth', __name__)
 
 
@@ -44,7 +43,7 @@ def create_user():
                 "include an uppercase letter, a number, and a special character",
                 400)
 
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed_password = password_hasher.hash_password(password)
 
         # All users are created as regular users (role_id = 1) by default
         role_id = 1
@@ -91,6 +90,9 @@ def create_user():
         return jsonify({"message": "User created successfully",
                         "token": token}), 200
 
+    except HasherBusyError:
+        return busy_response(current_app.config['BCRYPT_RETRY_AFTER'])
+
     except Exception as e:
         return error_response(str(e), 500)
 
@@ -125,8 +127,24 @@ def login():
 
         # Check if the provided password matches the stored password
         if user and (user['login_password'] == password
-                     or bcrypt.check_password_hash(user['login_password'],
-                                                   password)):
+                     or password_hasher.check_password(user['login_password'],
+                                                       password)):
+
+            # Renew plain text hashes and hashes with an outdated cost factor.
+            # The password is verified, so a failure here must not fail the
+            # login; the hash is renewed on a later one
+            if password_hasher.needs_rehash(user['login_password']):
+                try:
+                    with get_db_connection() as conn:
+                        cursor = conn.cursor()
+                        cursor.execute("""
+                            UPDATE login SET login_password = %s WHERE login_username = %s
+                        """, (password_hasher.hash_password(password), username))
+                        conn.commit()
+                except Exception as e:
+                    current_app.logger.warning("Could not rehash the password of %s: %r",
+                                               username, e)
+
             token = create_token(user['user_id'], username, user['role_id'])
             return jsonify(
                 {"message": "Login successful", "token": token}), 200
@@ -151,6 +169,9 @@ def login():
 
         return error_response("Invalid credentials", 401)
 
+    except HasherBusyError:
+        return busy_response(current_app.config['BCRYPT_RETRY_AFTER'])
+
     except Exception as e:
         return error_response(str(e), 500)
 
@@ -174,13 +195,28 @@ def delete_user():
         # Delete the user account. First the login and then the user itself
         with get_db_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("""SELECT id FROM users WHERE email = %s""",
+                           (input_data['username'],))
+            deleted_user = cursor.fetchone()
             cursor.execute("""DELETE FROM login WHERE login_username = %s""",
                            (input_data['username'],))
 
+            # consumption_data is partitioned and has no foreign key, so the
+            # readings of the user's meters have to be deleted explicitly
+            cursor.execute("""DELETE c FROM consumption_data c
+                           INNER JOIN meters m ON c.meter_id = m.id
+                           INNER JOIN users u ON m.owner_id = u.id
+                           WHERE u.email = %s""",
+                           (input_data['username'],))
+
             cursor.execute("""DELETE FROM users WHERE email = %s""",
                            (input_data['username'],))
             conn.commit()
 
+        if deleted_user:
+            cache.invalidate(user_key(deleted_user[0]),
+                             user_meters_key(deleted_user[0]), ALL_METERS_KEY)
+
         return jsonify({"message": "User deleted successfully"}), 200
 
     except Exception as e:
@@ -246,12 +282,12 @@ def change_password():
             user = cursor.fetchone()
 
         # Check if the user exists and if the old password is correct
-        if not user or not bcrypt.check_password_hash(user['login_password'],
-                                                      old_password):
+        if not user or not password_hasher.check_password(user['login_password'],
+                                                          old_password):
             return error_response("Invalid username or password", 401)
 
         # Create the password hash form the plain password
-        hashed_new_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
+        hashed_new_password = password_hasher.hash_password(new_password)
 
         # Change the password in the database
         with get_db_connection() as conn:
@@ -263,5 +299,8 @@ def change_password():
 
         return jsonify({"message": "Password changed successfully"}), 200
 
+    except HasherBusyError:
+        return busy_response(current_app.config['BCRYPT_RETRY_AFTER'])
+
     except Exception as e:
         return error_response(str(e), 500)
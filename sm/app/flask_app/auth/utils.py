@@ -1,13 +1,82 @@
 import datetime
+import hashlib
 import re
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import jwt
 from database import get_db_connection
-from flask import current_app, jsonify, request
+from flask import current_app, g, jsonify, request
+from instrumentation import span
 from werkzeug.exceptions import BadRequest
 
 
+class TokenCache:
+    """Bounded LRU cache of verified token claims.
+
+    Entries are keyed by the SHA-256 hash of the token and expire together
+    with the token, so an expired token is never served from the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """Return the cached claims for a token or None."""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token, claims):
+        """Cache the claims of a verified token until it expires."""
+        if self.max_size <= 0 or 'exp' not in claims:
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (claims, claims['exp'])
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.max_size:
+                # Drop expired tokens first, then the least recently used ones
+                now = time.time()
+                for expired_key in [k for k, (_, exp) in self._entries.items() if exp <= now]:
+                    del self._entries[expired_key]
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(0)
+
+
+def init_token_cache(app):
+    """Set the size of the token cache from the app config."""
+    token_cache.max_size = app.config['TOKEN_CACHE_SIZE']
+    token_cache.clear()
+
+
 def create_token(user_id, username, role_id):
     """Create a JWT token for user authentication."""
     return jwt.encode({
@@ -18,37 +87,56 @@ def create_token(user_id, username, role_id):
     }, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 
+def decode_token(token):
+    """Verify a JWT token and return its claims.
+
+    The claims are verified only once per request and kept on flask.g.
+    Across requests, verified tokens are served from the token cache.
+
+    Returns:
+        dict: The token claims, or None if the token is invalid or expired
+    """
+    if not token:
+        return None
+
+    cached = g.get('token_claims')
+    if cached is not None and cached[0] == token:
+        return cached[1]
+
+    claims = token_cache.get(token)
+    if claims is None:
+        try:
+            with span('jwt'):
+                claims = jwt.decode(token, current_app.config['SECRET_KEY'],
+                                    algorithms=['HS256'])
+        except Exception as e:
+            print(e)
+            return None
+        token_cache.put(token, claims)
+
+    g.token_claims = (token, claims)
+    return claims
+
+
 def verify_token(token):
     """Verify if a JWT token is valid and not expired."""
-    try:
-        jwt.decode(token, current_app.config['SECRET_KEY'],
-                   algorithms=['HS256'])
-        return True
-    except Exception as e:
-        print(e)
-        return False
+    return decode_token(token) is not None
 
 
 def user_is_authorized(token, auth_levels: list):
     """Check if user has required authorization level."""
-    try:
-        decoded = jwt.decode(token, current_app.config['SECRET_KEY'],
-                             algorithms=['HS256'])
-        for auth_level in auth_levels:
-            if decoded['roleId'] == auth_level:
-                return True
-        return False
-
-    except Exception:
+    claims = decode_token(token)
+    if claims is None:
         return False
+    return claims.get('roleId') in auth_levels
 
 
 def get_data_from_token(token, key):
     """Extract specific data from a JWT token."""
-    if verify_token(token):
-        return jwt.decode(token, current_app.config['SECRET_KEY'],
-                          algorithms=['HS256'])[key]
-    return False
+    claims = decode_token(token)
+    if claims is None:
+        return False
+    return claims[key]
 
 
 def get_user_id_for_username(username):
@@ -82,6 +170,11 @@ def error_response(message, status_code):
     return jsonify({"error": message}), status_code
 
 
+def busy_response(retry_after, message="Server is busy, please try again later"):
+    """503 response telling the client to retry after retry_after seconds."""
+    return jsonify({"error": message}), 503, {'Retry-After': str(retry_after)}
+
+
 def validate_request_data(given_request, required_fields):
     data = given_request.get_json(force=True)
     if not data:
@@ -0,0 +1,407 @@
+import itertools
+import json
+import math
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib import error as urllib_error
+from urllib import request as urllib_request
+
+import click
+from consumption.rollups import rebuild_rollups
+from db_commands import SYNTHETIC_PASSWORD, seed_synthetic_data
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+bench_cli = AppGroup('bench', help='Load tests and latency benchmarks of the API.')
+
+DEFAULT_MIX = 'login=1,dashboard=6,ingest=2,export=1'
+
+# Scenarios: login, dashboard (user, meters, readings and daily aggregate),
+# ingest (one day of readings through add_batch), ingest_async (the same
+# with ?mode=async) and export (admin NDJSON export of the last day)
+
+# One day of 15 minute readings per ingest request
+INGEST_BATCH_SIZE = 96
+INGEST_INTERVAL = timedelta(minutes=15)
+
+
+class Recorder:
+    """Collects latency, status and database statistics per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def add(self, name: str, latency: float, status: int, queries, query_time):
+        with self._lock:
+            self._samples.setdefault(name, []).append((latency, status, queries, query_time))
+
+    def summary(self, duration: float) -> dict:
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+
+        endpoints = {}
+        for name, values in sorted(samples.items()):
+            latencies = sorted(latency for latency, _, _, _ in values)
+            queries = [value[2] for value in values if value[2] is not None]
+            query_times = [value[3] for value in values if value[3] is not None]
+            endpoints[name] = {
+                'requests': len(values),
+                'errors': sum(1 for _, status, _, _ in values if status >= 400),
+                'throughput_rps': round(len(values) / duration, 2),
+                'latency_ms': {
+                    'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+                    'p50': round(_percentile(latencies, 50) * 1000, 2),
+                    'p95': round(_percentile(latencies, 95) * 1000, 2),
+                    'p99': round(_percentile(latencies, 99) * 1000, 2),
+                    'max': round(latencies[-1] * 1000, 2),
+                },
+                'db_queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+                'db_time_ms_mean': round(sum(query_times) / len(query_times), 2)
+                if query_times else None,
+            }
+        return endpoints
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class BenchClient:
+    """HTTP client of one simulated user. Every request is recorded."""
+
+    def __init__(self, base_url: str, recorder: Recorder):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.token = None
+        self.meters = []
+
+    def request(self, name: str, method: str, path: str, body=None, token=None,
+                record: bool = True):
+        """Send a request and read the whole response.
+
+        Returns:
+            tuple: (status, response body)
+        """
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = token
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        http_request = urllib_request.Request(self.base_url + path, data=data,
+                                              headers=headers, method=method)
+
+        started = time.perf_counter()
+        try:
+            with urllib_request.urlopen(http_request, timeout=120) as response:
+                status, payload, response_headers = response.status, response.read(), response.headers
+        except urllib_error.HTTPError as e:
+            status, payload, response_headers = e.code, e.read(), e.headers
+        latency = time.perf_counter() - started
+
+        if record:
+            queries = response_headers.get('X-DB-Queries')
+            query_time = response_headers.get('X-DB-Time')
+            self.recorder.add(name, latency, status,
+                              int(queries) if queries is not None else None,
+                              float(query_time) if query_time is not None else None)
+        return status, payload
+
+    def login(self, username: str, record: bool = True) -> str:
+        status, payload = self.request(
+            'POST /auth/login', 'POST', '/auth/login',
+            {'username': username, 'password': SYNTHETIC_PASSWORD}, record=record)
+        if status != 200:
+            raise click.ClickException(f"Login of {username} failed with status {status}")
+        return json.loads(payload)['token']
+
+
+def _scenario_login(client, context):
+    client.login(context['username'])
+
+
+def _scenario_dashboard(client, _context):
+    token = client.token
+    client.request('GET /user/get_user', 'GET', '/user/get_user', token=token)
+    client.request('GET /meters/get_data', 'GET', '/meters/get_data', token=token)
+    client.request('GET /consumption/get_data', 'GET', '/consumption/get_data', token=token)
+    client.request('GET /consumption/aggregate', 'GET', '/consumption/aggregate?bucket=day',
+                   token=token)
+
+
+def _scenario_ingest(client, context, mode=None):
+    if not client.meters:
+        return
+    meter_id = context['random'].choice(client.meters)
+    first = context['ingest_start'] + next(context['ingest_days']) * timedelta(days=1)
+    readings = [{'meter_id': meter_id,
+                 'consumption_kwh': round(context['random'].uniform(0, 2), 2),
+                 'timestamp': (first + number * INGEST_INTERVAL).isoformat()}
+                for number in range(INGEST_BATCH_SIZE)]
+    if mode:
+        client.request(f'POST /consumption/add_batch?mode={mode}', 'POST',
+                       f'/consumption/add_batch?mode={mode}', readings, token=client.token)
+    else:
+        client.request('POST /consumption/add_batch', 'POST', '/consumption/add_batch',
+                       readings, token=client.token)
+
+
+def _scenario_ingest_async(client, context):
+    _scenario_ingest(client, context, mode='async')
+
+
+def _scenario_export(client, context):
+    start = (datetime.now(timezone.utc) - timedelta(days=1)).replace(tzinfo=None)
+    client.request('GET /consumption/export', 'GET',
+                   f'/consumption/export?format=ndjson&start={start.isoformat(timespec="seconds")}',
+                   token=context['admin_token'])
+
+
+SCENARIOS = {
+    'login': _scenario_login,
+    'dashboard': _scenario_dashboard,
+    'ingest': _scenario_ingest,
+    'ingest_async': _scenario_ingest_async,
+    'export': _scenario_export,
+}
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse 'login=1,dashboard=6' into scenario weights."""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise click.BadParameter(f"Unknown scenario {name}, use one of {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def run_benchmark(base_url: str, prefix: str, users: int, admins: int, concurrency: int,
+                  duration: float, mix: dict, seed: int = 1) -> dict:
+    """Drive the scenario mix against a running API.
+
+    Each of the ``concurrency`` clients logs in as one of the synthetic
+    users and then runs randomly chosen scenarios until ``duration``
+    seconds have passed. Logins during the setup are not recorded.
+
+    Returns:
+        dict: Statistics per endpoint and in total
+    """
+    if 'export' in mix and not admins:
+        raise click.ClickException("The export scenario needs an admin, seed with --admins")
+
+    recorder = Recorder()
+    setup_client = BenchClient(base_url, recorder)
+    admin_token = setup_client.login(f'{prefix}-admin-0', record=False) if admins else None
+    ingest_days = itertools.count()
+    # Ingested readings start in the future so they never collide with seeded ones
+    ingest_start = (datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0,
+                                                       microsecond=0) + timedelta(days=1))
+
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    errors = []
+
+    def worker(number):
+        rng = random.Random(seed + number)
+        username = f'{prefix}-{number % users}'
+        client = BenchClient(base_url, recorder)
+        try:
+            client.token = client.login(username, record=False)
+            _, payload = client.request('', 'GET', '/meters/get_data', token=client.token,
+                                        record=False)
+            client.meters = [meter['meter_id'] for meter in json.loads(payload)]
+        except Exception as e:
+            errors.append(f"Setup of {username} failed: {e}")
+            start_barrier.abort()
+            return
+        context = {'random': rng, 'username': username, 'admin_token': admin_token,
+                   'ingest_days': ingest_days, 'ingest_start': ingest_start}
+
+        try:
+            start_barrier.wait()
+        except threading.BrokenBarrierError:
+            return
+        while time.monotonic() < deadline:
+            try:
+                SCENARIOS[rng.choices(names, weights)[0]](client, context)
+            except Exception as e:
+                errors.append(str(e))
+
+    def start_clock():
+        nonlocal started, deadline
+        started = time.monotonic()
+        deadline = started + duration
+
+    # All clients start together once they are logged in
+    started = deadline = None
+    start_barrier = threading.Barrier(concurrency + 1, action=start_clock)
+    threads = [threading.Thread(target=worker, args=(number,), daemon=True)
+               for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        start_barrier.wait()
+    except threading.BrokenBarrierError as exc:
+        for thread in threads:
+            thread.join()
+        raise click.ClickException('; '.join(errors)) from exc
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    endpoints = recorder.summary(elapsed)
+    requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+    return {
+        'endpoints': endpoints,
+        'total': {
+            'requests': requests,
+            'errors': sum(endpoint['errors'] for endpoint in endpoints.values()),
+            'client_errors': len(errors),
+            'throughput_rps': round(requests / elapsed, 2),
+            'duration_s': round(elapsed, 2),
+        },
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class _ServerThread(threading.Thread):
+    """Serves an app instance on a free local port."""
+
+    def __init__(self, app):
+        super().__init__(daemon=True)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=_QuietRequestHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+@bench_cli.command('run')
+@click.option('--url', default=None,
+              help='Benchmark a running API instead of starting one in-process.')
+@click.option('--prefix', default=None,
+              help='Reuse synthetic users of an earlier run instead of seeding new ones.')
+@click.option('--users', type=int, default=50, show_default=True)
+@click.option('--meters', 'meters_per_user', type=int, default=2, show_default=True,
+              help='Meters per user.')
+@click.option('--readings', 'readings_per_meter', type=int, default=500, show_default=True,
+              help='Readings per meter.')
+@click.option('--admins', type=int, default=1, show_default=True)
+@click.option('--concurrency', type=int, default=8, show_default=True)
+@click.option('--duration', type=float, default=30, show_default=True, help='Seconds.')
+@click.option('--mix', default=DEFAULT_MIX, show_default=True,
+              help='Weights of the scenarios login, dashboard, ingest, ingest_async and export.')
+@click.option('--seed', type=int, default=1, show_default=True)
+@click.option('--output', default=None,
+              help='JSON file for the results. Defaults to bench-<timestamp>.json.')
+def run_command(url, prefix, users, meters_per_user, readings_per_meter, admins,
+                concurrency, duration, mix, seed, output):
+    """Seed synthetic data and measure throughput and latency per endpoint.
+
+    Writes to the configured database, use a dedicated one. Started
+    in-process, the API runs without rate limits and reports its database
+    queries per request.
+    """
+    weights = parse_mix(mix)
+    dataset = {'users': users, 'meters_per_user': meters_per_user,
+               'readings_per_meter': readings_per_meter, 'admins': admins}
+    if prefix is None:
+        click.echo("Seeding synthetic data...")
+        counts = seed_synthetic_data(users, meters_per_user, readings_per_meter, admins=admins)
+        rebuild_rollups()
+        prefix = counts['prefix']
+    dataset['prefix'] = prefix
+
+    server = None
+    if url is None:
+        # A second app with its own settings, from the factory of this one
+        create_app = current_app.extensions['create_app']
+        server = _ServerThread(create_app({'DB_REPORT_QUERIES': True,
+                                           'RATELIMIT_ENABLED': False}))
+        server.start()
+        url = server.url
+
+    click.echo(f"Running {mix} with {concurrency} clients for {duration}s against {url}")
+    started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    try:
+        results = run_benchmark(url, prefix, users, admins, concurrency, duration, weights, seed)
+    finally:
+        if server is not None:
+            server.stop()
+
+    results = {
+        'started_at': started_at,
+        'commit': _git_commit(),
+        'target': 'in-process' if server is not None else url,
+        'concurrency': concurrency,
+        'mix': weights,
+        'seed': seed,
+        'dataset': dataset,
+        **results,
+    }
+    output = output or f"bench-{datetime.now().strftime('%Y%m%d%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    for name, endpoint in results['endpoints'].items():
+        latency = endpoint['latency_ms']
+        click.echo(f"{name}: {endpoint['requests']} requests, {endpoint['errors']} errors, "
+                   f"{endpoint['throughput_rps']} req/s, p50 {latency['p50']} ms, "
+                   f"p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+                   f"{endpoint['db_queries_mean']} queries")
+    click.echo(f"Total: {results['total']['throughput_rps']} req/s. Results written to {output}")
+
+
+@bench_cli.command('compare')
+@click.argument('baseline', type=click.File('r'))
+@click.argument('result', type=click.File('r'))
+@click.option('--max-regression', type=float, default=None,
+              help='Fail if the p95 latency of an endpoint grew by more than this many percent.')
+def compare_command(baseline, result, max_regression):
+    """Compare two benchmark results per endpoint."""
+    baseline = json.load(baseline)
+    result = json.load(result)
+
+    regressions = []
+    for name, endpoint in result['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            click.echo(f"{name}: new endpoint")
+            continue
+
+        changes = []
+        for percentile in ('p50', 'p95', 'p99'):
+            old, new = before['latency_ms'][percentile], endpoint['latency_ms'][percentile]
+            change = (new - old) / old * 100 if old else 0.0
+            changes.append(f"{percentile} {old} -> {new} ms ({change:+.1f}%)")
+            if percentile == 'p95' and max_regression is not None and change > max_regression:
+                regressions.append(name)
+        click.echo(f"{name}: {', '.join(changes)}, "
+                   f"{before['throughput_rps']} -> {endpoint['throughput_rps']} req/s")
+
+    if regressions:
+        raise click.ClickException(f"p95 regressions in: {', '.join(regressions)}")
@@ -0,0 +1,69 @@
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from billing.engine import BillingError, run_billing
+from billing.tariffs import TariffError, assign_tariff_in_db, parse_tariff, save_tariff_in_db
+
+billing_cli = AppGroup('billing', help='Manage tariffs and bill the consumption data.')
+
+
+@billing_cli.command('load-tariffs')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def load_tariffs_command(path):
+    """Create or replace the tariffs defined in a JSON file (a list of tariffs)."""
+    with open(path, encoding='utf-8') as tariff_file:
+        definitions = json.load(tariff_file)
+    if isinstance(definitions, dict):
+        definitions = [definitions]
+
+    try:
+        # Validate all tariffs before changing any
+        tariffs = [parse_tariff(definition) for definition in definitions]
+    except TariffError as e:
+        raise click.ClickException(str(e)) from e
+    for tariff in tariffs:
+        tariff_id = save_tariff_in_db(tariff)
+        click.echo(f"Saved {tariff.kind} tariff {tariff.name} (id {tariff_id})")
+
+
+@billing_cli.command('assign')
+@click.argument('tariff')
+@click.argument('meter_ids', nargs=-1, required=True)
+def assign_command(tariff, meter_ids):
+    """Bill the given meters (external IDs) with TARIFF."""
+    try:
+        count = assign_tariff_in_db(tariff, list(meter_ids))
+    except TariffError as e:
+        raise click.ClickException(str(e)) from e
+    click.echo(f"Assigned {tariff} to {count} meter(s)")
+    if count < len(set(meter_ids)):
+        click.echo(f"{len(set(meter_ids)) - count} meter(s) not found", err=True)
+
+
+@billing_cli.command('run')
+@click.option('--period', required=True, help='Month to bill, e.g. 2025-02.')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes. Defaults to BILLING_WORKERS, 0 bills in this process.')
+@click.option('--rerun', is_flag=True,
+              help='Recalculate a billed month, replacing its invoices.')
+def run_command(period, workers, rerun):
+    """Bill a month and create the invoices of all users.
+
+    An interrupted run continues where it stopped when started again.
+    """
+    def report(billed, total):
+        click.echo(f"Billed {billed}/{total} meter(s)")
+
+    try:
+        summary = run_billing(current_app.config, period, workers=workers, rerun=rerun,
+                              progress=report)
+    except BillingError as e:
+        raise click.ClickException(str(e)) from e
+
+    click.echo(f"Run {summary['run_id']}: {summary['meters']} meter(s), "
+               f"{summary['kwh']:.2f} kWh, {summary['invoices']} invoice(s)")
+    if summary['unpriced']:
+        click.echo(f"{summary['unpriced']} meter(s) without tariff were not billed", err=True)
@@ -0,0 +1,334 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal
+from zoneinfo import ZoneInfo
+
+import mysql.connector
+import numpy as np
+from database import get_db_connection
+from billing.tariffs import load_tariffs_in_db
+
+CENT = Decimal('0.01')
+BASE_FEE_LABEL = 'base fee'
+
+
+class BillingError(Exception):
+    """Raised when a billing run cannot be started."""
+
+
+def parse_period(period: str, time_zone: str) -> tuple:
+    """Return the first and last day of a month given as YYYY-MM, and its
+    start and end in UTC (naive, end exclusive)."""
+    try:
+        first_day = datetime.strptime(period, '%Y-%m').date()
+    except ValueError as e:
+        raise BillingError("The period must be a month like 2025-02") from e
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+
+    zone = ZoneInfo(time_zone)
+
+    def to_utc(day: date) -> datetime:
+        local = datetime(day.year, day.month, day.day, tzinfo=zone)
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return first_day, next_month - timedelta(days=1), to_utc(first_day), to_utc(next_month)
+
+
+def get_hour_slots(start: datetime, end: datetime, time_zone: str) -> np.ndarray:
+    """Return the local slot of the week (weekday * 24 + hour) of every UTC
+    hour between start and end."""
+    zone = ZoneInfo(time_zone)
+    start = start.replace(tzinfo=timezone.utc)
+    hours = int((end.replace(tzinfo=timezone.utc) - start).total_seconds() // 3600)
+    slots = np.empty(hours, dtype=np.int64)
+    for hour in range(hours):
+        local = (start + timedelta(hours=hour)).astimezone(zone)
+        slots[hour] = local.weekday() * 24 + local.hour
+    return slots
+
+
+def price_meters(kwh: np.ndarray, tariff_ids: list, tariffs: dict, slots: np.ndarray) -> list:
+    """Split the consumption of meters into the bands or tiers of their tariffs.
+
+    All meters with the same tariff are priced at once.
+
+    Args:
+        kwh: Consumption per meter (rows) and hour of the period (columns)
+        tariff_ids: Tariff of each row
+        tariffs: Tariffs by ID, see load_tariffs_in_db
+        slots: Slot of the week of each hour, see get_hour_slots
+
+    Returns:
+        list: Per meter, the kWh per band or tier of its tariff as float array
+    """
+    results = [None] * len(tariff_ids)
+    rows_by_tariff = {}
+    for row, tariff_id in enumerate(tariff_ids):
+        rows_by_tariff.setdefault(tariff_id, []).append(row)
+
+    for tariff_id, rows in rows_by_tariff.items():
+        tariff = tariffs[tariff_id]
+        usage = kwh[rows]
+        bands = len(tariff.labels)
+        if tariff.rates:
+            # Sum the hours of each band with one bincount over all meters
+            band_of_hour = tariff.slot_band[slots]
+            index = (np.arange(len(rows))[:, None] * bands + band_of_hour[None, :]).ravel()
+            per_band = np.bincount(index, weights=usage.ravel(),
+                                   minlength=len(rows) * bands).reshape(len(rows), bands)
+        else:
+            totals = usage.sum(axis=1)
+            per_band = np.clip(totals[:, None] - tariff.bounds[None, :-1], 0,
+                               np.diff(tariff.bounds)[None, :])
+        for position, row in enumerate(rows):
+            results[row] = per_band[position]
+    return results
+
+
+def charge_lines(tariff, per_band) -> list:
+    """Return the (label, kWh, price per kWh, amount) lines of a meter.
+
+    The kWh are rounded to the precision of the readings and the amounts
+    to cents, so every line can be recalculated from the invoice.
+    """
+    lines = [(BASE_FEE_LABEL, Decimal('0.00'), None, tariff.base_fee.quantize(CENT))]
+    for label, price, value in zip(tariff.labels, tariff.prices, per_band):
+        kwh = Decimal(f'{value:.2f}')
+        if kwh:
+            lines.append((label, kwh, price, (kwh * price).quantize(CENT, ROUND_HALF_UP)))
+    return lines
+
+
+def load_hourly(cursor, meter_ids: list, start: datetime, end: datetime,
+                use_rollups: bool) -> list:
+    """Return (meter_id, hour of the period, kWh) of the given meters."""
+    placeholders = ", ".join(["%s"] * len(meter_ids))
+    if use_rollups:
+        cursor.execute(
+            f"""SELECT meter_id, TIMESTAMPDIFF(HOUR, %s, bucket_start), sum_kwh
+            FROM consumption_rollup_hourly
+            WHERE meter_id IN ({placeholders}) AND bucket_start >= %s AND bucket_start < %s""",
+            (start, *meter_ids, start, end))
+    else:
+        cursor.execute(
+            f"""SELECT meter_id, TIMESTAMPDIFF(HOUR, %s, timestamp) AS hour, SUM(consumption_kwh)
+            FROM consumption_data
+            WHERE meter_id IN ({placeholders}) AND timestamp >= %s AND timestamp < %s
+            GROUP BY meter_id, hour""",
+            (start, *meter_ids, start, end))
+    return cursor.fetchall()
+
+
+def _bill_meters(db_config: dict, jobs: list, tariffs: dict, period: dict) -> tuple:
+    """Price a batch of meters. Runs in a worker process.
+
+    Args:
+        db_config: Connection settings, workers open their own connection
+        jobs: (meter_id, owner_id, tariff_id) tuples
+        tariffs: Tariffs by ID
+        period: start, end (UTC), slots and use_rollups
+
+    Returns:
+        tuple: (list of billing_charges rows without the run ID, total kWh)
+    """
+    slots = period['slots']
+    kwh = np.zeros((len(jobs), len(slots)))
+    row_of_meter = {meter_id: row for row, (meter_id, _, _) in enumerate(jobs)}
+
+    conn = mysql.connector.connect(**db_config)
+    try:
+        rows = load_hourly(conn.cursor(), list(row_of_meter), period['start'],
+                           period['end'], period['use_rollups'])
+    finally:
+        conn.close()
+
+    if rows:
+        meter_ids, hours, values = zip(*rows)
+        np.add.at(kwh, (np.fromiter((row_of_meter[meter_id] for meter_id in meter_ids),
+                                    dtype=np.int64, count=len(rows)),
+                        np.array(hours, dtype=np.int64)),
+                  np.array(values, dtype=np.float64))
+
+    charges = []
+    for (meter_id, owner_id, tariff_id), per_band in zip(
+            jobs, price_meters(kwh, [job[2] for job in jobs], tariffs, slots)):
+        for label, line_kwh, price, amount in charge_lines(tariffs[tariff_id], per_band):
+            charges.append((meter_id, owner_id, tariff_id, label, line_kwh, price, amount))
+    return charges, float(kwh.sum())
+
+
+def _store_charges(run_id: int, charges: list):
+    """Write the charges of a batch in one transaction."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """INSERT INTO billing_charges (
+                run_id, meter_id, owner_id, tariff_id, label, kwh, price_per_kwh, amount)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) AS new
+            ON DUPLICATE KEY UPDATE
+                owner_id = new.owner_id,
+                tariff_id = new.tariff_id,
+                kwh = new.kwh,
+                price_per_kwh = new.price_per_kwh,
+                amount = new.amount""",
+            [(run_id, *charge) for charge in charges])
+        conn.commit()
+
+
+def _start_run(cursor, first_day: date, last_day: date, rerun: bool) -> int:
+    """Return the ID of the run of the period, creating it if needed."""
+    cursor.execute(
+        """SELECT id, status FROM billing_runs
+        WHERE period_start = %s AND period_end = %s""",
+        (first_day, last_day))
+    row = cursor.fetchone()
+    if row is not None:
+        run_id, status = row
+        if status != 'complete':
+            return run_id
+        if not rerun:
+            raise BillingError(
+                f"{first_day:%Y-%m} has already been billed, use --rerun to recalculate it")
+        # Removes the charges and invoices of the run as well
+        cursor.execute("""DELETE FROM billing_runs WHERE id = %s""", (run_id,))
+
+    cursor.execute(
+        """INSERT INTO billing_runs (period_start, period_end) VALUES (%s, %s)""",
+        (first_day, last_day))
+    return cursor.lastrowid
+
+
+def _pending_jobs(cursor, run_id: int, default_tariff_id) -> tuple:
+    """Return the (meter_id, owner_id, tariff_id) of the meters without charges
+    in the run, and the number of meters without a tariff."""
+    cursor.execute(
+        """SELECT m.id, m.owner_id, mt.tariff_id
+        FROM meters m
+        LEFT JOIN meter_tariffs mt ON mt.meter_id = m.id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM billing_charges c WHERE c.run_id = %s AND c.meter_id = m.id)
+        ORDER BY m.id""",
+        (run_id,))
+    jobs = []
+    unpriced = 0
+    for meter_id, owner_id, tariff_id in cursor.fetchall():
+        tariff_id = tariff_id if tariff_id is not None else default_tariff_id
+        if tariff_id is None:
+            unpriced += 1
+        else:
+            jobs.append((meter_id, owner_id, tariff_id))
+    return jobs, unpriced
+
+
+def run_billing(config, period: str, workers: int = None, rerun: bool = False,
+                progress=None) -> dict:
+    """Bill the consumption of a month and create the invoices of all users.
+
+    The meters are priced in batches of BILLING_METERS_PER_TASK by a
+    process pool, with at most two batches per worker in flight. Every
+    batch is stored in its own transaction, so an interrupted run
+    continues with the meters that have no charges yet when it is started
+    again. The invoices are created once all meters are billed.
+
+    Args:
+        config: App config
+        period: Month to bill as YYYY-MM (in BILLING_TIMEZONE)
+        workers: Worker processes, defaults to BILLING_WORKERS. 0 bills in this process
+        rerun: Recalculate a complete run, replacing its charges and invoices
+        progress: Called with the number of billed meters and the total
+
+    Returns:
+        dict: Run ID, billed meters, meters without tariff, kWh and invoices
+    """
+    if workers is None:
+        workers = config['BILLING_WORKERS']
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    time_zone = config['BILLING_TIMEZONE']
+    first_day, last_day, start, end = parse_period(period, time_zone)
+    tariffs = load_tariffs_in_db()
+
+    default_tariff_id = None
+    if config['BILLING_DEFAULT_TARIFF'] is not None:
+        default_tariff_id = next((tariff.id for tariff in tariffs.values()
+                                  if tariff.name == config['BILLING_DEFAULT_TARIFF']), None)
+        if default_tariff_id is None:
+            raise BillingError(f"Unknown default tariff {config['BILLING_DEFAULT_TARIFF']}")
+
+    # The lock is held by this connection until the run ends
+    with get_db_connection() as lock_conn:
+        cursor = lock_conn.cursor()
+        cursor.execute("""SELECT GET_LOCK(%s, 0)""", (f'billing-{first_day:%Y-%m}',))
+        if not cursor.fetchone()[0]:
+            raise BillingError(f"{first_day:%Y-%m} is being billed by another process")
+        try:
+            period_settings = {'start': start, 'end': end,
+                               'slots': get_hour_slots(start, end, time_zone),
+                               'use_rollups': config['CONSUMPTION_USE_ROLLUPS']}
+            return _run(config, first_day, last_day, period_settings, tariffs,
+                        default_tariff_id, workers, rerun, progress)
+        finally:
+            cursor.execute("""DO RELEASE_LOCK(%s)""", (f'billing-{first_day:%Y-%m}',))
+
+
+def _run(config, first_day: date, last_day: date, period_settings: dict, tariffs: dict,
+         default_tariff_id, workers: int, rerun: bool, progress) -> dict:
+    """Bill the pending meters of the period and create the invoices, see run_billing."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        run_id = _start_run(cursor, first_day, last_day, rerun)
+        conn.commit()
+        jobs, unpriced = _pending_jobs(cursor, run_id, default_tariff_id)
+
+    size = config['BILLING_METERS_PER_TASK']
+    chunks = [jobs[offset:offset + size] for offset in range(0, len(jobs), size)]
+    db_config = config['DB_CONFIG']
+    summary = {'run_id': run_id, 'meters': len(jobs), 'unpriced': unpriced, 'kwh': 0.0}
+
+    billed = 0
+
+    def store(chunk, result):
+        nonlocal billed
+        charges, kwh = result
+        _store_charges(run_id, charges)
+        summary['kwh'] += kwh
+        billed += len(chunk)
+        if progress is not None:
+            progress(billed, len(jobs))
+
+    if workers == 0:
+        for chunk in chunks:
+            store(chunk, _bill_meters(db_config, chunk, tariffs, period_settings))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for chunk in chunks:
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(pending.pop(future), future.result())
+                future = executor.submit(_bill_meters, db_config, chunk, tariffs,
+                                         period_settings)
+                pending[future] = chunk
+            for future in wait(pending).done:
+                store(pending[future], future.result())
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """INSERT INTO invoices (
+                run_id, user_id, period_start, period_end, currency, kwh, amount)
+            SELECT run_id, owner_id, %s, %s, %s, SUM(kwh), SUM(amount)
+            FROM billing_charges
+            WHERE run_id = %s
+            GROUP BY run_id, owner_id""",
+            (first_day, last_day, config['BILLING_CURRENCY'], run_id))
+        summary['invoices'] = cursor.rowcount
+        cursor.execute(
+            """UPDATE billing_runs SET status = 'complete', finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s""",
+            (run_id,))
+        conn.commit()
+    return summary
@@ -0,0 +1,83 @@
+from auth.utils import (error_response, require_auth, require_special_auth,
+                        user_is_authorized)
+from flask import Blueprint, current_app, jsonify, request
+from meters.utils import get_user_id
+from rate_limit import limiter
+from billing.tariffs import load_tariffs_in_db
+from billing.utils import get_billing_runs_in_db, get_invoice_in_db, get_invoices_in_db
+
+billing_bp = Blueprint('billing', __name__)
+
+
+@billing_bp.route('/invoices', methods=['GET'])
+@limiter.limit("60 per minute")
+@require_auth
+def invoices():
+    """Retrieve invoices. Admins see all invoices (or those of ?user_id),
+    users their own. Paginated by id"""
+    try:
+        token = request.headers.get('Authorization')
+        if user_is_authorized(token, [99]):
+            user_id = request.args.get('user_id', type=int)
+        else:
+            user_id = get_user_id(token)
+            if not user_id:
+                return error_response("Unauthorized user", 403)
+
+        after_id = request.args.get('after_id', 0, type=int)
+        page_size = request.args.get(
+            'page_size', current_app.config['CONSUMPTION_PAGE_SIZE'], type=int)
+        page_size = max(1, min(page_size, current_app.config['CONSUMPTION_MAX_PAGE_SIZE']))
+
+        data = get_invoices_in_db(user_id=user_id, after_id=after_id, limit=page_size)
+        response = jsonify(data)
+        if len(data) == page_size:
+            response.headers['X-Next-After-Id'] = str(data[-1]['id'])
+        return response, 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@billing_bp.route('/invoices/<int:invoice_id>', methods=['GET'])
+@limiter.limit("60 per minute")
+@require_auth
+def invoice(invoice_id):
+    """Retrieve an invoice with its charges per meter"""
+    try:
+        token = request.headers.get('Authorization')
+        data = get_invoice_in_db(invoice_id)
+
+        # Invoices of other users are reported as missing
+        if data is None or (not user_is_authorized(token, [99])
+                            and data['user_id'] != get_user_id(token)):
+            return error_response("Invoice not found", 404)
+        return jsonify(data), 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@billing_bp.route('/tariffs', methods=['GET'])
+@limiter.limit("60 per minute")
+@require_auth
+def tariffs():
+    """Retrieve the available tariffs"""
+    try:
+        data = [tariff.to_dict() for tariff in load_tariffs_in_db(read_only=True).values()]
+        return jsonify(data), 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@billing_bp.route('/runs', methods=['GET'])
+@limiter.limit("60 per minute")
+@require_special_auth
+def runs():
+    """Retrieve the latest billing runs"""
+    try:
+        return jsonify(get_billing_runs_in_db()), 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
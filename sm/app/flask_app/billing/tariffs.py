@@ -0,0 +1,232 @@
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+from database import get_db_connection
+
+WEEKDAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+ALL_DAYS = 0b1111111
+
+# Hours of the week, a slot is weekday * 24 + hour (local time, Monday = 0)
+WEEK_SLOTS = 7 * 24
+
+
+class TariffError(Exception):
+    """Raised for an invalid tariff definition."""
+
+
+class Tariff:
+    """A tariff prices energy either by time of use or by tiers.
+
+    Time-of-use rates cover every hour of the week exactly once. Rates
+    with the same label form one band and must have the same price.
+    Tiers price the consumption of the billing period: the kWh from
+    ``from_kwh`` up to the next tier cost the price of the tier.
+    """
+
+    def __init__(self, tariff_id: int, name: str, base_fee, rates=(), tiers=()):
+        self.id = tariff_id
+        self.name = name
+        self.base_fee = Decimal(base_fee)
+        self.rates = list(rates)
+        self.tiers = sorted(tiers, key=lambda tier: tier[1])
+        if bool(self.rates) == bool(self.tiers):
+            raise TariffError(f"{name}: a tariff needs either rates or tiers")
+
+        if self.rates:
+            self.labels, self.prices, self.slot_band = self._compile_rates()
+        else:
+            self.labels, self.prices, self.bounds = self._compile_tiers()
+
+    @property
+    def kind(self) -> str:
+        return 'time_of_use' if self.rates else 'tiered'
+
+    def _compile_rates(self):
+        """Map every slot of the week to the index of its band."""
+        labels = []
+        prices = []
+        slot_band = np.full(WEEK_SLOTS, -1, dtype=np.int64)
+        for label, days, start_hour, end_hour, price in self.rates:
+            if not 0 <= start_hour < 24 or not 0 < end_hour <= 24 or start_hour == end_hour:
+                raise TariffError(f"{self.name}: invalid hours {start_hour}-{end_hour}")
+            if label in labels:
+                band = labels.index(label)
+                if prices[band] != price:
+                    raise TariffError(f"{self.name}: band {label} has different prices")
+            else:
+                band = len(labels)
+                labels.append(label)
+                prices.append(price)
+
+            # Rates like 22-6 wrap around midnight
+            hours = (range(start_hour, end_hour) if start_hour < end_hour
+                     else [*range(start_hour, 24), *range(end_hour)])
+            for weekday in range(7):
+                if days & (1 << weekday):
+                    for hour in hours:
+                        slot = weekday * 24 + hour
+                        if slot_band[slot] != -1:
+                            raise TariffError(
+                                f"{self.name}: {WEEKDAY_NAMES[weekday]} {hour}:00 "
+                                f"is covered by several rates")
+                        slot_band[slot] = band
+
+        uncovered = np.flatnonzero(slot_band == -1)
+        if len(uncovered):
+            weekday, hour = divmod(int(uncovered[0]), 24)
+            raise TariffError(
+                f"{self.name}: {WEEKDAY_NAMES[weekday]} {hour}:00 is not covered by a rate")
+        return labels, prices, slot_band
+
+    def _compile_tiers(self):
+        """Return the tier boundaries in kWh, the last tier is open-ended."""
+        if self.tiers[0][1] != 0:
+            raise TariffError(f"{self.name}: the first tier has to start at 0 kWh")
+        labels = [label for label, _, _ in self.tiers]
+        if len(set(labels)) != len(labels):
+            raise TariffError(f"{self.name}: tier labels have to be unique")
+        bounds = np.array([float(from_kwh) for _, from_kwh, _ in self.tiers] + [np.inf])
+        if np.any(np.diff(bounds) <= 0):
+            raise TariffError(f"{self.name}: tiers have to start at different kWh")
+        return labels, [price for _, _, price in self.tiers], bounds
+
+    def to_dict(self) -> dict:
+        """Return the definition in the format read by parse_tariff."""
+        tariff = {'id': self.id, 'name': self.name, 'base_fee': self.base_fee,
+                  'kind': self.kind}
+        if self.rates:
+            tariff['rates'] = [
+                {'label': label,
+                 'days': [name for weekday, name in enumerate(WEEKDAY_NAMES)
+                          if days & (1 << weekday)],
+                 'start_hour': start_hour, 'end_hour': end_hour, 'price_per_kwh': price}
+                for label, days, start_hour, end_hour, price in self.rates]
+        else:
+            tariff['tiers'] = [
+                {'label': label, 'from_kwh': from_kwh, 'price_per_kwh': price}
+                for label, from_kwh, price in self.tiers]
+        return tariff
+
+
+def _decimal(value, field: str, name: str) -> Decimal:
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation as e:
+        raise TariffError(f"{name}: {field} must be a number") from e
+    if not number.is_finite() or number < 0:
+        raise TariffError(f"{name}: {field} must be a non-negative number")
+    return number
+
+
+def _days_mask(days, name: str) -> int:
+    if days is None:
+        return ALL_DAYS
+    mask = 0
+    for day in days:
+        try:
+            mask |= 1 << WEEKDAY_NAMES.index(str(day).lower()[:3])
+        except ValueError as e:
+            raise TariffError(f"{name}: unknown day {day}") from e
+    return mask
+
+
+def parse_tariff(definition: dict) -> Tariff:
+    """Validate a tariff definition like
+
+    {"name": "dual", "base_fee": "9.90",
+     "rates": [{"label": "day", "start_hour": 6, "end_hour": 22, "price_per_kwh": "0.34"},
+               {"label": "night", "start_hour": 22, "end_hour": 6, "price_per_kwh": "0.26"}]}
+
+    or, with tiers, {"name": ..., "tiers": [{"label": ..., "from_kwh": 0, "price_per_kwh": ...}]}.
+    Rates apply to all days unless "days" lists weekdays ("mon" ... "sun").
+    """
+    name = definition.get('name')
+    if not name:
+        raise TariffError("A tariff needs a name")
+    try:
+        rates = [(str(rate['label']), _days_mask(rate.get('days'), name),
+                  int(rate['start_hour']), int(rate['end_hour']),
+                  _decimal(rate['price_per_kwh'], 'price_per_kwh', name))
+                 for rate in definition.get('rates') or []]
+        tiers = [(str(tier['label']), _decimal(tier['from_kwh'], 'from_kwh', name),
+                  _decimal(tier['price_per_kwh'], 'price_per_kwh', name))
+                 for tier in definition.get('tiers') or []]
+    except (KeyError, TypeError, ValueError) as e:
+        raise TariffError(f"{name}: invalid rate or tier ({e})") from e
+    return Tariff(None, name, _decimal(definition.get('base_fee', 0), 'base_fee', name),
+                  rates, tiers)
+
+
+def load_tariffs_in_db(read_only: bool = False) -> dict:
+    """Return all tariffs by ID."""
+    with get_db_connection(read_only=read_only) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT id, name, base_fee FROM tariffs ORDER BY id""")
+        tariffs = {row[0]: (row[1], row[2], [], []) for row in cursor.fetchall()}
+        cursor.execute(
+            """SELECT tariff_id, label, days, start_hour, end_hour, price_per_kwh
+            FROM tariff_rates ORDER BY id""")
+        for tariff_id, *rate in cursor.fetchall():
+            tariffs[tariff_id][2].append(tuple(rate))
+        cursor.execute(
+            """SELECT tariff_id, label, from_kwh, price_per_kwh
+            FROM tariff_tiers ORDER BY from_kwh""")
+        for tariff_id, *tier in cursor.fetchall():
+            tariffs[tariff_id][3].append(tuple(tier))
+
+    return {tariff_id: Tariff(tariff_id, *definition)
+            for tariff_id, definition in tariffs.items()}
+
+
+def save_tariff_in_db(tariff: Tariff) -> int:
+    """Create a tariff or replace the rates and tiers of the tariff with its name.
+
+    Changed prices apply to billing runs started afterwards.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """INSERT INTO tariffs (name, base_fee) VALUES (%s, %s) AS new
+            ON DUPLICATE KEY UPDATE base_fee = new.base_fee""",
+            (tariff.name, tariff.base_fee))
+        cursor.execute("""SELECT id FROM tariffs WHERE name = %s""", (tariff.name,))
+        tariff_id = cursor.fetchone()[0]
+
+        cursor.execute("""DELETE FROM tariff_rates WHERE tariff_id = %s""", (tariff_id,))
+        cursor.execute("""DELETE FROM tariff_tiers WHERE tariff_id = %s""", (tariff_id,))
+        if tariff.rates:
+            cursor.executemany(
+                """INSERT INTO tariff_rates (
+                    tariff_id, label, days, start_hour, end_hour, price_per_kwh)
+                VALUES (%s, %s, %s, %s, %s, %s)""",
+                [(tariff_id, *rate) for rate in tariff.rates])
+        if tariff.tiers:
+            cursor.executemany(
+                """INSERT INTO tariff_tiers (tariff_id, label, from_kwh, price_per_kwh)
+                VALUES (%s, %s, %s, %s)""",
+                [(tariff_id, *tier) for tier in tariff.tiers])
+        conn.commit()
+    return tariff_id
+
+
+def assign_tariff_in_db(tariff_name: str, meter_ids: list) -> int:
+    """Bill the given meters (external IDs) with a tariff. Returns the number of meters."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT id FROM tariffs WHERE name = %s""", (tariff_name,))
+        row = cursor.fetchone()
+        if row is None:
+            raise TariffError(f"Unknown tariff {tariff_name}")
+
+        placeholders = ", ".join(["%s"] * len(meter_ids))
+        cursor.execute(
+            f"""INSERT INTO meter_tariffs (meter_id, tariff_id)
+            SELECT id, %s FROM meters WHERE meter_id IN ({placeholders})
+            ON DUPLICATE KEY UPDATE tariff_id = %s""",
+            (row[0], *meter_ids, row[0]))
+        cursor.execute(
+            f"""SELECT COUNT(*) FROM meters WHERE meter_id IN ({placeholders})""",
+            tuple(meter_ids))
+        count = cursor.fetchone()[0]
+        conn.commit()
+    return count
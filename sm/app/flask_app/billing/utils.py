@@ -0,0 +1,63 @@
+from database import get_db_connection
+
+
+def get_invoices_in_db(user_id: int = None, after_id: int = 0, limit: int = 100) -> list:
+    """Retrieve a page of invoices ordered by ID.
+
+    Args:
+        user_id: Only invoices of this user
+        after_id: Keyset pagination, return invoices with a larger ID
+        limit: Page size
+    """
+    user_filter = " AND user_id = %s" if user_id is not None else ""
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f"""SELECT id, user_id, period_start, period_end, currency, kwh, amount, created_at
+            FROM invoices
+            WHERE id > %s{user_filter}
+            ORDER BY id
+            LIMIT %s""",
+            (after_id, user_id, limit) if user_id is not None else (after_id, limit))
+        return cursor.fetchall()
+
+
+def get_invoice_in_db(invoice_id: int):
+    """Retrieve an invoice with its charges per meter, or None."""
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            """SELECT id, run_id, user_id, period_start, period_end, currency, kwh, amount,
+            created_at
+            FROM invoices WHERE id = %s""",
+            (invoice_id,))
+        invoice = cursor.fetchone()
+        if invoice is None:
+            return None
+
+        cursor.execute(
+            """SELECT m.meter_id, t.name AS tariff, c.label, c.kwh, c.price_per_kwh, c.amount
+            FROM billing_charges c
+            INNER JOIN meters m ON c.meter_id = m.id
+            INNER JOIN tariffs t ON c.tariff_id = t.id
+            WHERE c.run_id = %s AND c.owner_id = %s
+            ORDER BY m.meter_id, c.id""",
+            (invoice.pop('run_id'), invoice['user_id']))
+        invoice['charges'] = cursor.fetchall()
+        return invoice
+
+
+def get_billing_runs_in_db(limit: int = 100) -> list:
+    """Retrieve the latest billing runs with their number of invoices and total."""
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            """SELECT r.id, r.period_start, r.period_end, r.status, r.started_at,
+            r.finished_at, COUNT(i.id) AS invoices, SUM(i.amount) AS amount
+            FROM billing_runs r
+            LEFT JOIN invoices i ON i.run_id = r.id
+            GROUP BY r.id
+            ORDER BY r.period_start DESC
+            LIMIT %s""",
+            (limit,))
+        return cursor.fetchall()
@@ -0,0 +1,197 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import worker_processes
+from database import use_primary
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache with a time to live per entry."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (True, value) for a live entry, (False, None) otherwise."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCacheBackend:
+    """Cache in a SQLite file shared by all worker processes of a host.
+
+    Invalidations are seen by every worker. Least recently written entries
+    are evicted once ``max_entries`` is exceeded.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # SQLite connections must not be shared across a fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL)""")
+            self._conn.execute(
+                """CREATE INDEX IF NOT EXISTS cache_entries_expires_at
+                ON cache_entries (expires_at)""")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection().execute(
+                """SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?""",
+                (key, time.time())).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                """INSERT OR REPLACE INTO cache_entries (key, value, expires_at)
+                VALUES (?, ?, ?)""",
+                (key, pickle.dumps(value), time.time() + ttl))
+            conn.execute(
+                """DELETE FROM cache_entries WHERE key IN (
+                    SELECT key FROM cache_entries ORDER BY expires_at DESC
+                    LIMIT -1 OFFSET ?)""",
+                (self.max_entries,))
+
+    def delete(self, keys):
+        with self._lock:
+            self._connection().executemany(
+                """DELETE FROM cache_entries WHERE key = ?""",
+                [(key,) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("""DELETE FROM cache_entries""")
+
+
+class Cache:
+    """Read-through cache for rarely changing lookups.
+
+    Writers must call invalidate() with the keys they affect. Values are
+    loaded from the primary database, a lagging replica could put back
+    what was just invalidated.
+    """
+
+    def __init__(self):
+        self.backend = MemoryCacheBackend()
+        self.ttl = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def configure(self, backend, ttl: float):
+        """Use the given backend. A ttl of 0 disables the cache."""
+        self.backend = backend
+        self.ttl = ttl
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get_or_load(self, key: str, loader):
+        """Return the cached value for key, or load and cache it."""
+        if self.ttl <= 0:
+            return loader()
+
+        found, value = self.backend.get(key)
+        if found:
+            self._count('hits')
+            return value
+
+        self._count('misses')
+        with use_primary():
+            value = loader()
+        if value is not None:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        """Remove the given keys from the cache."""
+        self._count('invalidations')
+        self.backend.delete(keys)
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+cache = Cache()
+
+
+def init_cache(app):
+    """Configure the lookup cache from the app config."""
+    backend_name = app.config['CACHE_BACKEND']
+    workers = worker_processes(app.config)
+    if backend_name is None:
+        backend_name = 'sqlite' if workers > 1 else 'memory'
+    elif backend_name == 'memory' and workers > 1:
+        raise RuntimeError(f"CACHE_BACKEND 'memory' is per process and cannot be used "
+                           f"with {workers} worker processes, use 'sqlite'")
+
+    if backend_name == 'sqlite':
+        backend = SQLiteCacheBackend(app.config['CACHE_SQLITE_PATH'],
+                                     app.config['CACHE_MAX_ENTRIES'])
+    else:
+        backend = MemoryCacheBackend(app.config['CACHE_MAX_ENTRIES'])
+    cache.configure(backend, app.config['CACHE_TTL'])
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+def user_meters_key(user_id):
+    return f"meters:user:{user_id}"
+
+
+ALL_METERS_KEY = "meters:all"
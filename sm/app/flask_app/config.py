@@ -1,3 +1,6 @@
+import os
+
+
 class Config:
     """Base configuration class.
 
@@ -11,3 +14,189 @@ class Config:
         'password': 'Server1!',
         'database': 'sm'
     }
+
+    # Number of verified JWT tokens kept in memory (0 disables the cache)
+    TOKEN_CACHE_SIZE = 10000
+
+    # Rate limiting. memory:// only works with a single process and is refused
+    # with several WORKER_PROCESSES. To share the counters between workers use
+    # e.g. redis://host:6379 or the batched sqlite:///path/to/file.db storage
+    # (fixed-window strategy only, options flush_interval and batch_size in
+    # RATELIMIT_STORAGE_OPTIONS). None uses memory:// for one worker and
+    # RATELIMIT_SQLITE_PATH for several. A strategy of None picks fixed-window
+    # for sqlite:// and moving-window otherwise
+    RATELIMIT_STORAGE_URI = None
+    RATELIMIT_SQLITE_PATH = '/tmp/sm_ratelimit.db'
+    RATELIMIT_STRATEGY = None
+    RATELIMIT_STORAGE_OPTIONS = {}
+
+    # Number of server processes. None reads GUNICORN_WORKERS (exported by
+    # gunicorn.conf.py) when the app is created, 1 without it
+    WORKER_PROCESSES = None
+
+    # Cache for meters and user profiles. 'memory' is per process, 'sqlite'
+    # is shared by all workers of a host. Invalidations and the read-your-writes
+    # pin only work across workers with 'sqlite', so 'memory' is refused with
+    # several WORKER_PROCESSES. None picks 'sqlite' for several workers and
+    # 'memory' for one. A TTL of 0 disables the cache
+    CACHE_BACKEND = None
+    CACHE_SQLITE_PATH = '/tmp/sm_cache.db'
+    CACHE_TTL = 300
+    CACHE_MAX_ENTRIES = 10000
+
+    # Password hashing. Hashes with a different cost are renewed on login.
+    # BCRYPT_WORKERS is the pool size of each server process. None splits the
+    # cores between the WORKER_PROCESSES, 0 hashes in the request thread
+    BCRYPT_LOG_ROUNDS = 12
+    BCRYPT_WORKERS = None
+    BCRYPT_MAX_PENDING = 64
+    BCRYPT_TIMEOUT = 30
+    BCRYPT_RETRY_AFTER = 2
+
+    # Database connection pool
+    DB_POOL_SIZE = 5
+    DB_POOL_MAX_OVERFLOW = 10
+    DB_POOL_RECYCLE = 3600
+    DB_POOL_IDLE_TIMEOUT = 300
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_PRE_PING = True
+
+    # Read replicas, each a dict like DB_CONFIG. Helpers that only read are
+    # served by a replica ('round_robin' or 'least_connections'). Replicas
+    # lagging more than DB_REPLICA_MAX_LAG seconds are taken out of rotation.
+    # Requests that change data and, for DB_READ_YOUR_WRITES_SECONDS after
+    # such a request, all requests of the same user use the primary. The
+    # pin is kept in the cache backend, use 'sqlite' to share it between
+    # workers. DB_REPLICA_HOSTS adds replicas with the settings of DB_CONFIG,
+    # by default from the comma separated environment variable of that name
+    DB_REPLICAS = []
+    DB_REPLICA_HOSTS = [host for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',')
+                        if host]
+    DB_REPLICA_STRATEGY = 'round_robin'
+    DB_REPLICA_MAX_LAG = 5
+    DB_REPLICA_CHECK_INTERVAL = 5
+    DB_READ_YOUR_WRITES_SECONDS = 10
+
+    # Report the number and time (ms) of database queries per request in the
+    # X-DB-Queries / X-DB-Time response headers, used by `flask bench`
+    DB_REPORT_QUERIES = False
+
+    # Batch ingestion of consumption data
+    CONSUMPTION_BATCH_MAX_READINGS = 10000
+    CONSUMPTION_BATCH_CHUNK_SIZE = 1000
+
+    # Bulk import of historical data (flask import files). Progress is kept
+    # in the state directory so interrupted imports can be resumed
+    CONSUMPTION_IMPORT_CHUNK_SIZE = 10000
+    CONSUMPTION_IMPORT_STATE_DIR = '/var/lib/sm/import-state'
+
+    # Pagination and export of consumption data
+    CONSUMPTION_PAGE_SIZE = 10000
+    CONSUMPTION_MAX_PAGE_SIZE = 10000
+    CONSUMPTION_EXPORT_FETCH_SIZE = 1000
+
+    # Serve aggregates from the pre-aggregated rollup tables
+    CONSUMPTION_USE_ROLLUPS = True
+
+    # Monthly partitions of consumption_data. Retention is disabled if None
+    CONSUMPTION_PARTITION_MONTHS_AHEAD = 3
+    CONSUMPTION_RETENTION_MONTHS = None
+    CONSUMPTION_ARCHIVE_DIR = None
+
+    # Delta sync (/consumption/changes). Cursors older than the tombstone
+    # retention are rejected with 410. Rows are handed out once they are
+    # CONSUMPTION_SETTLE_SECONDS old, so that slower transactions committing
+    # lower ids or earlier modifications are not skipped. Keep it above the
+    # longest write transaction. The hot stores and the anomaly scan use it too
+    CONSUMPTION_CHANGES_PAGE_SIZE = 1000
+    CONSUMPTION_SETTLE_SECONDS = 10
+    CONSUMPTION_TOMBSTONE_RETENTION_DAYS = 30
+
+    # Live feed (/consumption/stream). Every open stream holds a worker thread,
+    # the limit per worker process leaves threads for the other requests.
+    # With several worker processes new readings are polled from the database
+    # every CONSUMPTION_FEED_POLL_INTERVAL seconds, None publishes in-process only
+    CONSUMPTION_FEED_QUEUE_SIZE = 100
+    CONSUMPTION_FEED_MAX_SUBSCRIBERS = 24
+    CONSUMPTION_FEED_POLL_INTERVAL = 1.0
+    CONSUMPTION_FEED_HEARTBEAT = 15
+    CONSUMPTION_FEED_MAX_DURATION = 300
+
+    # Asynchronous ingest (/consumption/add_batch?mode=async). Readings are
+    # acknowledged once they are in the write-ahead log and inserted by a
+    # background writer. FSYNC is 'always', 'interval' or 'never'. Disabled if
+    # the WAL directory is None. Clients of a full queue are told to retry
+    # after CONSUMPTION_INGEST_RETRY_AFTER seconds
+    CONSUMPTION_INGEST_WAL_DIR = '/var/lib/sm/ingest-wal'
+    CONSUMPTION_INGEST_FSYNC = 'always'
+    CONSUMPTION_INGEST_BATCH_SIZE = 5000
+    CONSUMPTION_INGEST_FLUSH_INTERVAL = 1.0
+    CONSUMPTION_INGEST_MAX_PENDING = 500000
+    CONSUMPTION_INGEST_RETRY_INTERVAL = 5.0
+    CONSUMPTION_INGEST_MAX_RETRIES = 10
+    CONSUMPTION_INGEST_RETRY_AFTER = 5
+
+    # In-memory store of the last HOT_STORE_DAYS of readings per meter for the
+    # recent reads of /consumption/get_data and /consumption/aggregate. Each
+    # worker process keeps its own store within HOT_STORE_MAX_BYTES, the least
+    # recently read meters are evicted. Changes are synced from the database
+    # every HOT_STORE_SYNC_INTERVAL seconds, so aggregates can lag behind the
+    # writes of other workers by that much; reads the store is not current
+    # for are served from the database. 0 bytes disables the store
+    HOT_STORE_DAYS = 7
+    HOT_STORE_MAX_BYTES = 64 * 1024 * 1024
+    HOT_STORE_SYNC_INTERVAL = 1.0
+
+    # Anomaly detection (flask anomalies scan). ANOMALY_WORKERS defaults to
+    # the number of cores, 0 scans in the calling process. Incremental scans
+    # load ANOMALY_CONTEXT_DAYS of older readings for the statistics
+    ANOMALY_WORKERS = None
+    ANOMALY_METERS_PER_TASK = 50
+    ANOMALY_CONTEXT_DAYS = 30
+    ANOMALY_MIN_READINGS = 24
+    ANOMALY_SPIKE_Z = 6.0
+    ANOMALY_SPIKE_IQR_FACTOR = 3.0
+    ANOMALY_FLATLINE_MIN_READINGS = 12
+    ANOMALY_GAP_FACTOR = 3.0
+    ANOMALY_SHIFT_WINDOW = 48
+    ANOMALY_SHIFT_SIGMA = 3.0
+
+    # Billing (flask billing run). Periods are calendar months in
+    # BILLING_TIMEZONE, tariff hours are local times. The hourly rollup is used
+    # with CONSUMPTION_USE_ROLLUPS, so the time zone needs whole-hour offsets.
+    # Meters without a tariff are billed with BILLING_DEFAULT_TARIFF (a name)
+    # or left out if None. BILLING_WORKERS defaults to the number of cores,
+    # 0 bills in the calling process
+    BILLING_TIMEZONE = 'Europe/Berlin'
+    BILLING_CURRENCY = 'EUR'
+    BILLING_DEFAULT_TARIFF = None
+    BILLING_WORKERS = None
+    BILLING_METERS_PER_TASK = 200
+
+    # JSON serialization: 'orjson' or Flask's 'default' provider. Dates are
+    # serialized as HTTP dates like Flask does ('http'), or as ISO 8601
+    # ('iso'), which is considerably faster for large responses
+    JSON_PROVIDER = 'orjson'
+    JSON_DATETIME_FORMAT = 'http'
+
+    # Instrumentation: request timing in the Server-Timing header, per-endpoint
+    # and per-statement metrics at /metrics. Workers share their metrics through
+    # snapshot files in METRICS_DIR. Without METRICS_TOKEN, /metrics only
+    # answers requests from localhost
+    INSTRUMENTATION_ENABLED = False
+    METRICS_DIR = '/tmp/sm-metrics'
+    METRICS_TOKEN = None
+    METRICS_FLUSH_INTERVAL = 5.0
+    # Write folded stacks of requests slower than this to PROFILE_DIR
+    # (disabled if None)
+    PROFILE_SLOW_REQUEST_MS = None
+    PROFILE_DIR = '/tmp/sm-profiles'
+    PROFILE_INTERVAL_MS = 5
+
+
+def worker_processes(config) -> int:
+    """Return the number of server processes the app runs in."""
+    workers = config['WORKER_PROCESSES']
+    if workers is None:
+        workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+    return workers
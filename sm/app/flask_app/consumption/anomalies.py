@@ -0,0 +1,406 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import mysql.connector
+import numpy as np
+from database import get_db_connection
+
+ANOMALY_KINDS = ('negative', 'spike', 'flatline', 'gap', 'shift')
+
+# Scale of the median absolute deviation to the standard deviation of a normal distribution
+MAD_SCALE = 0.6745
+
+
+def _runs(mask):
+    """Return the [start, end) index pairs of the runs of True in a boolean array."""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+def detect_negative(timestamps, values, settings):
+    """Readings below zero."""
+    return [('negative', timestamps[i], timestamps[i], float(values[i]),
+             f"{values[i]:.2f} kWh")
+            for i in np.flatnonzero(values < 0)]
+
+
+def detect_spikes(timestamps, values, settings):
+    """Readings far outside the usual range of the meter.
+
+    A reading is a spike if it lies more than ANOMALY_SPIKE_IQR_FACTOR
+    interquartile ranges outside the quartiles and its robust z-score
+    (based on the median absolute deviation) exceeds ANOMALY_SPIKE_Z.
+    """
+    if len(values) < settings['min_readings']:
+        return []
+
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    mad = np.median(np.abs(values - median))
+    if mad == 0 or iqr == 0:
+        # Mostly constant series are the flatline check's business
+        return []
+
+    z_scores = MAD_SCALE * (values - median) / mad
+    factor = settings['spike_iqr_factor']
+    mask = (((values > q3 + factor * iqr) | (values < q1 - factor * iqr))
+            & (np.abs(z_scores) > settings['spike_z']))
+    return [('spike', timestamps[i], timestamps[i], float(abs(z_scores[i])),
+             f"{values[i]:.2f} kWh, median {median:.2f} kWh")
+            for i in np.flatnonzero(mask)]
+
+
+def detect_flatlines(timestamps, values, settings):
+    """Runs of at least ANOMALY_FLATLINE_MIN_READINGS identical readings."""
+    if len(values) < settings['flatline_min_readings']:
+        return []
+
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    ends = np.concatenate((starts[1:], [len(values)]))
+    lengths = ends - starts
+    return [('flatline', timestamps[start], timestamps[end - 1], float(length),
+             f"{length} readings of {values[start]:.2f} kWh")
+            for start, end, length in zip(starts, ends, lengths)
+            if length >= settings['flatline_min_readings']]
+
+
+def detect_gaps(timestamps, values, settings):
+    """Intervals without readings, longer than ANOMALY_GAP_FACTOR usual intervals.
+
+    The usual interval of a meter is the median time between its readings.
+    """
+    if len(timestamps) < 3:
+        return []
+
+    intervals = np.diff(timestamps)
+    usual = np.median(intervals)
+    if usual <= 0:
+        return []
+
+    return [('gap', timestamps[i], timestamps[i + 1], float(intervals[i] / usual),
+             f"about {int(round(intervals[i] / usual)) - 1} missing readings")
+            for i in np.flatnonzero(intervals > settings['gap_factor'] * usual)]
+
+
+def detect_shifts(timestamps, values, settings):
+    """Sudden lasting changes of the baseline.
+
+    Compares the mean of the ANOMALY_SHIFT_WINDOW readings before each
+    reading with the mean of the window starting at it. Where the
+    difference exceeds ANOMALY_SHIFT_SIGMA pooled standard deviations, the
+    reading with the largest difference of each such region is reported.
+    """
+    window = settings['shift_window']
+    count = len(values)
+    if count < 2 * window:
+        return []
+
+    # Window sums for every split point from prefix sums
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    squares = np.concatenate(([0.0], np.cumsum(values * values)))
+    splits = np.arange(window, count - window + 1)
+    mean_before = (sums[splits] - sums[splits - window]) / window
+    mean_after = (sums[splits + window] - sums[splits]) / window
+    var_before = (squares[splits] - squares[splits - window]) / window - mean_before ** 2
+    var_after = (squares[splits + window] - squares[splits]) / window - mean_after ** 2
+    pooled = np.sqrt(np.maximum((var_before + var_after) / 2, 0))
+
+    difference = np.abs(mean_after - mean_before)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(pooled > 0, difference / pooled,
+                          np.where(difference > 0, np.inf, 0.0))
+
+    anomalies = []
+    for start, end in _runs(scores > settings['shift_sigma']):
+        best = start + int(np.argmax(scores[start:end]))
+        split = splits[best]
+        anomalies.append((
+            'shift', timestamps[split], timestamps[min(split + window, count) - 1],
+            float(min(scores[best], 1e9)),
+            f"mean {mean_before[best]:.2f} kWh before, {mean_after[best]:.2f} kWh after"))
+    return anomalies
+
+
+DETECTORS = (detect_negative, detect_spikes, detect_flatlines, detect_gaps, detect_shifts)
+
+
+def detect_anomalies(timestamps, values, settings, since=None) -> list:
+    """Run all checks over the readings of one meter.
+
+    Args:
+        timestamps: Seconds as int64 array, ascending
+        values: consumption_kwh as float64 array
+        settings: Thresholds, see get_anomaly_settings
+        since: Only return anomalies ending at or after this time (seconds)
+
+    Returns:
+        list: (kind, start, end, score, detail) tuples, times in seconds
+    """
+    anomalies = []
+    for detector in DETECTORS:
+        anomalies.extend(detector(timestamps, values, settings))
+    if since is not None:
+        anomalies = [anomaly for anomaly in anomalies if anomaly[2] >= since]
+    return anomalies
+
+
+def load_series(cursor, meter_id: int, start=None):
+    """Load the readings of a meter as (timestamps in seconds, values) arrays."""
+    if start is None:
+        cursor.execute(
+            """SELECT timestamp, consumption_kwh FROM consumption_data
+            WHERE meter_id = %s ORDER BY timestamp""",
+            (meter_id,))
+    else:
+        cursor.execute(
+            """SELECT timestamp, consumption_kwh FROM consumption_data
+            WHERE meter_id = %s AND timestamp >= %s ORDER BY timestamp""",
+            (meter_id, start))
+    rows = cursor.fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    timestamps, values = zip(*rows)
+    return (np.array(timestamps, dtype='datetime64[s]').astype(np.int64),
+            np.array(values, dtype=np.float64))
+
+
+def _to_datetime(seconds):
+    return np.datetime64(int(seconds), 's').item()
+
+
+def _scan_meters(db_config: dict, jobs: list, settings: dict) -> tuple:
+    """Scan a share of the meters. Runs in a worker process.
+
+    Args:
+        db_config: Connection settings, workers open their own connection
+        jobs: (meter_id, since) tuples, since is None for a full scan
+        settings: Thresholds, see get_anomaly_settings
+
+    Returns:
+        tuple: (list of (meter_id, kind, start, end, score, detail), number of readings)
+    """
+    context = timedelta(days=settings['context_days'])
+    results = []
+    readings = 0
+    conn = mysql.connector.connect(**db_config)
+    try:
+        cursor = conn.cursor()
+        for meter_id, since in jobs:
+            timestamps, values = load_series(
+                cursor, meter_id, since - context if since is not None else None)
+            readings += len(values)
+            since_seconds = (np.datetime64(since, 's').astype(np.int64)
+                             if since is not None else None)
+            for kind, start, end, score, detail in detect_anomalies(
+                    timestamps, values, settings, since_seconds):
+                results.append((meter_id, kind, _to_datetime(start), _to_datetime(end),
+                                score, detail))
+    finally:
+        conn.close()
+    return results, readings
+
+
+def _store_anomalies(anomalies: list, replace_meters=None):
+    """Upsert anomalies. replace_meters: meters whose old anomalies are removed first."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if replace_meters:
+            placeholders = ", ".join(["%s"] * len(replace_meters))
+            cursor.execute(
+                f"""DELETE FROM consumption_anomalies WHERE meter_id IN ({placeholders})""",
+                tuple(replace_meters))
+        if anomalies:
+            cursor.executemany(
+                """INSERT INTO consumption_anomalies (
+                    meter_id, kind, start_timestamp, end_timestamp, score, detail)
+                VALUES (%s, %s, %s, %s, %s, %s) AS new
+                ON DUPLICATE KEY UPDATE
+                    end_timestamp = new.end_timestamp,
+                    score = new.score,
+                    detail = new.detail,
+                    detected_at = CURRENT_TIMESTAMP""",
+                anomalies)
+        conn.commit()
+
+
+def pending_meters(cursor, after_id: int, last_id: int, meter_id: int = None) -> list:
+    """Return (meter_id, first new timestamp) of meters with readings after_id < id <= last_id."""
+    meter_filter = " AND meter_id = %s" if meter_id is not None else ""
+    cursor.execute(
+        f"""SELECT meter_id, MIN(timestamp) FROM consumption_data
+        WHERE id > %s AND id <= %s{meter_filter}
+        GROUP BY meter_id""",
+        (after_id, last_id, meter_id) if meter_id is not None else (after_id, last_id))
+    return cursor.fetchall()
+
+
+def get_anomaly_settings(config) -> dict:
+    """Collect the detection thresholds from the app config."""
+    return {
+        'min_readings': config['ANOMALY_MIN_READINGS'],
+        'spike_z': config['ANOMALY_SPIKE_Z'],
+        'spike_iqr_factor': config['ANOMALY_SPIKE_IQR_FACTOR'],
+        'flatline_min_readings': config['ANOMALY_FLATLINE_MIN_READINGS'],
+        'gap_factor': config['ANOMALY_GAP_FACTOR'],
+        'shift_window': config['ANOMALY_SHIFT_WINDOW'],
+        'shift_sigma': config['ANOMALY_SHIFT_SIGMA'],
+        'context_days': config['ANOMALY_CONTEXT_DAYS'],
+    }
+
+
+def run_anomaly_scan(config, full: bool = False, meter_id: int = None,
+                     workers: int = None, progress=None) -> dict:
+    """Scan the consumption data for anomalies.
+
+    An incremental scan only looks at meters with readings added since the
+    previous scan, together with ANOMALY_CONTEXT_DAYS of older readings
+    for the statistics, and only records anomalies that involve the new
+    readings. A full scan re-checks all readings and replaces the stored
+    anomalies. The meters are split across a process pool.
+
+    Readings are scanned up to the highest ID at the start, after waiting
+    CONSUMPTION_SETTLE_SECONDS for transactions still committing lower
+    IDs. Scans of a single meter record no watermark, the next incremental
+    scan continues after the last scan of all meters.
+
+    Args:
+        config: App config
+        full: Scan everything instead of the readings since the last scan
+        meter_id: Only scan this meter (database ID)
+        workers: Worker processes, defaults to ANOMALY_WORKERS. 0 scans in this process
+        progress: Called with the number of scanned meters and the total
+
+    Returns:
+        dict: Mode, scanned meters, readings and found anomalies
+    """
+    settings = get_anomaly_settings(config)
+    if workers is None:
+        workers = config['ANOMALY_WORKERS']
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM consumption_data""")
+        last_id = cursor.fetchone()[0]
+        cursor.execute(
+            """SELECT last_consumption_id FROM consumption_anomaly_scans
+            WHERE finished_at IS NOT NULL AND meter_id IS NULL
+            ORDER BY id DESC LIMIT 1""")
+        previous = cursor.fetchone()
+        full = full or previous is None
+        # Ends the snapshot, the scan reads what committed while waiting
+        conn.commit()
+
+    time.sleep(config['CONSUMPTION_SETTLE_SECONDS'])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        if full:
+            if meter_id is None:
+                cursor.execute("""SELECT id FROM meters ORDER BY id""")
+            else:
+                cursor.execute("""SELECT id FROM meters WHERE id = %s""", (meter_id,))
+            jobs = [(row[0], None) for row in cursor.fetchall()]
+        else:
+            jobs = pending_meters(cursor, previous[0], last_id, meter_id)
+
+        cursor.execute(
+            """INSERT INTO consumption_anomaly_scans (
+                mode, meter_id, last_consumption_id, meters, readings, anomalies)
+            VALUES (%s, %s, %s, %s, 0, 0)""",
+            ('full' if full else 'incremental', meter_id,
+             last_id if meter_id is None else None, len(jobs)))
+        scan_id = cursor.lastrowid
+        conn.commit()
+
+    size = config['ANOMALY_METERS_PER_TASK']
+    chunks = [jobs[start:start + size] for start in range(0, len(jobs), size)]
+    db_config = config['DB_CONFIG']
+    summary = {'mode': 'full' if full else 'incremental', 'meters': len(jobs),
+               'readings': 0, 'anomalies': 0}
+
+    def store(chunk, result):
+        anomalies, readings = result
+        _store_anomalies(anomalies, [job[0] for job in chunk] if full else None)
+        summary['readings'] += readings
+        summary['anomalies'] += len(anomalies)
+
+    scanned = 0
+    if workers == 0:
+        for chunk in chunks:
+            store(chunk, _scan_meters(db_config, chunk, settings))
+            scanned += len(chunk)
+            if progress is not None:
+                progress(scanned, len(jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(chunk, executor.submit(_scan_meters, db_config, chunk, settings))
+                       for chunk in chunks]
+            for chunk, future in futures:
+                store(chunk, future.result())
+                scanned += len(chunk)
+                if progress is not None:
+                    progress(scanned, len(jobs))
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE consumption_anomaly_scans
+            SET readings = %s, anomalies = %s, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s""",
+            (summary['readings'], summary['anomalies'], scan_id))
+        conn.commit()
+    return summary
+
+
+def get_anomalies_in_db(kind: str = None, meter_id: str = None, start=None, end=None,
+                        after_id: int = 0, limit: int = 1000) -> list:
+    """Retrieve a page of anomalies ordered by ID.
+
+    Args:
+        kind: Only anomalies of this kind
+        meter_id: Only anomalies of this meter (external ID)
+        start: Only anomalies ending at or after this time
+        end: Only anomalies starting before this time
+        after_id: Keyset pagination, return anomalies with a larger ID
+        limit: Page size
+    """
+    conditions = ["a.id > %s"]
+    params = [after_id]
+    if kind is not None:
+        conditions.append("a.kind = %s")
+        params.append(kind)
+    if meter_id is not None:
+        conditions.append("m.meter_id = %s")
+        params.append(meter_id)
+    if start is not None:
+        conditions.append("a.end_timestamp >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("a.start_timestamp < %s")
+        params.append(end)
+
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f"""SELECT
+            a.id,
+            m.meter_id,
+            a.kind,
+            a.start_timestamp,
+            a.end_timestamp,
+            a.score,
+            a.detail,
+            a.detected_at
+            FROM consumption_anomalies a
+            INNER JOIN meters m
+            ON a.meter_id = m.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY a.id
+            LIMIT %s""",
+            (*params, limit))
+        return cursor.fetchall()
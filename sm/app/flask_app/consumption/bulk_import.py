@@ -0,0 +1,226 @@
+import csv
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from database import get_db_connection
+from consumption.utils import validate_reading, write_readings_in_db
+
+IMPORT_COLUMNS = ['meter_id', 'consumption_kwh', 'timestamp']
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+
+class BulkImportError(Exception):
+    """Raised when an input file cannot be imported."""
+
+
+def get_meter_map_in_db() -> dict:
+    """Return all external meter IDs mapped to their database IDs."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""SELECT meter_id, id FROM meters""")
+        return dict(cursor.fetchall())
+
+
+def _check_columns(path: str, columns) -> None:
+    missing = [column for column in IMPORT_COLUMNS if column not in (columns or [])]
+    if missing:
+        raise BulkImportError(f"{path}: missing column(s) {', '.join(missing)}")
+
+
+def read_csv_rows(path: str, delimiter: str = ','):
+    """Yield the rows of a CSV file (optionally gzip compressed) as dicts."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='', encoding='utf-8') as csv_file:
+        reader = csv.DictReader(csv_file, delimiter=delimiter)
+        _check_columns(path, reader.fieldnames)
+        yield from reader
+
+
+def read_parquet_rows(path: str, batch_size: int = 10000):
+    """Yield the rows of a Parquet file as dicts, one row group batch at a time.
+
+    Requires pyarrow, which is only needed on hosts that import Parquet files.
+    """
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    parquet_file = pq.ParquetFile(path)
+    _check_columns(path, parquet_file.schema_arrow.names)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=IMPORT_COLUMNS):
+        yield from batch.to_pylist()
+
+
+def read_rows(path: str, delimiter: str = ',', batch_size: int = 10000):
+    """Yield the readings of a CSV or Parquet file, chosen by its extension."""
+    if path.lower().endswith(PARQUET_EXTENSIONS):
+        return read_parquet_rows(path, batch_size)
+    return read_csv_rows(path, delimiter)
+
+
+class ImportState:
+    """Progress of one input file, saved after every committed chunk.
+
+    A restarted import skips the rows that were already committed. Writes
+    are upserts, so rows committed after the last save are written again
+    without creating duplicates. If the file changed in the meantime,
+    its import starts over.
+    """
+
+    def __init__(self, state_dir: str, path: str):
+        self.path = os.path.abspath(path)
+        stat = os.stat(self.path)
+        self.signature = [stat.st_size, int(stat.st_mtime)]
+        name = hashlib.sha1(self.path.encode('utf-8')).hexdigest()
+        self.state_path = os.path.join(state_dir, f'{name}.json')
+        self.rejects_path = os.path.join(state_dir, f'{name}.rejected.csv')
+        self.reset()
+
+    def reset(self):
+        self.rows_done = 0
+        self.written = 0
+        self.rejected = 0
+        self.meter_ids = set()
+        self.complete = False
+
+    def load(self) -> bool:
+        """Load the saved progress. Returns whether there was any."""
+        try:
+            with open(self.state_path, encoding='utf-8') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return False
+
+        if state['signature'] != self.signature:
+            return False
+        self.rows_done = state['rows_done']
+        self.written = state['written']
+        self.rejected = state['rejected']
+        self.meter_ids = set(state['meter_ids'])
+        self.complete = state['complete']
+        return True
+
+    def save(self):
+        state = {
+            'path': self.path,
+            'signature': self.signature,
+            'rows_done': self.rows_done,
+            'written': self.written,
+            'rejected': self.rejected,
+            'meter_ids': sorted(self.meter_ids),
+            'complete': self.complete,
+        }
+        with open(self.state_path + '.tmp', 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def discard(self):
+        """Remove the saved progress and the rejected rows."""
+        for path in (self.state_path, self.rejects_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.reset()
+
+    def add_rejects(self, rejects: list):
+        """Append rejected rows as (row number, error, reading) to the rejects file."""
+        if not rejects:
+            return
+        new_file = not os.path.exists(self.rejects_path)
+        with open(self.rejects_path, 'a', newline='', encoding='utf-8') as rejects_file:
+            writer = csv.writer(rejects_file)
+            if new_file:
+                writer.writerow(['row', 'error', *IMPORT_COLUMNS])
+            for row_number, error, reading in rejects:
+                values = [reading.get(column) for column in IMPORT_COLUMNS] \
+                    if isinstance(reading, dict) else []
+                writer.writerow([row_number, error, *values])
+        self.rejected += len(rejects)
+
+
+def list_import_states(state_dir: str) -> list:
+    """Return the saved progress of all imports."""
+    if not os.path.isdir(state_dir):
+        return []
+    states = []
+    for name in sorted(os.listdir(state_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(state_dir, name), encoding='utf-8') as state_file:
+                states.append(json.load(state_file))
+    return states
+
+
+def import_file(path: str, meter_map: dict, state_dir: str, chunk_size: int = 10000,
+                insert_chunk_size: int = 1000, update_rollups: bool = True,
+                delimiter: str = ',', restart: bool = False, progress=None) -> ImportState:
+    """Import the readings of a CSV or Parquet file.
+
+    The file is streamed, every chunk of ``chunk_size`` rows is written in
+    one transaction and the progress is saved after each commit.
+    Readings that fail validation or belong to an unknown meter are
+    written to the rejects file of the import.
+
+    Args:
+        path: CSV (optionally .gz) or Parquet file with meter_id, consumption_kwh and timestamp columns
+        meter_map: External meter ID -> database ID, see get_meter_map_in_db
+        state_dir: Directory of the progress files
+        chunk_size: Rows per transaction
+        insert_chunk_size: Rows per multi-row INSERT
+        update_rollups: Refresh the rollups with every chunk. If False, the
+            rollups of state.meter_ids have to be rebuilt afterwards
+        delimiter: CSV field delimiter
+        restart: Ignore any saved progress
+        progress: Called with the state and the rows per second after every chunk
+
+    Returns:
+        ImportState: Progress of the file
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    state = ImportState(state_dir, path)
+    if restart or not state.load():
+        state.discard()
+    if state.complete:
+        return state
+
+    started = time.monotonic()
+    rows_started = state.rows_done
+    chunk = []
+    rejects = []
+
+    def commit(row_number):
+        if chunk:
+            write_readings_in_db(chunk, insert_chunk_size, update_rollups)
+            state.written += len(chunk)
+            state.meter_ids.update(meter_id for meter_id, _, _ in chunk)
+        state.add_rejects(rejects)
+        state.rows_done = row_number
+        state.save()
+        chunk.clear()
+        rejects.clear()
+        if progress is not None:
+            elapsed = time.monotonic() - started
+            progress(state, (state.rows_done - rows_started) / elapsed if elapsed else 0.0)
+
+    row_number = 0
+    for row_number, reading in enumerate(read_rows(path, delimiter, chunk_size), start=1):
+        if row_number <= state.rows_done:
+            continue
+
+        values, error = validate_reading(reading)
+        if error is None:
+            meter_id = meter_map.get(values[0])
+            if meter_id is None:
+                error = f"Unknown meter {values[0]}"
+            else:
+                chunk.append((meter_id, values[1], values[2]))
+        if error is not None:
+            rejects.append((row_number, error, reading))
+
+        if row_number - state.rows_done >= chunk_size:
+            commit(row_number)
+
+    state.complete = True
+    commit(max(row_number, state.rows_done))
+    return state
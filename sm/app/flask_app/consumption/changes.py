@@ -0,0 +1,228 @@
+import base64
+import json
+import time
+from datetime import datetime
+
+from consumption.partitions import get_retention_cutoff
+from database import get_db_connection
+
+
+class CursorError(Exception):
+    """Raised for malformed cursors."""
+
+
+class CursorExpiredError(Exception):
+    """Raised when a cursor is older than the tombstone retention."""
+
+
+def encode_cursor(position: dict) -> str:
+    """Encode a sync position into an opaque cursor."""
+    position = dict(position, issued=int(time.time()))
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str, max_age_days: int = None) -> dict:
+    """Decode a cursor created by encode_cursor. An empty cursor starts from the beginning.
+
+    Raises:
+        CursorError: If the cursor is malformed
+        CursorExpiredError: If the cursor is older than max_age_days
+    """
+    if not cursor:
+        return {'last_id': 0, 'modified': None, 'modified_id': 0, 'tombstone_id': 0,
+                'retention_id': 0, 'settled_id': 0, 'pending_id': None, 'pending_at': None}
+
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        position = {
+            'last_id': int(position['last_id']),
+            'modified': position['modified'],
+            'modified_id': int(position['modified_id']),
+            'tombstone_id': int(position['tombstone_id']),
+            # Cursors issued before retention watermarks existed
+            'retention_id': int(position.get('retention_id', 0)),
+            # Cursors issued before the settled watermark had all rows up to last_id
+            'settled_id': int(position.get('settled_id', position['last_id'])),
+            'pending_id': _optional_int(position.get('pending_id')),
+            'pending_at': _optional_int(position.get('pending_at')),
+            'issued': int(position['issued']),
+        }
+    except (ValueError, KeyError, TypeError) as e:
+        raise CursorError("Invalid cursor") from e
+
+    if max_age_days and time.time() - position['issued'] > max_age_days * 86400:
+        raise CursorExpiredError("Cursor expired, a full resync is required")
+    return position
+
+
+def _optional_int(value):
+    return int(value) if value is not None else None
+
+
+def advance_watermark(cursor, watermark: dict, settle_seconds: int) -> int:
+    """Return the highest consumption_data id below which no rows can still appear.
+
+    Ids are allocated when a row is inserted, not when it is committed, so
+    a slow transaction can commit an id below rows that are already
+    visible. The highest id seen at one call is trusted settle_seconds
+    later (by the database clock); writes taking longer are missed.
+
+    Args:
+        cursor: A cursor returning tuples
+        watermark: Dict with settled_id, pending_id and pending_at, updated in place
+        settle_seconds: Time a write transaction may take to commit
+
+    Returns:
+        int: The settled id
+    """
+    cursor.execute("""SELECT COALESCE(MAX(id), 0), UNIX_TIMESTAMP() FROM consumption_data""")
+    max_id, now = cursor.fetchone()
+    if settle_seconds <= 0:
+        watermark['settled_id'] = max(watermark['settled_id'], max_id)
+        watermark['pending_id'] = watermark['pending_at'] = None
+        return watermark['settled_id']
+
+    if (watermark['pending_id'] is not None
+            and now - watermark['pending_at'] >= settle_seconds):
+        watermark['settled_id'] = watermark['pending_id']
+        watermark['pending_id'] = watermark['pending_at'] = None
+    # Kept until it settles, or clients polling often would never get there
+    if watermark['pending_id'] is None and max_id > watermark['settled_id']:
+        watermark['pending_id'], watermark['pending_at'] = max_id, int(now)
+    return watermark['settled_id']
+
+
+def get_changes_in_db(position: dict, meter_ids: list = None, owner_id=None,
+                      limit: int = 1000, settle_seconds: int = 0) -> dict:
+    """Return the changes of consumption_data after a sync position.
+
+    Three streams are read, each with its own position in the cursor:
+    new rows (by id), modified rows the client has already seen (by
+    modify_timestamp, id) and deleted rows (tombstones by id). Rows that
+    could still be joined by slower transactions are held back: new rows
+    up to the watermark of advance_watermark, modified rows until their
+    modification is settle_seconds old (and at least one second, the
+    resolution of modify_timestamp). Readings removed by
+    the retention policy have no tombstones; if a partition was dropped
+    since the cursor, purged_before tells the client to remove all
+    readings before that time.
+
+    Args:
+        position: Decoded cursor
+        meter_ids: Database IDs of the meters in scope, all meters if None
+        owner_id: Only return tombstones of this owner, all if None
+        limit: Maximum number of rows per stream
+        settle_seconds: Time a write transaction may take to commit
+
+    Returns:
+        dict: changes, deleted IDs, purged_before (datetime or None), the new
+        position and has_more
+    """
+    position = dict(position)
+    position.pop('issued', None)
+    changes = []
+    deleted = []
+    has_more = False
+    purged_before = None
+
+    scope_condition = ""
+    scope_params = ()
+    if meter_ids is not None:
+        if not meter_ids:
+            scope_condition = " AND 1 = 0"
+        else:
+            scope_condition = f" AND c.meter_id IN ({', '.join(['%s'] * len(meter_ids))})"
+            scope_params = tuple(meter_ids)
+
+    with get_db_connection() as conn:
+        # Readings before the retention cutoff are about to be dropped or
+        # gone, a client that has not seen the cutoff yet removes them
+        retention = get_retention_cutoff(conn.cursor())
+        if retention is not None:
+            if retention[0] > position['retention_id']:
+                position['retention_id'], purged_before = retention
+            scope_condition += " AND c.timestamp >= %s"
+            scope_params += (retention[1],)
+
+        settled_id = advance_watermark(conn.cursor(), position, settle_seconds)
+        settle_seconds = max(settle_seconds, 1)
+        cursor = conn.cursor(dictionary=True)
+
+        # A new client receives every row through the insert stream, so its
+        # modification stream starts at the time of the first sync
+        if position['modified'] is None:
+            cursor.execute("""SELECT CURRENT_TIMESTAMP - INTERVAL %s SECOND AS start""",
+                           (settle_seconds,))
+            position['modified'] = cursor.fetchone()['start'].isoformat()
+            position['modified_id'] = 0
+
+        # New rows
+        cursor.execute(
+            f"""SELECT c.id, m.meter_id, c.consumption_kwh, c.timestamp, c.modify_timestamp
+            FROM consumption_data c
+            INNER JOIN meters m ON c.meter_id = m.id
+            WHERE c.id > %s AND c.id <= %s{scope_condition}
+            ORDER BY c.id
+            LIMIT %s""",
+            (position['last_id'], settled_id, *scope_params, limit))
+        inserted = cursor.fetchall()
+        has_more |= len(inserted) == limit
+
+        # Modified rows the client already has
+        modified_after = datetime.fromisoformat(position['modified'])
+        cursor.execute(
+            f"""SELECT c.id, m.meter_id, c.consumption_kwh, c.timestamp, c.modify_timestamp
+            FROM consumption_data c
+            INNER JOIN meters m ON c.meter_id = m.id
+            WHERE c.id <= %s
+            AND c.modify_timestamp < CURRENT_TIMESTAMP - INTERVAL %s SECOND
+            AND (c.modify_timestamp > %s OR (c.modify_timestamp = %s AND c.id > %s)){scope_condition}
+            ORDER BY c.modify_timestamp, c.id
+            LIMIT %s""",
+            (position['last_id'], settle_seconds, modified_after, modified_after,
+             position['modified_id'], *scope_params, limit))
+        modified = cursor.fetchall()
+        has_more |= len(modified) == limit
+
+        # Deleted rows
+        owner_condition = " AND owner_id = %s" if owner_id is not None else ""
+        owner_params = (owner_id,) if owner_id is not None else ()
+        cursor.execute(
+            f"""SELECT id, consumption_id FROM consumption_tombstones
+            WHERE id > %s{owner_condition}
+            ORDER BY id
+            LIMIT %s""",
+            (position['tombstone_id'], *owner_params, limit))
+        tombstones = cursor.fetchall()
+        has_more |= len(tombstones) == limit
+
+    changes.extend(modified)
+    changes.extend(inserted)
+    deleted.extend(tombstone['consumption_id'] for tombstone in tombstones)
+
+    if inserted:
+        position['last_id'] = inserted[-1]['id']
+    if modified:
+        position['modified'] = modified[-1]['modify_timestamp'].isoformat()
+        position['modified_id'] = modified[-1]['id']
+    if tombstones:
+        position['tombstone_id'] = tombstones[-1]['id']
+
+    return {'changes': changes, 'deleted': deleted, 'purged_before': purged_before,
+            'position': position, 'has_more': has_more}
+
+
+def prune_tombstones(retention_days: int) -> int:
+    """Delete tombstones older than the retention period.
+
+    Returns:
+        int: Number of deleted tombstones
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """DELETE FROM consumption_tombstones
+            WHERE deleted_at < NOW() - INTERVAL %s DAY""",
+            (retention_days,))
+        conn.commit()
+        return cursor.rowcount
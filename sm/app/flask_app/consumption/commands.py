@@ -0,0 +1,189 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from consumption.anomalies import run_anomaly_scan
+from consumption.bulk_import import (BulkImportError, get_meter_map_in_db, import_file,
+                                     list_import_states)
+from consumption.changes import prune_tombstones
+from consumption.ingest import ingest_queue
+from consumption.partitions import (apply_retention, create_future_partitions,
+                                    get_partitions)
+from consumption.rollups import check_rollups, rebuild_rollups
+
+rollups_cli = AppGroup('rollups', help='Maintain the consumption rollup tables.')
+partitions_cli = AppGroup('partitions', help='Maintain the consumption_data partitions.')
+ingest_cli = AppGroup('ingest', help='Manage the asynchronous ingest write-ahead log.')
+import_cli = AppGroup('import', help='Bulk import historical consumption data.')
+anomalies_cli = AppGroup('anomalies', help='Detect anomalies in the consumption data.')
+
+
+@rollups_cli.command('rebuild')
+@click.option('--meter-id', type=int, default=None,
+              help='Only rebuild this meter (database ID).')
+def rebuild_command(meter_id):
+    """Rebuild (or backfill) the rollups from the raw consumption data."""
+    count = rebuild_rollups(meter_id)
+    click.echo(f"Rebuilt rollups for {count} meter(s)")
+
+
+@rollups_cli.command('check')
+@click.option('--meter-id', type=int, default=None,
+              help='Only check this meter (database ID).')
+def check_command(meter_id):
+    """Compare the hourly and daily rollups with the raw consumption data."""
+    mismatches = check_rollups(meter_id)
+    for mismatch in mismatches:
+        click.echo(
+            f"{mismatch['granularity']} of meter {mismatch['meter_id']} "
+            f"{mismatch['bucket_start']}: "
+            f"raw {mismatch['raw_sum_kwh']} kWh / {mismatch['raw_count']} readings, "
+            f"rollup {mismatch['rollup_sum_kwh']} kWh / {mismatch['rollup_count']} readings")
+
+    if mismatches:
+        raise click.ClickException(f"{len(mismatches)} inconsistent bucket(s) found")
+    click.echo("Rollups are consistent")
+
+
+@partitions_cli.command('list')
+def list_command():
+    """List the partitions of consumption_data."""
+    for partition in get_partitions():
+        bound = partition['upper_bound'] or 'MAXVALUE'
+        click.echo(f"{partition['name']}: < {bound} (~{partition['table_rows']} rows)")
+
+
+@partitions_cli.command('maintain')
+@click.option('--months-ahead', type=int, default=None,
+              help='Months to create in advance. Defaults to CONSUMPTION_PARTITION_MONTHS_AHEAD.')
+@click.option('--retention-months', type=int, default=None,
+              help='Months to keep. Defaults to CONSUMPTION_RETENTION_MONTHS.')
+@click.option('--archive-dir', default=None,
+              help='Export dropped partitions to Parquet here. Defaults to CONSUMPTION_ARCHIVE_DIR.')
+def maintain_command(months_ahead, retention_months, archive_dir):
+    """Create upcoming partitions, apply the retention policy and prune tombstones.
+
+    Meant to run periodically, e.g. daily from cron.
+    """
+    config = current_app.config
+    if months_ahead is None:
+        months_ahead = config['CONSUMPTION_PARTITION_MONTHS_AHEAD']
+    if retention_months is None:
+        retention_months = config['CONSUMPTION_RETENTION_MONTHS']
+    if archive_dir is None:
+        archive_dir = config['CONSUMPTION_ARCHIVE_DIR']
+
+    for name in create_future_partitions(months_ahead):
+        click.echo(f"Created partition {name}")
+
+    if retention_months is not None:
+        for name in apply_retention(retention_months, archive_dir):
+            click.echo(f"Dropped partition {name}")
+
+    pruned = prune_tombstones(config['CONSUMPTION_TOMBSTONE_RETENTION_DAYS'])
+    click.echo(f"Pruned {pruned} tombstone(s)")
+
+
+@ingest_cli.command('replay')
+def replay_command():
+    """Insert readings left in the write-ahead log by stopped workers."""
+    if not ingest_queue.enabled:
+        raise click.ClickException("CONSUMPTION_INGEST_WAL_DIR is not set")
+    inserted = ingest_queue.replay()
+    click.echo(f"Inserted {inserted} reading(s)")
+
+
+@import_cli.command('files')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--jobs', type=int, default=1, show_default=True,
+              help='Files imported in parallel, each with its own connection.')
+@click.option('--chunk-size', type=int, default=None,
+              help='Rows per transaction. Defaults to CONSUMPTION_IMPORT_CHUNK_SIZE.')
+@click.option('--delimiter', default=',', show_default=True, help='CSV field delimiter.')
+@click.option('--defer-rollups', is_flag=True,
+              help='Rebuild the rollups of the imported meters at the end instead of per chunk.')
+@click.option('--restart', is_flag=True, help='Ignore the saved progress of the files.')
+def import_files_command(paths, jobs, chunk_size, delimiter, defer_rollups, restart):
+    """Import readings from CSV (optionally gzipped) or Parquet files.
+
+    Files need meter_id, consumption_kwh and timestamp columns. An
+    interrupted import continues where it stopped when run again.
+    """
+    config = current_app.config
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+    state_dir = config['CONSUMPTION_IMPORT_STATE_DIR']
+    if chunk_size is None:
+        chunk_size = config['CONSUMPTION_IMPORT_CHUNK_SIZE']
+
+    meter_map = get_meter_map_in_db()
+    click.echo(f"Loaded {len(meter_map)} meter(s)")
+    echo_lock = threading.Lock()
+
+    def report(state, rows_per_second):
+        with echo_lock:
+            click.echo(f"{state.path}: {state.rows_done} rows read, {state.written} written, "
+                       f"{state.rejected} rejected ({rows_per_second:.0f} rows/s)")
+
+    def run(path):
+        with app.app_context():
+            return import_file(path, meter_map, state_dir, chunk_size=chunk_size,
+                               insert_chunk_size=config['CONSUMPTION_BATCH_CHUNK_SIZE'],
+                               update_rollups=not defer_rollups, delimiter=delimiter,
+                               restart=restart, progress=report)
+
+    meter_ids = set()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(run, path): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                state = future.result()
+            except BulkImportError as e:
+                failures += 1
+                click.echo(f"Failed: {e}", err=True)
+                continue
+            meter_ids.update(state.meter_ids)
+            rejects = f", rejected rows in {state.rejects_path}" if state.rejected else ""
+            click.echo(f"Done {state.path}: {state.written} written, "
+                       f"{state.rejected} rejected{rejects}")
+
+    if defer_rollups:
+        for meter_id in sorted(meter_ids):
+            rebuild_rollups(meter_id)
+        click.echo(f"Rebuilt rollups for {len(meter_ids)} meter(s)")
+
+    if failures:
+        raise click.ClickException(f"{failures} file(s) could not be imported")
+
+
+@import_cli.command('status')
+def import_status_command():
+    """Show the progress of imported files."""
+    for state in list_import_states(current_app.config['CONSUMPTION_IMPORT_STATE_DIR']):
+        status = 'complete' if state['complete'] else 'incomplete'
+        click.echo(f"{state['path']}: {status}, {state['rows_done']} rows read, "
+                   f"{state['written']} written, {state['rejected']} rejected")
+
+
+@anomalies_cli.command('scan')
+@click.option('--full', is_flag=True,
+              help='Re-check all readings instead of the ones added since the last scan.')
+@click.option('--meter-id', type=int, default=None,
+              help='Only scan this meter (database ID).')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes. Defaults to ANOMALY_WORKERS, 0 scans in this process.')
+def anomalies_scan_command(full, meter_id, workers):
+    """Check the readings for spikes, flatlines, gaps and baseline shifts.
+
+    Meant to run periodically, e.g. hourly from cron.
+    """
+    def report(scanned, total):
+        click.echo(f"Scanned {scanned}/{total} meter(s)")
+
+    summary = run_anomaly_scan(current_app.config, full=full, meter_id=meter_id,
+                               workers=workers, progress=report)
+    click.echo(f"{summary['mode'].capitalize()} scan of {summary['meters']} meter(s), "
+               f"{summary['readings']} readings, {summary['anomalies']} anomalies")
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+from collections import deque
+
+from database import get_db_connection
+
+
+class FeedFullError(Exception):
+    """Raised when a worker has reached its maximum number of subscribers."""
+
+
+class Subscription:
+    """Bounded event queue of one live feed client.
+
+    If the client does not keep up, the oldest events are dropped and
+    counted so the client can resync through /consumption/changes.
+    """
+
+    def __init__(self, meter_ids, queue_size: int):
+        self.meter_ids = set(meter_ids) if meter_ids is not None else None
+        self.dropped = 0
+        self._events = deque(maxlen=queue_size)
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        with self._condition:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout: float) -> tuple:
+        """Wait up to timeout seconds for events.
+
+        Returns:
+            tuple: (events, number of events dropped since the last call)
+        """
+        with self._condition:
+            if not self._events:
+                self._condition.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+
+class FeedBroker:
+    """In-process pub/sub of new consumption readings.
+
+    Readings are published either by the write paths of this process right
+    after they commit, or, when ``poll_interval`` is set, by a background
+    thread that reads new rows from consumption_data. Polling is needed
+    when several worker processes serve the API, because a reading written
+    by one worker would otherwise never reach the subscribers of another.
+    It costs one query per interval and worker, independent of the number
+    of subscribers, and only runs while there are subscribers. Rows whose
+    transaction commits after a row with a higher id can be missed by the
+    poller; the feed is a notification channel, /consumption/changes stays
+    the source of truth.
+    """
+
+    def __init__(self):
+        self.queue_size = 100
+        self.max_subscribers = 24
+        self.poll_interval = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._tail_thread = None
+        self._tail_pid = None
+        self._app = None
+
+    def configure(self, app, queue_size: int, max_subscribers: int,
+                  poll_interval: float = None):
+        self._app = app
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.poll_interval = poll_interval
+
+    def subscribe(self, meter_ids=None) -> Subscription:
+        """Subscribe to the readings of the given meters (database IDs), all if None.
+
+        Raises:
+            FeedFullError: If this worker has no free subscriber slot
+        """
+        subscription = Subscription(meter_ids, self.queue_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise FeedFullError("Too many live feed subscribers")
+            self._subscribers.add(subscription)
+            if self.poll_interval and (self._tail_thread is None
+                                       or self._tail_pid != os.getpid()):
+                self._tail_thread = threading.Thread(
+                    target=self._tail, name='consumption-feed', daemon=True)
+                self._tail_pid = os.getpid()
+                self._tail_thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, readings):
+        """Publish committed readings of this process.
+
+        Ignored when polling, the tail thread picks them up from the database.
+
+        Args:
+            readings: Dicts with meter_id (database ID), consumption_kwh and
+                timestamp, and id where known
+        """
+        if not self.poll_interval:
+            self._dispatch(readings)
+
+    def _dispatch(self, readings):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            return
+        for reading in readings:
+            for subscription in subscribers:
+                if subscription.meter_ids is None or reading['meter_id'] in subscription.meter_ids:
+                    subscription.put(reading)
+
+    def _tail(self):
+        """Publish new rows of consumption_data while there are subscribers."""
+        last_id = None
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._tail_thread = None
+                    return
+            try:
+                with self._app.app_context(), get_db_connection() as conn:
+                    cursor = conn.cursor(dictionary=True)
+                    if last_id is None:
+                        cursor.execute("""SELECT COALESCE(MAX(id), 0) AS id FROM consumption_data""")
+                        last_id = cursor.fetchone()['id']
+                    cursor.execute(
+                        """SELECT id, meter_id, consumption_kwh, timestamp
+                        FROM consumption_data
+                        WHERE id > %s
+                        ORDER BY id
+                        LIMIT 1000""",
+                        (last_id,))
+                    rows = cursor.fetchall()
+                if rows:
+                    last_id = rows[-1]['id']
+                    self._dispatch(rows)
+                    if len(rows) == 1000:
+                        continue
+            except Exception as e:
+                print(f"Error polling live feed: {str(e)}")
+            time.sleep(self.poll_interval)
+
+
+feed_broker = FeedBroker()
+
+
+def init_feed(app):
+    """Configure the live feed from the app config."""
+    feed_broker.configure(app,
+                          app.config['CONSUMPTION_FEED_QUEUE_SIZE'],
+                          app.config['CONSUMPTION_FEED_MAX_SUBSCRIBERS'],
+                          app.config['CONSUMPTION_FEED_POLL_INTERVAL'])
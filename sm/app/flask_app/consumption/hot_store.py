@@ -0,0 +1,693 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+from consumption.changes import advance_watermark
+from consumption.partitions import get_retention_cutoff
+from database import get_db_connection
+
+# consumption_kwh is DECIMAL(20, 2), kept as integer hundredths of a kWh
+KWH_STEP = Decimal('0.01')
+# MySQL returns averages of DECIMAL(20, 2) with 6 decimal places
+AVG_SCALE = Decimal('0.000001')
+
+# ID of a reading written by this process until the sync delivers it
+NO_ID = 0
+# modify_timestamp of a reading that was never modified, and of a reading
+# modified by this process that the sync has not delivered yet
+NO_MODIFIED = -1
+PENDING = -2
+
+# Bytes per reading (timestamp, value, ID and modification as int64) and per meter
+ROW_BYTES = 4 * 8
+METER_OVERHEAD = 256
+MIN_CAPACITY = 16
+
+SYNC_BATCH_SIZE = 1000
+WARM_BATCH_METERS = 200
+# Stop warming at this share of the budget, leaving room for new readings
+WARM_FILL = 0.9
+# Requests load at most this many missing meters, larger scopes use SQL
+LOAD_MAX_METERS = 100
+EXPIRE_INTERVAL = 60
+
+
+def _seconds(value: datetime) -> int:
+    """Seconds since the epoch of a naive UTC datetime."""
+    return int(np.datetime64(value, 's').astype(np.int64))
+
+
+def _datetimes(seconds: np.ndarray) -> list:
+    return seconds.astype('datetime64[s]').tolist()
+
+
+def _kwh(value) -> int:
+    return int(Decimal(value).quantize(KWH_STEP, ROUND_HALF_UP).scaleb(2))
+
+
+def _decimal(value) -> Decimal:
+    return Decimal(int(value)).scaleb(-2)
+
+
+class MeterSeries:
+    """Recent readings of one meter in ring buffers, ordered by timestamp.
+
+    New readings are appended at the end and expired ones dropped at the
+    start without moving the others. Late readings are inserted in order,
+    which copies the buffers.
+    """
+
+    __slots__ = ('timestamps', 'values', 'ids', 'modified', 'start', 'count')
+
+    def __init__(self, capacity: int = MIN_CAPACITY):
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.int64)
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.modified = np.zeros(capacity, dtype=np.int64)
+        self.start = 0
+        self.count = 0
+
+    @classmethod
+    def from_columns(cls, timestamps, values, ids, modified, capacity: int = 0):
+        """Create a series from columns sorted by timestamp."""
+        count = len(timestamps)
+        capacity = max(capacity, MIN_CAPACITY)
+        while capacity < count:
+            capacity *= 2
+        series = cls(capacity)
+        series.timestamps[:count] = timestamps
+        series.values[:count] = values
+        series.ids[:count] = ids
+        series.modified[:count] = modified
+        series.count = count
+        return series
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.timestamps) * ROW_BYTES + METER_OVERHEAD
+
+    def _positions(self, first: int = 0, last: int = None) -> np.ndarray:
+        last = self.count if last is None else last
+        return (self.start + np.arange(first, last)) % len(self.timestamps)
+
+    def columns(self, first: int = 0, last: int = None) -> tuple:
+        """Return (timestamps, values, ids, modified) of a range of readings in time order."""
+        positions = self._positions(first, last)
+        return (self.timestamps[positions], self.values[positions], self.ids[positions],
+                self.modified[positions])
+
+    def _ordered_timestamps(self) -> np.ndarray:
+        return self.timestamps[self._positions()]
+
+    def _replace(self, columns, capacity: int):
+        other = MeterSeries.from_columns(*columns, capacity=capacity)
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+    def window(self, start: int = None, end: int = None) -> tuple:
+        """Return the columns of the readings with start <= timestamp < end."""
+        timestamps = self._ordered_timestamps()
+        first = int(np.searchsorted(timestamps, start)) if start is not None else 0
+        last = int(np.searchsorted(timestamps, end)) if end is not None else self.count
+        return self.columns(first, max(first, last))
+
+    def upsert(self, timestamp: int, value: int, reading_id: int, modified: int):
+        """Add or replace the reading at a timestamp.
+
+        Readings written by this process have no ID yet (NO_ID). They keep
+        the ID and only mark the reading as modified if the value changed,
+        like the upsert in the database does.
+        """
+        capacity = len(self.timestamps)
+        last = (self.start + self.count - 1) % capacity
+        if self.count and timestamp <= self.timestamps[last]:
+            self._upsert_existing(timestamp, value, reading_id, modified)
+            return
+
+        if self.count == capacity:
+            self._replace(self.columns(), capacity * 2)
+            capacity *= 2
+        position = (self.start + self.count) % capacity
+        self.timestamps[position] = timestamp
+        self.values[position] = value
+        self.ids[position] = reading_id
+        self.modified[position] = modified
+        self.count += 1
+
+    def _upsert_existing(self, timestamp: int, value: int, reading_id: int, modified: int):
+        timestamps = self._ordered_timestamps()
+        index = int(np.searchsorted(timestamps, timestamp))
+        if index < self.count and timestamps[index] == timestamp:
+            position = (self.start + index) % len(self.timestamps)
+            if reading_id == NO_ID:
+                if self.values[position] != value:
+                    self.values[position] = value
+                    self.modified[position] = PENDING
+                return
+            self.values[position] = value
+            self.ids[position] = reading_id
+            self.modified[position] = modified
+            return
+
+        capacity = len(self.timestamps)
+        self._replace([np.insert(column, index, item) for column, item in
+                       zip(self.columns(), (timestamp, value, reading_id, modified))],
+                      capacity * 2 if self.count == capacity else capacity)
+
+    def expire(self, horizon: int):
+        """Drop the readings before horizon, shrinking the buffers if they got mostly empty."""
+        expired = int(np.searchsorted(self._ordered_timestamps(), horizon))
+        if not expired:
+            return
+        self.start = (self.start + expired) % len(self.timestamps)
+        self.count -= expired
+        capacity = len(self.timestamps)
+        if capacity > MIN_CAPACITY and self.count < capacity // 4:
+            self._replace(self.columns(), capacity // 2)
+
+    def delete(self, reading_ids):
+        keep = ~np.isin(self.columns()[2], reading_ids)
+        if not keep.all():
+            self._replace([column[keep] for column in self.columns()], len(self.timestamps))
+
+
+class HotStore:
+    """In-process store of the recent readings of each meter.
+
+    Keeps the last ``days`` of readings per meter so the dashboard reads
+    of recent data and their aggregates are answered without SQL. Each
+    worker process warms its store from the database when it starts and
+    then follows the changes of consumption_data (new, modified and
+    deleted rows) with a background thread, which readings written by
+    this process wake up immediately. Meters that were least recently
+    read are evicted once the store exceeds ``max_bytes``; they are
+    loaded again when they are read. Reads that the store cannot answer
+    return None and are served from the database.
+
+    New rows are applied as soon as they are visible. Rows of transactions
+    that commit behind a higher ID are picked up by scanning each range of
+    IDs again once it has settled (see changes.advance_watermark).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.days = 7
+        self.max_bytes = 64 * 1024 * 1024
+        self.sync_interval = 1.0
+        self.settle_seconds = 10
+        # Database meter ID -> MeterSeries, least recently read first
+        self._meters = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Held while reading from the database, so loads never miss a change
+        self._sync_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._position = None
+        self._ready = False
+        self._synced_at = 0.0
+        self._thread = None
+        self._thread_pid = None
+        self._app = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def configure(self, app, days: int, max_bytes: int, sync_interval: float,
+                  settle_seconds: int = 10):
+        self._app = app
+        self.enabled = bool(max_bytes) and days > 0
+        self.days = days
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.settle_seconds = settle_seconds
+        with self._lock:
+            self._meters.clear()
+            self._bytes = 0
+            self._ready = False
+
+    def start(self):
+        """Start warming and syncing the store of this process."""
+        if not self.enabled:
+            return
+        with self._lock:
+            # Threads do not survive a fork, so each worker process starts its own
+            if self._thread is not None and self._thread_pid == os.getpid():
+                return
+            self._meters.clear()
+            self._bytes = 0
+            self._ready = False
+            self._thread = threading.Thread(target=self._run, name='consumption-hot-store',
+                                            daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'meters': len(self._meters), 'bytes': self._bytes, 'ready': self._ready,
+                    'hits': self._hits, 'misses': self._misses,
+                    'evictions': self._evictions}
+
+    def _horizon(self) -> datetime:
+        return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=self.days)
+
+    def _run(self):
+        last_expire = time.monotonic()
+        while True:
+            try:
+                with self._app.app_context():
+                    if not self._ready:
+                        self.warm()
+                    self.sync()
+                if time.monotonic() - last_expire >= EXPIRE_INTERVAL:
+                    self._expire()
+                    last_expire = time.monotonic()
+            except Exception as e:
+                print(f"Error syncing the hot store: {str(e)}")
+            self._wake.wait(self.sync_interval)
+            self._wake.clear()
+
+    def load_meters(self, meter_ids: list, horizon: datetime) -> dict:
+        """Read the readings after horizon of the given meters into new series."""
+        placeholders = ", ".join(["%s"] * len(meter_ids))
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT meter_id, timestamp, consumption_kwh, id, modify_timestamp
+                FROM consumption_data
+                WHERE meter_id IN ({placeholders}) AND timestamp >= %s
+                ORDER BY meter_id, timestamp""",
+                (*meter_ids, horizon))
+            rows = cursor.fetchall()
+
+        series = {meter_id: MeterSeries() for meter_id in meter_ids}
+        if not rows:
+            return series
+        meters = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = (np.array([_seconds(row[1]) for row in rows], dtype=np.int64),
+                   np.array([_kwh(row[2]) for row in rows], dtype=np.int64),
+                   np.array([row[3] for row in rows], dtype=np.int64),
+                   np.array([_seconds(row[4]) if row[4] is not None else NO_MODIFIED
+                             for row in rows], dtype=np.int64))
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(meters)) + 1, [len(rows)]))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            series[int(meters[first])] = MeterSeries.from_columns(
+                *(column[first:last] for column in columns))
+        return series
+
+    def _insert(self, series: dict):
+        """Add loaded meters and evict the least recently read ones. Caller holds the lock."""
+        for meter_id, meter in series.items():
+            previous = self._meters.pop(meter_id, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._meters[meter_id] = meter
+            self._bytes += meter.nbytes
+        while self._bytes > self.max_bytes and self._meters:
+            _, meter = self._meters.popitem(last=False)
+            self._bytes -= meter.nbytes
+            self._evictions += 1
+
+    def warm(self):
+        """Load the recent readings of as many meters as the budget allows."""
+        with self._sync_lock:
+            horizon = self._horizon()
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM consumption_data""")
+                last_id = cursor.fetchone()[0]
+                cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM consumption_tombstones""")
+                tombstone_id = cursor.fetchone()[0]
+                cursor.execute("""SELECT CURRENT_TIMESTAMP - INTERVAL 1 SECOND""")
+                modified = cursor.fetchone()[0]
+                cursor.execute("""SELECT id FROM meters ORDER BY id""")
+                meter_ids = [row[0] for row in cursor.fetchall()]
+                retention = get_retention_cutoff(cursor)
+
+            # Changes from here on are picked up by the sync, applying one
+            # twice does no harm. Rows committing below last_id while the
+            # store warms are only seen once their meter is loaded again
+            self._position = {'last_id': last_id, 'modified': modified, 'modified_id': 0,
+                              'tombstone_id': tombstone_id,
+                              'retention_id': retention[0] if retention else 0,
+                              'settled_id': last_id, 'pending_id': None, 'pending_at': None,
+                              'rescan_id': last_id}
+            for first in range(0, len(meter_ids), WARM_BATCH_METERS):
+                if self._bytes >= self.max_bytes * WARM_FILL:
+                    break
+                series = self.load_meters(meter_ids[first:first + WARM_BATCH_METERS], horizon)
+                with self._lock:
+                    self._insert(series)
+            with self._lock:
+                self._ready = True
+
+    def sync(self):
+        """Apply the changes of consumption_data since the last sync."""
+        with self._sync_lock:
+            horizon = self._horizon()
+            more = True
+            while more:
+                with get_db_connection() as conn:
+                    more = self._apply_changes(conn.cursor(), horizon)
+
+            # Dropped partitions leave no tombstones
+            with get_db_connection() as conn:
+                retention = get_retention_cutoff(conn.cursor())
+            if retention is not None and retention[0] > self._position['retention_id']:
+                self._expire(_seconds(retention[1]))
+                with self._lock:
+                    self._position['retention_id'] = retention[0]
+            self._synced_at = time.monotonic()
+
+    def _apply_changes(self, cursor, horizon: datetime) -> bool:
+        """Apply one batch of changes. Returns whether there are more."""
+        position = self._position
+        cursor.execute(
+            """SELECT id, meter_id, consumption_kwh, timestamp, modify_timestamp
+            FROM consumption_data
+            WHERE id > %s AND timestamp >= %s
+            ORDER BY id
+            LIMIT %s""",
+            (position['last_id'], horizon, SYNC_BATCH_SIZE))
+        inserted = cursor.fetchall()
+
+        # Settled IDs again, for rows committed after the first pass
+        rescan_to = min(advance_watermark(cursor, position, self.settle_seconds),
+                        position['last_id'])
+        cursor.execute(
+            """SELECT id, meter_id, consumption_kwh, timestamp, modify_timestamp
+            FROM consumption_data
+            WHERE id > %s AND id <= %s AND timestamp >= %s
+            ORDER BY id
+            LIMIT %s""",
+            (position['rescan_id'], rescan_to, horizon, SYNC_BATCH_SIZE))
+        rescanned = cursor.fetchall()
+
+        # Rows the store has seen, once the modification has settled (see
+        # changes.py). Older rows only move the position, which validators
+        # compare with
+        cursor.execute(
+            """SELECT id, meter_id, consumption_kwh, timestamp, modify_timestamp
+            FROM consumption_data
+            WHERE modify_timestamp < CURRENT_TIMESTAMP - INTERVAL %s SECOND
+            AND (modify_timestamp > %s OR (modify_timestamp = %s AND id > %s))
+            AND id <= %s
+            ORDER BY modify_timestamp, id
+            LIMIT %s""",
+            (max(self.settle_seconds, 1), position['modified'], position['modified'],
+             position['modified_id'], position['last_id'], SYNC_BATCH_SIZE))
+        modified = cursor.fetchall()
+
+        cursor.execute(
+            """SELECT id, meter_id, consumption_id FROM consumption_tombstones
+            WHERE id > %s
+            ORDER BY id
+            LIMIT %s""",
+            (position['tombstone_id'], SYNC_BATCH_SIZE))
+        tombstones = cursor.fetchall()
+
+        deleted = {}
+        for _, meter_id, consumption_id in tombstones:
+            deleted.setdefault(meter_id, []).append(consumption_id)
+
+        with self._lock:
+            for reading_id, meter_id, consumption_kwh, timestamp, modify_timestamp in (
+                    rescanned + modified + inserted):
+                meter = self._meters.get(meter_id)
+                if meter is None or timestamp < horizon:
+                    continue
+                before = meter.nbytes
+                meter.upsert(_seconds(timestamp), _kwh(consumption_kwh), reading_id,
+                             _seconds(modify_timestamp) if modify_timestamp is not None
+                             else NO_MODIFIED)
+                self._bytes += meter.nbytes - before
+            for meter_id, reading_ids in deleted.items():
+                meter = self._meters.get(meter_id)
+                if meter is not None:
+                    before = meter.nbytes
+                    meter.delete(reading_ids)
+                    self._bytes += meter.nbytes - before
+            self._insert({})
+
+            # Moved with the readings, get_readings reads both under the lock
+            if inserted:
+                position['last_id'] = inserted[-1][0]
+            if len(rescanned) == SYNC_BATCH_SIZE:
+                position['rescan_id'] = rescanned[-1][0]
+            else:
+                position['rescan_id'] = max(position['rescan_id'], rescan_to)
+            if modified:
+                position['modified'] = modified[-1][4]
+                position['modified_id'] = modified[-1][0]
+            if tombstones:
+                position['tombstone_id'] = tombstones[-1][0]
+        return SYNC_BATCH_SIZE in (len(inserted), len(rescanned), len(modified),
+                                   len(tombstones))
+
+    def _expire(self, horizon: int = None):
+        """Drop the readings before horizon (seconds), by default before the store's days."""
+        if horizon is None:
+            horizon = _seconds(self._horizon())
+        with self._lock:
+            for meter in self._meters.values():
+                before = meter.nbytes
+                meter.expire(horizon)
+                self._bytes += meter.nbytes - before
+
+    def add_readings(self, rows):
+        """Apply readings this process has written and wake the sync, which
+        fills in their IDs.
+
+        Args:
+            rows: List of (meter_id, consumption_kwh, timestamp) tuples using database meter IDs
+        """
+        if not self.enabled:
+            return
+        horizon = _seconds(self._horizon())
+        with self._lock:
+            for meter_id, consumption_kwh, timestamp in rows:
+                meter = self._meters.get(meter_id)
+                seconds = _seconds(timestamp)
+                if meter is not None and seconds >= horizon:
+                    before = meter.nbytes
+                    meter.upsert(seconds, _kwh(consumption_kwh), NO_ID, NO_MODIFIED)
+                    self._bytes += meter.nbytes - before
+            self._insert({})
+        self._wake.set()
+
+    def wake(self):
+        """Sync now, e.g. after this process changed readings."""
+        if self.enabled:
+            self._wake.set()
+
+    def discard(self, meter_ids):
+        """Drop meters, they are loaded again on their next read."""
+        with self._lock:
+            for meter_id in meter_ids:
+                meter = self._meters.pop(meter_id, None)
+                if meter is not None:
+                    self._bytes -= meter.nbytes
+
+    def answers(self, start: datetime) -> bool:
+        """Return whether the store is ready to answer reads of ranges from start on."""
+        self.start()
+        return (self.enabled and self._ready and start is not None
+                and start >= self._horizon()
+                and time.monotonic() - self._synced_at <= max(5 * self.sync_interval, 5.0))
+
+    def _windows(self, meter_ids: list, start: datetime, end: datetime):
+        """Return the columns of the readings of the meters in a time range,
+        or None if the store cannot answer."""
+        if not self.answers(start):
+            return self._miss()
+
+        with self._lock:
+            missing = [meter_id for meter_id in meter_ids if meter_id not in self._meters]
+        if missing:
+            if len(missing) > LOAD_MAX_METERS:
+                return self._miss()
+            with self._sync_lock:
+                series = self.load_meters(missing, self._horizon())
+                with self._lock:
+                    self._insert(series)
+
+        start_seconds = _seconds(start)
+        end_seconds = _seconds(end) if end is not None else None
+        windows = {}
+        with self._lock:
+            for meter_id in meter_ids:
+                meter = self._meters.get(meter_id)
+                if meter is None:
+                    # Evicted, the scope does not fit into the budget
+                    return self._miss()
+                self._meters.move_to_end(meter_id)
+                windows[meter_id] = meter.window(start_seconds, end_seconds)
+        return windows
+
+    def _hit(self):
+        with self._lock:
+            self._hits += 1
+
+    def _miss(self):
+        with self._lock:
+            self._misses += 1
+
+    def _current(self, meter_ids: list, windows: dict, validator: tuple,
+                 end: datetime = None) -> bool:
+        """Return whether the windows (up to end) are as current as the
+        validator from get_consumption_validator for the same meters and range.
+
+        A store that has not synced as far as the validator is behind. One
+        that has, but lacks the newest reading, lost a change: its meters are
+        discarded and loaded again on the next read.
+        """
+        max_id, modified, tombstone_id, retention_id = validator
+        end_seconds = _seconds(end) if end is not None else None
+        ids = [columns[2] if end_seconds is None else columns[2][columns[0] < end_seconds]
+               for columns in windows.values()]
+        ids = [int(column.max()) for column in ids if len(column)]
+        newest = max(ids) if ids else None
+        with self._lock:
+            position = dict(self._position)
+        if (position['last_id'] < (max_id or 0)
+                or (modified is not None and (position['modified'] is None
+                                              or position['modified'] < modified))
+                or position['tombstone_id'] < tombstone_id
+                or position['retention_id'] < retention_id):
+            return False
+        if newest == max_id:
+            return True
+        if max_id is not None and (newest is None or newest < max_id):
+            self.discard(meter_ids)
+        # Otherwise newer than the validator, which came from a lagging replica
+        return False
+
+    def get_readings(self, meter_ids: list, start: datetime, end: datetime = None,
+                     validator: tuple = None):
+        """Return the readings of the meters in a time range, ordered by ID.
+
+        Args:
+            meter_ids: Database IDs of the meters
+            start: Include readings from this time on, must lie within the kept days
+            end: Include readings before this time
+            validator: get_consumption_validator of the meters and range the
+                readings have to be as current as
+
+        Returns:
+            list: Rows as dicts like consumption_data, or None if the store
+            cannot answer
+        """
+        windows = self._windows(meter_ids, start, end)
+        if windows is None:
+            return None
+        if validator is not None and not self._current(meter_ids, windows, validator):
+            return self._miss()
+
+        meters = np.concatenate([np.full(len(columns[0]), meter_id, dtype=np.int64)
+                                 for meter_id, columns in windows.items()] or [[]])
+        timestamps, values, ids, modified = (
+            np.concatenate([columns[index] for columns in windows.values()] or [[]])
+            .astype(np.int64) for index in range(4))
+        if np.any(ids == NO_ID) or np.any(modified == PENDING):
+            # Written by this process but not synced yet
+            return self._miss()
+        self._hit()
+        if not ids.size:
+            return []
+
+        order = np.argsort(ids, kind='stable')
+        meters, timestamps, values, ids, modified = (
+            column[order] for column in (meters, timestamps, values, ids, modified))
+        times = _datetimes(timestamps)
+        modified_times = [time_ if seconds >= 0 else None for time_, seconds in
+                          zip(_datetimes(np.maximum(modified, 0)), modified)]
+        rows = [{'id': reading_id, 'meter_id': meter_id, 'consumption_kwh': _decimal(value),
+                 'timestamp': timestamp, 'modify_timestamp': modify_timestamp}
+                for reading_id, meter_id, value, timestamp, modify_timestamp in zip(
+                    ids.tolist(), meters.tolist(), values.tolist(), times, modified_times)]
+
+        return rows
+
+    def get_aggregate(self, bucket: str, meter_ids: list, start: datetime,
+                      end: datetime = None, use_rollups: bool = False,
+                      validator: tuple = None):
+        """Aggregate the readings of the meters per bucket like
+        get_consumption_aggregate_in_db, or return None if the store cannot answer.
+
+        With use_rollups the range applies to the start of the hour (hour
+        buckets) or day the reading falls in, as it does for the rollup tables.
+        The validator is checked like in get_readings, over the readings
+        from start to end.
+        """
+        # Readings before start never fall into an hour or day starting at or after it
+        windows = self._windows(meter_ids, start, None)
+        if windows is None:
+            return None
+        if validator is not None and not self._current(meter_ids, windows, validator, end):
+            return self._miss()
+        self._hit()
+
+        timestamps = np.concatenate([columns[0] for columns in windows.values()] or [[]]) \
+            .astype(np.int64)
+        values = np.concatenate([columns[1] for columns in windows.values()] or [[]]) \
+            .astype(np.int64)
+
+        if use_rollups:
+            unit = 3600 if bucket == 'hour' else 86400
+            filtered = timestamps // unit * unit
+        else:
+            filtered = timestamps
+        mask = filtered >= _seconds(start)
+        if end is not None:
+            mask &= filtered < _seconds(end)
+        timestamps = timestamps[mask]
+        values = values[mask]
+
+        if bucket == 'hour':
+            keys = timestamps // 3600 * 3600
+        elif bucket == 'day':
+            keys = timestamps // 86400 * 86400
+        elif bucket == 'week':
+            # 1970-01-01 was a Thursday, weeks start on Monday
+            days = timestamps // 86400
+            keys = (days - (days + 3) % 7) * 86400
+        else:
+            keys = (timestamps.astype('datetime64[s]').astype('datetime64[M]')
+                    .astype('datetime64[s]').astype(np.int64))
+
+        buckets, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(buckets))
+        sums = np.zeros(len(buckets), dtype=np.int64)
+        np.add.at(sums, inverse, values)
+        minimums = np.full(len(buckets), np.iinfo(np.int64).max)
+        np.minimum.at(minimums, inverse, values)
+        maximums = np.full(len(buckets), np.iinfo(np.int64).min)
+        np.maximum.at(maximums, inverse, values)
+
+        data = []
+        for key, total, minimum, maximum, count in zip(
+                _datetimes(buckets), sums.tolist(), minimums.tolist(), maximums.tolist(),
+                counts.tolist()):
+            data.append({
+                'bucket': key.strftime('%Y-%m-%d %H:%M:%S'),
+                'sum_kwh': _decimal(total),
+                'min_kwh': _decimal(minimum),
+                'max_kwh': _decimal(maximum),
+                'avg_kwh': (_decimal(total) / count).quantize(AVG_SCALE, ROUND_HALF_UP),
+                # SUM(count) over the rollups is a DECIMAL in MySQL
+                'count': Decimal(count) if use_rollups else count,
+            })
+        return data
+
+
+hot_store = HotStore()
+
+
+def init_hot_store(app):
+    """Configure the hot store from the app config."""
+    hot_store.configure(app, app.config['HOT_STORE_DAYS'], app.config['HOT_STORE_MAX_BYTES'],
+                        app.config['HOT_STORE_SYNC_INTERVAL'],
+                        app.config['CONSUMPTION_SETTLE_SECONDS'])
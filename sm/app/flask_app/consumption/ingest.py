@@ -0,0 +1,336 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+from consumption.utils import add_consumption_batch_in_db
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+# Seconds between scans for segments left behind by crashed workers
+ORPHAN_SCAN_INTERVAL = 30
+
+
+class IngestBusyError(Exception):
+    """Raised when too many readings are waiting to be written."""
+
+
+def _encode_record(row) -> str:
+    meter_id, consumption_kwh, timestamp = row
+    payload = json.dumps([meter_id, str(consumption_kwh), timestamp.isoformat()])
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+
+def _decode_record(line: str):
+    """Return the row of a WAL line, None for a torn or corrupt line."""
+    checksum, _, payload = line.rstrip('\n').partition(' ')
+    try:
+        if int(checksum, 16) != zlib.crc32(payload.encode('utf-8')):
+            return None
+        meter_id, consumption_kwh, timestamp = json.loads(payload)
+        return meter_id, Decimal(consumption_kwh), datetime.fromisoformat(timestamp)
+    except ValueError:
+        return None
+
+
+class Segment:
+    """One WAL file, locked by the process that owns it."""
+
+    def __init__(self, path: str, handle, records=None):
+        self.path = path
+        self.handle = handle
+        self.records = records if records is not None else []
+        self.attempts = 0
+
+    @classmethod
+    def create(cls, wal_dir: str, sequence: int):
+        name = f"{int(time.time() * 1000):013d}-{os.getpid()}-{sequence}"
+        path = os.path.join(wal_dir, name + '.wal')
+        # Lock before the file gets its .wal name, otherwise another worker
+        # could adopt it as an orphan
+        handle = open(os.path.join(wal_dir, name + '.tmp'), 'a', encoding='utf-8')
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        os.rename(handle.name, path)
+        return cls(path, handle)
+
+    @classmethod
+    def adopt(cls, path: str):
+        """Lock and read a segment nobody owns. Returns None if it is owned."""
+        try:
+            handle = open(path, 'a+', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            handle.close()
+            return None
+
+        # The file may have been flushed and removed before we got the lock
+        if not os.path.exists(path):
+            handle.close()
+            return None
+
+        handle.seek(0)
+        records = []
+        for line in handle:
+            row = _decode_record(line)
+            if row is None:
+                # A crash during an append leaves a torn last line
+                break
+            records.append(row)
+        return cls(path, handle, records)
+
+    def append(self, data: str, fsync: bool):
+        self.handle.write(data)
+        self.handle.flush()
+        if fsync:
+            os.fsync(self.handle.fileno())
+
+    def sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def remove(self):
+        os.remove(self.path)
+        self.handle.close()
+
+    def quarantine(self):
+        os.rename(self.path, self.path[:-len('.wal')] + '.failed')
+        self.handle.close()
+
+
+class IngestQueue:
+    """Write-behind queue for consumption readings.
+
+    Readings are appended to a write-ahead log and acknowledged before they
+    reach MySQL. A background thread per worker process seals the current
+    WAL segment every ``flush_interval`` seconds (or once ``batch_size``
+    readings are waiting), inserts its readings in one transaction and
+    deletes the segment. Failed inserts are retried every
+    ``retry_interval`` seconds; after ``max_retries`` failures the segment
+    is renamed to ``*.failed`` so it does not block the queue. Segments of
+    crashed workers are picked up by the other workers and on restart.
+
+    ``fsync`` decides when appends are forced to disk: ``always`` before
+    acknowledging, ``interval`` when a segment is sealed, ``never`` leaves
+    it to the OS. All policies survive a crash of the process itself.
+    """
+
+    def __init__(self):
+        self._app = None
+        self.wal_dir = None
+        self.fsync = 'always'
+        self.batch_size = 1000
+        self.flush_interval = 1.0
+        self.max_pending = 100000
+        self.retry_interval = 5.0
+        self.max_retries = 10
+        self.chunk_size = 1000
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._active = None
+        self._sealed = deque()
+        self._pending = 0
+        self._sequence = 0
+        self._writer = None
+        self._writer_pid = None
+        self._last_orphan_scan = 0.0
+
+    def configure(self, app, wal_dir: str, fsync: str = 'always', batch_size: int = 1000,
+                  flush_interval: float = 1.0, max_pending: int = 100000,
+                  retry_interval: float = 5.0, max_retries: int = 10,
+                  chunk_size: int = 1000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {', '.join(FSYNC_POLICIES)}")
+        self._app = app
+        self.wal_dir = wal_dir
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.chunk_size = chunk_size
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.wal_dir)
+
+    def start(self):
+        """Start the writer of this process and replay orphaned segments."""
+        if not self.enabled:
+            return
+        with self._condition:
+            # Threads do not survive a fork, so each worker process starts its own
+            if self._writer is not None and self._writer_pid == os.getpid():
+                return
+            os.makedirs(self.wal_dir, exist_ok=True)
+            self._active = None
+            self._sealed.clear()
+            self._pending = 0
+            self._adopt_orphans()
+            self._writer = threading.Thread(target=self._run, name='consumption-ingest',
+                                            daemon=True)
+            self._writer_pid = os.getpid()
+            self._writer.start()
+        atexit.register(self.close)
+
+    def append(self, rows: list) -> int:
+        """Log readings for a later insert.
+
+        Args:
+            rows: List of (meter_id, consumption_kwh, timestamp) tuples using database meter IDs
+
+        Returns:
+            int: Number of accepted readings
+
+        Raises:
+            IngestBusyError: If accepting the readings would exceed max_pending
+        """
+        self.start()
+        data = ''.join(_encode_record(row) for row in rows)
+        with self._condition:
+            if self._pending + len(rows) > self.max_pending:
+                raise IngestBusyError("Too many readings waiting to be written")
+            if self._active is None:
+                self._active = self._new_segment()
+            self._active.append(data, self.fsync == 'always')
+            self._active.records.extend(rows)
+            self._pending += len(rows)
+            if len(self._active.records) >= self.batch_size:
+                self._condition.notify()
+        return len(rows)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'pending': self._pending, 'segments': len(self._sealed)
+                    + (1 if self._active is not None else 0)}
+
+    def _new_segment(self) -> Segment:
+        self._sequence += 1
+        return Segment.create(self.wal_dir, self._sequence)
+
+    def _seal(self):
+        """Move the active segment to the write queue. Caller holds the lock."""
+        if self._active is None:
+            return
+        if self.fsync == 'interval':
+            self._active.sync()
+        self._sealed.append(self._active)
+        self._active = None
+
+    def _adopt_orphans(self):
+        """Queue the segments of crashed workers. Caller holds the lock."""
+        self._last_orphan_scan = time.monotonic()
+        owned = {segment.path for segment in self._sealed}
+        if self._active is not None:
+            owned.add(self._active.path)
+
+        for name in sorted(os.listdir(self.wal_dir)):
+            path = os.path.join(self.wal_dir, name)
+            if not name.endswith('.wal') or path in owned:
+                continue
+            segment = Segment.adopt(path)
+            if segment is None:
+                continue
+            if not segment.records:
+                segment.remove()
+                continue
+            self._sealed.append(segment)
+            self._pending += len(segment.records)
+
+    def flush(self) -> int:
+        """Seal the active segment and insert all sealed segments.
+
+        Returns:
+            int: Number of inserted readings
+
+        Raises:
+            Exception: The database error of the first segment that failed
+        """
+        with self._flush_lock:
+            with self._condition:
+                self._seal()
+                segments = list(self._sealed)
+
+            inserted = 0
+            for segment in segments:
+                try:
+                    with self._app.app_context():
+                        add_consumption_batch_in_db(segment.records, self.chunk_size)
+                except Exception as e:
+                    segment.attempts += 1
+                    if segment.attempts < self.max_retries:
+                        raise
+                    print(f"Giving up on {segment.path}: {str(e)}")
+                    self._done(segment)
+                    segment.quarantine()
+                    continue
+
+                self._done(segment)
+                segment.remove()
+                inserted += len(segment.records)
+            return inserted
+
+    def _done(self, segment: Segment):
+        with self._condition:
+            self._sealed.remove(segment)
+            self._pending -= len(segment.records)
+
+    def replay(self) -> int:
+        """Insert the segments of all workers that are not running anymore.
+
+        Returns:
+            int: Number of inserted readings
+        """
+        with self._condition:
+            os.makedirs(self.wal_dir, exist_ok=True)
+            self._adopt_orphans()
+        return self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._sealed and (self._active is None
+                                         or len(self._active.records) < self.batch_size):
+                    self._condition.wait(self.flush_interval)
+                if time.monotonic() - self._last_orphan_scan >= ORPHAN_SCAN_INTERVAL:
+                    self._adopt_orphans()
+
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing ingested readings: {str(e)}")
+                time.sleep(self.retry_interval)
+
+    def close(self):
+        """Try to write everything on shutdown. Segments left over are replayed later."""
+        if self._writer_pid != os.getpid():
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error writing ingested readings on shutdown: {str(e)}")
+
+
+ingest_queue = IngestQueue()
+
+
+def init_ingest(app):
+    """Configure the asynchronous ingest queue from the app config."""
+    config = app.config
+    ingest_queue.configure(app, config['CONSUMPTION_INGEST_WAL_DIR'],
+                           fsync=config['CONSUMPTION_INGEST_FSYNC'],
+                           batch_size=config['CONSUMPTION_INGEST_BATCH_SIZE'],
+                           flush_interval=config['CONSUMPTION_INGEST_FLUSH_INTERVAL'],
+                           max_pending=config['CONSUMPTION_INGEST_MAX_PENDING'],
+                           retry_interval=config['CONSUMPTION_INGEST_RETRY_INTERVAL'],
+                           max_retries=config['CONSUMPTION_INGEST_MAX_RETRIES'],
+                           chunk_size=config['CONSUMPTION_BATCH_CHUNK_SIZE'])
@@ -0,0 +1,171 @@
+import os
+from datetime import datetime
+
+from database import get_db_connection
+
+ARCHIVE_COLUMNS = ['id', 'meter_id', 'timestamp', 'modify_timestamp', 'consumption_kwh']
+
+
+def _month_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _add_months(timestamp: datetime, months: int) -> datetime:
+    month_index = timestamp.month - 1 + months
+    return timestamp.replace(year=timestamp.year + month_index // 12, month=month_index % 12 + 1)
+
+
+def _partition_name(month: datetime) -> str:
+    return f"p{month.year}{month.month:02d}"
+
+
+def get_partitions() -> list:
+    """Return the partitions of consumption_data ordered by their bound.
+
+    Returns:
+        list: Dicts with name, upper bound (datetime or None for MAXVALUE) and row estimate
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            """SELECT
+                PARTITION_NAME AS name,
+                PARTITION_DESCRIPTION AS description,
+                TABLE_ROWS AS table_rows
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE()
+            AND TABLE_NAME = 'consumption_data'
+            AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION""")
+        partitions = cursor.fetchall()
+
+    for partition in partitions:
+        description = partition.pop('description')
+        partition['upper_bound'] = (None if description == 'MAXVALUE'
+                                    else datetime.utcfromtimestamp(int(description)))
+    return partitions
+
+
+def create_future_partitions(months_ahead: int) -> list:
+    """Split the MAXVALUE partition so that the coming months have their own partition.
+
+    Returns:
+        list: Names of the created partitions
+    """
+    partitions = get_partitions()
+    bounds = [partition['upper_bound'] for partition in partitions if partition['upper_bound']]
+    if not bounds:
+        return []
+
+    target = _add_months(_month_start(datetime.utcnow()), months_ahead + 1)
+    new_partitions = []
+    month = max(bounds)
+    while month < target:
+        new_partitions.append((_partition_name(month), _add_months(month, 1)))
+        month = _add_months(month, 1)
+
+    if not new_partitions:
+        return []
+
+    definitions = ", ".join(
+        f"PARTITION {name} VALUES LESS THAN (UNIX_TIMESTAMP('{bound:%Y-%m-%d %H:%M:%S}'))"
+        for name, bound in new_partitions)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""ALTER TABLE consumption_data REORGANIZE PARTITION pmax INTO (
+                {definitions},
+                PARTITION pmax VALUES LESS THAN MAXVALUE)""")
+
+    return [name for name, _ in new_partitions]
+
+
+def archive_partition(name: str, archive_dir: str, fetch_size: int = 10000) -> str:
+    """Export a partition to a zstd compressed Parquet file.
+
+    Requires pyarrow, which is only needed on hosts that archive data.
+
+    Returns:
+        str: Path of the written file
+    """
+    import pyarrow as pa  # pylint: disable=import-outside-toplevel
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('meter_id', pa.int64()),
+        ('timestamp', pa.timestamp('s')),
+        ('modify_timestamp', pa.timestamp('s')),
+        ('consumption_kwh', pa.decimal128(20, 2)),
+    ])
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"consumption_data_{name}.parquet")
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor(buffered=False)
+        cursor.execute(
+            f"""SELECT {', '.join(ARCHIVE_COLUMNS)}
+            FROM consumption_data PARTITION ({name})
+            ORDER BY id""")
+        with pq.ParquetWriter(path + '.tmp', schema, compression='zstd') as writer:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                writer.write_batch(pa.record_batch(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                    schema=schema))
+
+    # Only publish complete files
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def apply_retention(retention_months: int, archive_dir: str = None) -> list:
+    """Drop partitions that only contain data older than the retention period.
+
+    The rollup tables are not touched, so aggregates over the dropped months
+    stay available. Dropping a partition fires no delete trigger, so the
+    bound of each partition is recorded in consumption_retention before it
+    is dropped; delta sync clients and hot stores learn from it that the
+    readings before the bound are gone.
+
+    Args:
+        retention_months: Number of full months to keep besides the current one
+        archive_dir: Export each partition to Parquet here before dropping it
+
+    Returns:
+        list: Names of the dropped partitions
+    """
+    cutoff = _add_months(_month_start(datetime.utcnow()), -retention_months)
+    expired = [(partition['name'], partition['upper_bound']) for partition in get_partitions()
+               if partition['upper_bound'] and partition['upper_bound'] <= cutoff]
+
+    for name, upper_bound in expired:
+        if archive_dir:
+            archive_partition(name, archive_dir)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO consumption_retention (cutoff) VALUES (%s)""",
+                (upper_bound,))
+            conn.commit()
+            cursor.execute(f"ALTER TABLE consumption_data DROP PARTITION {name}")
+
+    return [name for name, _ in expired]
+
+
+def get_retention_cutoff(cursor):
+    """Return the latest retention watermark. Cutoffs only grow, so it
+    covers all earlier ones.
+
+    Args:
+        cursor: A cursor returning tuples
+
+    Returns:
+        tuple: (id, cutoff as datetime), or None if no partition was dropped
+    """
+    cursor.execute(
+        """SELECT id, cutoff FROM consumption_retention ORDER BY id DESC LIMIT 1""")
+    return cursor.fetchone()
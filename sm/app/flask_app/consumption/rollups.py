@@ -0,0 +1,236 @@
+from datetime import datetime, timedelta
+
+from database import get_db_connection
+
+ROLLUP_TABLES = {
+    'hour': 'consumption_rollup_hourly',
+    'day': 'consumption_rollup_daily',
+}
+
+
+def _hour_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def _day_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# Bucket ranges per statement when refreshing the rollups
+REFRESH_CHUNK_SIZE = 500
+
+
+def _bucket_ranges(readings, bucket_start, step: timedelta) -> list:
+    """Return the buckets the readings fall in as [meter_id, start, end] ranges.
+
+    Only touched buckets are included, adjacent ones are merged into one range.
+    """
+    buckets = sorted({(meter_id, bucket_start(timestamp)) for meter_id, timestamp in readings})
+    ranges = []
+    for meter_id, start in buckets:
+        if ranges and ranges[-1][0] == meter_id and ranges[-1][2] == start:
+            ranges[-1][2] = start + step
+        else:
+            ranges.append([meter_id, start, start + step])
+    return ranges
+
+
+def _ranges_condition(ranges: list, column: str) -> tuple:
+    """Build the SQL condition matching rows of any of the bucket ranges."""
+    condition = " OR ".join(
+        [f"(meter_id = %s AND {column} >= %s AND {column} < %s)"] * len(ranges))
+    return f"({condition})", tuple(value for bucket_range in ranges for value in bucket_range)
+
+
+def _refresh_hourly(cursor, ranges: list):
+    """Recompute the hourly rollup of the given (meter_id, start, end) ranges."""
+    for first in range(0, len(ranges), REFRESH_CHUNK_SIZE):
+        chunk = ranges[first:first + REFRESH_CHUNK_SIZE]
+        bucket_condition, params = _ranges_condition(chunk, 'bucket_start')
+        cursor.execute(
+            f"""DELETE FROM consumption_rollup_hourly WHERE {bucket_condition}""",
+            params)
+        reading_condition, params = _ranges_condition(chunk, 'timestamp')
+        cursor.execute(
+            f"""INSERT INTO consumption_rollup_hourly (
+                meter_id, bucket_start, sum_kwh, min_kwh, max_kwh, count)
+            SELECT
+                meter_id,
+                DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00'),
+                SUM(consumption_kwh),
+                MIN(consumption_kwh),
+                MAX(consumption_kwh),
+                COUNT(*)
+            FROM consumption_data
+            WHERE {reading_condition}
+            GROUP BY meter_id, DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00')""",
+            params)
+
+
+def _refresh_daily(cursor, ranges: list):
+    """Recompute the daily rollup of the given (meter_id, start, end) ranges from
+    the hourly rollup."""
+    for first in range(0, len(ranges), REFRESH_CHUNK_SIZE):
+        bucket_condition, params = _ranges_condition(
+            ranges[first:first + REFRESH_CHUNK_SIZE], 'bucket_start')
+        cursor.execute(
+            f"""DELETE FROM consumption_rollup_daily WHERE {bucket_condition}""",
+            params)
+        cursor.execute(
+            f"""INSERT INTO consumption_rollup_daily (
+                meter_id, bucket_start, sum_kwh, min_kwh, max_kwh, count)
+            SELECT
+                meter_id,
+                DATE(bucket_start),
+                SUM(sum_kwh),
+                MIN(min_kwh),
+                MAX(max_kwh),
+                SUM(count)
+            FROM consumption_rollup_hourly
+            WHERE {bucket_condition}
+            GROUP BY meter_id, DATE(bucket_start)""",
+            params)
+
+
+def refresh_rollups(conn, readings):
+    """Bring the rollups up to date for the given readings.
+
+    Only the hours and days the readings fall in are recomputed, so the
+    cost depends on the size of the write, not on the history of a meter
+    or the time between its readings. Must be called inside the
+    transaction that wrote the readings.
+
+    Args:
+        conn: The writing connection
+        readings: Iterable of (meter_id, timestamp) tuples using database meter IDs
+    """
+    readings = [(meter_id, timestamp) for meter_id, timestamp in readings
+                if timestamp is not None]
+    if not readings:
+        return
+
+    cursor = conn.cursor()
+    _refresh_hourly(cursor, _bucket_ranges(readings, _hour_start, timedelta(hours=1)))
+    _refresh_daily(cursor, _bucket_ranges(readings, _day_start, timedelta(days=1)))
+
+
+def refresh_rollups_for_ids(conn, ids):
+    """Bring the rollups up to date for the given consumption_data IDs."""
+    ids = list(ids)
+    if not ids:
+        return
+
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(ids))
+    cursor.execute(
+        f"""SELECT meter_id, timestamp FROM consumption_data
+        WHERE id IN ({placeholders})""",
+        tuple(ids))
+    refresh_rollups(conn, cursor.fetchall())
+
+
+def rebuild_rollups(meter_id: int = None) -> int:
+    """Rebuild the rollups from the raw data.
+
+    Args:
+        meter_id: Only rebuild this meter (database ID), all meters if None
+
+    Returns:
+        int: Number of rebuilt meters
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if meter_id is None:
+            cursor.execute("""SELECT id FROM meters""")
+        else:
+            cursor.execute("""SELECT id FROM meters WHERE id = %s""", (meter_id,))
+        meter_ids = [row[0] for row in cursor.fetchall()]
+
+        # One transaction per meter keeps the lock footprint small
+        for current_meter_id in meter_ids:
+            cursor.execute(
+                """SELECT MIN(timestamp), MAX(timestamp)
+                FROM consumption_data WHERE meter_id = %s""",
+                (current_meter_id,))
+            first, last = cursor.fetchone()
+
+            cursor.execute(
+                """DELETE FROM consumption_rollup_hourly WHERE meter_id = %s""",
+                (current_meter_id,))
+            cursor.execute(
+                """DELETE FROM consumption_rollup_daily WHERE meter_id = %s""",
+                (current_meter_id,))
+            if first is not None:
+                _refresh_hourly(cursor, [(current_meter_id, _hour_start(first),
+                                          _hour_start(last) + timedelta(hours=1))])
+                _refresh_daily(cursor, [(current_meter_id, _day_start(first),
+                                         _day_start(last) + timedelta(days=1))])
+            conn.commit()
+
+    return len(meter_ids)
+
+
+# SQL expressions mapping a reading's timestamp (or a timestamp column) to its bucket
+CHECK_BUCKETS = {
+    'hour': ("CAST(DATE_FORMAT({column}, '%Y-%m-%d %H:00:00') AS DATETIME)", "HOUR"),
+    'day': ("CAST(DATE({column}) AS DATETIME)", "DAY"),
+}
+
+
+def _check_rollup(cursor, granularity: str, meter_id: int = None) -> list:
+    """Compare one rollup table with the raw data, see check_rollups."""
+    meter_filter = "AND meter_id = %s" if meter_id is not None else ""
+    params = (meter_id, meter_id) if meter_id is not None else ()
+    bucket, interval = CHECK_BUCKETS[granularity]
+    table = ROLLUP_TABLES[granularity]
+
+    cursor.execute(
+        f"""SELECT
+            '{granularity}' AS granularity,
+            COALESCE(r.meter_id, d.meter_id) AS meter_id,
+            COALESCE(r.bucket_start, d.bucket_start) AS bucket_start,
+            r.sum_kwh AS raw_sum_kwh,
+            d.sum_kwh AS rollup_sum_kwh,
+            r.count AS raw_count,
+            d.count AS rollup_count
+        FROM (
+            SELECT meter_id,
+                {bucket.format(column='timestamp')} AS bucket_start,
+                SUM(consumption_kwh) AS sum_kwh,
+                COUNT(*) AS count
+            FROM consumption_data
+            WHERE timestamp IS NOT NULL {meter_filter}
+            GROUP BY meter_id, bucket_start
+        ) r
+        LEFT JOIN {table} d
+            ON d.meter_id = r.meter_id AND d.bucket_start = r.bucket_start
+        WHERE d.meter_id IS NULL OR d.sum_kwh <> r.sum_kwh OR d.count <> r.count
+        UNION ALL
+        SELECT '{granularity}', d.meter_id, d.bucket_start, NULL, d.sum_kwh, NULL, d.count
+        FROM {table} d
+        WHERE d.bucket_start >= (
+            SELECT {bucket.format(column='MIN(timestamp)')} FROM consumption_data)
+        AND NOT EXISTS (
+            SELECT 1 FROM consumption_data c
+            WHERE c.meter_id = d.meter_id
+            AND c.timestamp >= d.bucket_start
+            AND c.timestamp < d.bucket_start + INTERVAL 1 {interval})
+        {meter_filter.replace('meter_id', 'd.meter_id')}""",
+        params)
+    return cursor.fetchall()
+
+
+def check_rollups(meter_id: int = None) -> list:
+    """Compare the hourly and daily rollups with the raw data.
+
+    Buckets before the oldest raw reading are skipped, because their raw
+    data may have been removed by the retention policy.
+
+    Returns:
+        list: Mismatching (granularity, meter_id, bucket_start) entries with raw and
+        rollup values
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        return [mismatch for granularity in ('hour', 'day')
+                for mismatch in _check_rollup(cursor, granularity, meter_id)]
@@ -1,14 +1,31 @@
-from auth.utils import (error_response, require_special_auth, require_auth,
-                        validate_request_data, user_is_authorized)
-from flask import Blueprint, jsonify, request
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from datetime import datetime, timezone
+
+from auth.utils import (busy_response, error_response, require_special_auth,
+                        require_auth, validate_request_data, user_is_authorized)
+from flask import (Blueprint, Response, current_app, jsonify, request,
+                   stream_with_context)
+from http_cache import conditional_response, make_etag
+from json_provider import columnar
+from meters.utils import get_meters
+from rate_limit import limiter
+from werkzeug.exceptions import BadRequest
+from consumption.anomalies import ANOMALY_KINDS, get_anomalies_in_db
+from consumption.changes import (CursorError, CursorExpiredError, decode_cursor,
+                                 encode_cursor, get_changes_in_db)
+from consumption.feed import FeedFullError, feed_broker
+from consumption.ingest import IngestBusyError, ingest_queue
 from consumption.utils import (get_user_id, get_consumption_data,
                                get_consumption_data_for_user_in_db,
                                add_consumption_data_in_db,
-                               update_consumption_data_in_db)
+                               update_consumption_data_in_db,
+                               parse_batch_payload, validate_reading,
+                               get_meter_ids_in_db,
+                               add_consumption_batch_in_db,
+                               stream_consumption_data, format_export_rows,
+                               parse_time_range, AGGREGATE_BUCKETS,
+                               get_consumption_aggregate_in_db,
+                               get_consumption_validator, format_feed_events)
 
-limiter = Limiter(get_remote_address)
 consumption_bp = Blueprint('consumption', __name__)
 
 
@@ -16,17 +33,53 @@ consumption_bp = Blueprint('consumption', __name__)
 @limiter.limit("240 per minute")
 @require_auth
 def get_data():
-    """Retrieve consumption data in the system"""
+    """Retrieve consumption data in the system
+
+    With ?format=columnar the rows are returned as
+    {"columns": [...], "rows": [[...]]} instead of a list of objects.
+    """
     try:
-        # Get all data if user is admin
+        try:
+            start, end = parse_time_range(request.args)
+        except ValueError:
+            return error_response("start and end must be ISO 8601 dates", 400)
+
+        response_format = request.args.get('format', 'records')
+        if response_format not in ('records', 'columnar'):
+            return error_response("format must be 'records' or 'columnar'", 400)
+        shape = columnar if response_format == 'columnar' else (lambda rows: rows)
+
+        # Get all data if user is admin. Paginated by id (keyset pagination)
         if user_is_authorized(request.headers.get('Authorization'), [99]):
-            return jsonify(get_consumption_data(limit=10000)), 200
+            after_id = request.args.get('after_id', 0, type=int)
+            page_size = request.args.get(
+                'page_size', current_app.config['CONSUMPTION_PAGE_SIZE'], type=int)
+            page_size = max(1, min(page_size, current_app.config['CONSUMPTION_MAX_PAGE_SIZE']))
+
+            def build_page():
+                data = get_consumption_data(limit=page_size, after_id=after_id,
+                                            start=start, end=end)
+                response = jsonify(shape(data))
+                if len(data) == page_size:
+                    response.headers['X-Next-After-Id'] = str(data[-1]['id'])
+                return response
+
+            validator = get_consumption_validator(start=start, end=end)
+            etag = make_etag('all', *validator, after_id, page_size, start, end,
+                             response_format)
+            return conditional_response(etag, None, build_page)
 
         # Else get data for user only
         user_id = get_user_id(request.headers.get('Authorization'))
         if user_id:
-            data = get_consumption_data_for_user_in_db(user_id)
-            return jsonify(data), 200
+            meter_ids = [meter['id'] for meter in get_meters(user_id=user_id)]
+            # No Last-Modified, reading timestamps come from the clients
+            validator = get_consumption_validator(meter_ids, start=start, end=end)
+            etag = make_etag(user_id, meter_ids, *validator, start, end, response_format)
+            return conditional_response(
+                etag, None,
+                lambda: jsonify(shape(get_consumption_data_for_user_in_db(
+                    user_id, start=start, end=end, validator=validator))))
 
         return error_response("Unauthorized user", 403)
 
@@ -34,6 +87,183 @@ def get_data():
         return error_response(str(e), 500)
 
 
+@consumption_bp.route('/export', methods=['GET'])
+@limiter.limit("5 per minute")
+@require_special_auth
+def export_data():
+    """Stream all consumption data as NDJSON or CSV"""
+    try:
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return error_response("format must be 'ndjson' or 'csv'", 400)
+
+        try:
+            start, end = parse_time_range(request.args)
+        except ValueError:
+            return error_response("start and end must be ISO 8601 dates", 400)
+
+        after_id = request.args.get('after_id', 0, type=int)
+        rows = stream_consumption_data(
+            after_id=after_id,
+            fetch_size=current_app.config['CONSUMPTION_EXPORT_FETCH_SIZE'],
+            start=start, end=end)
+
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        response = Response(
+            stream_with_context(format_export_rows(rows, export_format)),
+            mimetype=mimetype)
+        response.headers['Content-Disposition'] = \
+            f'attachment; filename=consumption_data.{export_format}'
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@consumption_bp.route('/aggregate', methods=['GET'])
+@limiter.limit("240 per minute")
+@require_auth
+def aggregate():
+    """Retrieve consumption totals per hour, day, week or month"""
+    try:
+        token = request.headers.get('Authorization')
+        bucket = request.args.get('bucket', 'day')
+        if bucket not in AGGREGATE_BUCKETS:
+            return error_response(
+                f"bucket must be one of {', '.join(AGGREGATE_BUCKETS)}", 400)
+
+        try:
+            start, end = parse_time_range(request.args)
+        except ValueError:
+            return error_response("start and end must be ISO 8601 dates", 400)
+
+        # Admins can aggregate over all meters, users only over their own
+        user_id = None
+        if not user_is_authorized(token, [99]):
+            user_id = get_user_id(token)
+            if not user_id:
+                return error_response("Unauthorized user", 403)
+
+        data = get_consumption_aggregate_in_db(
+            bucket, start=start, end=end, user_id=user_id,
+            meter_id=request.args.get('meter_id'))
+        return jsonify(data), 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@consumption_bp.route('/anomalies', methods=['GET'])
+@limiter.limit("240 per minute")
+@require_special_auth
+def anomalies():
+    """Retrieve the anomalies found by the anomaly scan. Paginated by id"""
+    try:
+        kind = request.args.get('kind')
+        if kind is not None and kind not in ANOMALY_KINDS:
+            return error_response(f"kind must be one of {', '.join(ANOMALY_KINDS)}", 400)
+
+        try:
+            start, end = parse_time_range(request.args)
+        except ValueError:
+            return error_response("start and end must be ISO 8601 dates", 400)
+
+        after_id = request.args.get('after_id', 0, type=int)
+        page_size = request.args.get(
+            'page_size', current_app.config['CONSUMPTION_PAGE_SIZE'], type=int)
+        page_size = max(1, min(page_size, current_app.config['CONSUMPTION_MAX_PAGE_SIZE']))
+
+        data = get_anomalies_in_db(kind=kind, meter_id=request.args.get('meter_id'),
+                                   start=start, end=end, after_id=after_id, limit=page_size)
+        response = jsonify(data)
+        if len(data) == page_size:
+            response.headers['X-Next-After-Id'] = str(data[-1]['id'])
+        return response, 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@consumption_bp.route('/changes', methods=['GET'])
+@limiter.limit("240 per minute")
+@require_auth
+def changes():
+    """Retrieve consumption data added, modified or deleted since a cursor"""
+    try:
+        token = request.headers.get('Authorization')
+        try:
+            position = decode_cursor(
+                request.args.get('since'),
+                current_app.config['CONSUMPTION_TOMBSTONE_RETENTION_DAYS'])
+        except CursorError as e:
+            return error_response(str(e), 400)
+        except CursorExpiredError as e:
+            return error_response(str(e), 410)
+
+        limit = request.args.get(
+            'limit', current_app.config['CONSUMPTION_CHANGES_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, current_app.config['CONSUMPTION_CHANGES_PAGE_SIZE']))
+
+        # Admins sync all meters, users only their own
+        meter_ids = None
+        owner_id = None
+        if not user_is_authorized(token, [99]):
+            owner_id = get_user_id(token)
+            if not owner_id:
+                return error_response("Unauthorized user", 403)
+            meter_ids = [meter['id'] for meter in get_meters(user_id=owner_id)]
+
+        result = get_changes_in_db(
+            position, meter_ids=meter_ids, owner_id=owner_id, limit=limit,
+            settle_seconds=current_app.config['CONSUMPTION_SETTLE_SECONDS'])
+        return jsonify({
+            'changes': result['changes'],
+            'deleted': result['deleted'],
+            'purged_before': result['purged_before'],
+            'cursor': encode_cursor(result['position']),
+            'has_more': result['has_more'],
+        }), 200
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
+@consumption_bp.route('/stream', methods=['GET'])
+@limiter.limit("30 per minute")
+@require_auth
+def stream():
+    """Push new consumption readings as server-sent events"""
+    try:
+        token = request.headers.get('Authorization')
+
+        # Admins receive the readings of all meters, users only of their own
+        meter_ids = None
+        user_id = None
+        if not user_is_authorized(token, [99]):
+            user_id = get_user_id(token)
+            if not user_id:
+                return error_response("Unauthorized user", 403)
+            meter_ids = [meter['id'] for meter in get_meters(user_id=user_id)]
+
+        try:
+            subscription = feed_broker.subscribe(meter_ids)
+        except FeedFullError as e:
+            return error_response(str(e), 503)
+
+        config = current_app.config
+        response = Response(
+            stream_with_context(format_feed_events(
+                subscription, user_id, config['CONSUMPTION_FEED_HEARTBEAT'],
+                config['CONSUMPTION_FEED_MAX_DURATION'])),
+            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
 @consumption_bp.route('/get_data_for_user/<user_id>', methods=['GET'])
 @limiter.limit("20 per minute")
 @require_auth
@@ -58,6 +288,18 @@ def add_data():
     try:
         input_data = validate_request_data(request, ['meter_id', 'consumption_kwh'])
 
+        # Meters should send the time of the reading, retries are then
+        # deduplicated. Readings without one are taken at the current time
+        reading = dict(input_data)
+        if not reading.get('timestamp'):
+            reading['timestamp'] = datetime.now(timezone.utc).isoformat()
+
+        # Checked like a reading of a batch
+        values, error = validate_reading(reading)
+        if error:
+            return jsonify({"inserted": 0, "failed": [{"index": 0, "error": error}]}), 400
+
+        _, input_data['consumption_kwh'], input_data['timestamp'] = values
         if add_consumption_data_in_db(input_data):
             return jsonify({"message": "Data successfully added"}), 200
 
@@ -67,6 +309,75 @@ def add_data():
         return error_response(str(e), 500)
 
 
+@consumption_bp.route('/add_batch', methods=['POST'])
+@limiter.limit("30 per minute")
+@require_auth
+def add_batch():
+    """Add many consumption readings at once.
+
+    Accepts a JSON array (or {"readings": [...]}) or NDJSON. Valid readings
+    are stored in one transaction, invalid ones are reported by index.
+    With ?mode=async valid readings are acknowledged with 202 once they are
+    in the write-ahead log and inserted in the background.
+    """
+    try:
+        token = request.headers.get('Authorization')
+        asynchronous = request.args.get('mode') == 'async'
+        if asynchronous and not ingest_queue.enabled:
+            return error_response("Asynchronous ingest is disabled", 400)
+
+        readings = parse_batch_payload(
+            request, current_app.config['CONSUMPTION_BATCH_MAX_READINGS'])
+
+        # Validate all readings first
+        validated = []
+        failed = []
+        for index, reading in enumerate(readings):
+            values, error = validate_reading(reading)
+            if error:
+                failed.append({"index": index, "error": error})
+            else:
+                validated.append((index, values))
+
+        # Resolve the external meter IDs with one lookup
+        meters = get_meter_ids_in_db(values[0] for _, values in validated)
+        is_admin = user_is_authorized(token, [99])
+        user_id = get_user_id(token)
+
+        rows = []
+        for index, (meter_id, consumption_kwh, timestamp) in validated:
+            meter = meters.get(meter_id)
+            if not meter:
+                failed.append({"index": index, "error": f"Unknown meter {meter_id}"})
+            elif not is_admin and meter['owner_id'] != user_id:
+                failed.append({"index": index, "error": f"Unauthorized for meter {meter_id}"})
+            else:
+                rows.append((meter['id'], consumption_kwh, timestamp))
+
+        failed.sort(key=lambda failure: failure['index'])
+        if not rows:
+            return jsonify({"inserted": 0, "failed": failed}), 400
+
+        if asynchronous:
+            try:
+                accepted = ingest_queue.append(rows)
+            except IngestBusyError as e:
+                return busy_response(current_app.config['CONSUMPTION_INGEST_RETRY_AFTER'],
+                                     str(e))
+            return jsonify({"accepted": accepted, "failed": failed}), 202
+
+        inserted = add_consumption_batch_in_db(
+            rows, current_app.config['CONSUMPTION_BATCH_CHUNK_SIZE'])
+        return jsonify({"inserted": inserted, "duplicates": len(rows) - inserted,
+                        "failed": failed}), 200
+
+    except BadRequest as e:
+        return error_response(e.description, 400)
+
+    except Exception as e:
+        return error_response(str(e), 500)
+
+
 @consumption_bp.route('/update_data', methods=['POST'])
 @limiter.limit("10 per minute")
 @require_special_auth
@@ -1,6 +1,35 @@
-from datetime import datetime
+import csv
+import io
+import json
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
 from auth.utils import get_data_from_token, user_is_authorized
+from consumption.feed import feed_broker
+from consumption.hot_store import hot_store
+from consumption.partitions import get_retention_cutoff
+from consumption.rollups import (ROLLUP_TABLES, refresh_rollups,
+                                 refresh_rollups_for_ids)
 from database import get_db_connection
+from flask import current_app
+from meters.utils import get_meters
+import mysql.connector
+from mysql.connector import errorcode
+from werkzeug.exceptions import BadRequest
+
+# Attempts of a batch insert that was chosen as a deadlock victim
+DEADLOCK_RETRIES = 3
+
+# Meters per IN list of a validator query, the admin scope has all of them
+VALIDATOR_METER_CHUNK = 1000
+
+# Limits of the columns of a reading: consumption_kwh is DECIMAL(20, 2),
+# meters.meter_id VARCHAR(50) and timestamp a TIMESTAMP (UTC)
+KWH_STEP = Decimal('0.01')
+MAX_KWH = Decimal('1e18')
+METER_ID_MAX_LENGTH = 50
+MIN_TIMESTAMP = datetime(1970, 1, 1, 0, 0, 1)
+MAX_TIMESTAMP = datetime(2038, 1, 19, 3, 14, 7)
 
 
 def get_user_id(token, input_data=None):
@@ -24,13 +53,39 @@ def get_user_id(token, input_data=None):
         return None
 
 
-def get_consumption_data(limit: int = 100, offset: int = 0):
-    """Retrieve a list of data from the database.
+def time_range_condition(start: datetime = None, end: datetime = None,
+                         column: str = 'c.timestamp') -> tuple:
+    """Build the SQL condition for a time range.
+
+    A time predicate on consumption_data lets MySQL skip partitions that
+    lie outside of the range.
+
+    Returns:
+        tuple: SQL condition (starting with AND, empty if no range) and its params
     """
-    with get_db_connection() as conn:
+    condition = ""
+    params = ()
+    if start is not None:
+        condition += f" AND {column} >= %s"
+        params += (start,)
+    if end is not None:
+        condition += f" AND {column} < %s"
+        params += (end,)
+    return condition, params
+
+
+def get_consumption_data(limit: int = 100, after_id: int = 0,
+                         start: datetime = None, end: datetime = None):
+    """Retrieve a page of data from the database.
+
+    Uses keyset pagination: rows are ordered by id and the page starts
+    after the given id, so deep pages are as cheap as the first one.
+    """
+    time_condition, time_params = time_range_condition(start, end)
+    with get_db_connection(read_only=True) as conn:
         cursor = conn.cursor(dictionary=True)
         cursor.execute(
-            """SELECT 
+            f"""SELECT 
                 c.id,
                 m.meter_id,
                 c.consumption_kwh,
@@ -39,30 +94,143 @@ def get_consumption_data(limit: int = 100, offset: int = 0):
                 FROM consumption_data c
                 INNER JOIN meters m
                 ON c.meter_id = m.id
-                LIMIT %s OFFSET %s""",
-            (limit, offset,))
+                WHERE c.id > %s{time_condition}
+                ORDER BY c.id
+                LIMIT %s""",
+            (after_id, *time_params, limit,))
         data = cursor.fetchall()
     return data
 
 
-def get_consumption_data_for_user_in_db(user_id):
-    """Retrieve a data from the database by its ID."""
+def stream_consumption_data(after_id: int = 0, fetch_size: int = 1000,
+                            start: datetime = None, end: datetime = None):
+    """Yield all rows after the given id using an unbuffered cursor.
+
+    Rows are fetched from the server in chunks, so memory usage does not
+    grow with the size of the table.
+    """
+    time_condition, time_params = time_range_condition(start, end)
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        try:
+            cursor.execute(
+                f"""SELECT 
+                    c.id,
+                    m.meter_id,
+                    c.consumption_kwh,
+                    c.timestamp,
+                    c.modify_timestamp
+                    FROM consumption_data c
+                    INNER JOIN meters m
+                    ON c.meter_id = m.id
+                    WHERE c.id > %s{time_condition}
+                    ORDER BY c.id""",
+                (after_id, *time_params))
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Discard unread rows if the client disconnected early
+            conn.consume_results()
+            cursor.close()
+
+
+def get_consumption_validator(meter_ids: list = None, start: datetime = None,
+                              end: datetime = None) -> tuple:
+    """Return a cheap validator for the consumption data in a scope.
+
+    Inserts raise the highest id, updates the latest modification, deletes
+    the latest tombstone and dropped partitions the retention watermark.
+    Each is read from one end of an index. The admin scope is checked
+    table-wide, the range only narrows the highest id of a meter scope.
+
+    Args:
+        meter_ids: Database IDs of the meters in scope, all meters if None.
+            Long lists are queried in chunks of VALIDATOR_METER_CHUNK
+
+    Returns:
+        tuple: (max id, last modification, max tombstone id, retention id)
+    """
+    if meter_ids is not None and not meter_ids:
+        return None, None, 0, 0
+
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor()
+        if meter_ids is None:
+            cursor.execute(
+                """SELECT MAX(id), MAX(modify_timestamp) FROM consumption_data""")
+            max_id, max_modified = cursor.fetchone()
+        else:
+            time_condition, time_params = time_range_condition(start, end)
+            max_ids = []
+            modified = []
+            for offset in range(0, len(meter_ids), VALIDATOR_METER_CHUNK):
+                chunk = meter_ids[offset:offset + VALIDATOR_METER_CHUNK]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute(
+                    f"""SELECT MAX(c.id) FROM consumption_data c
+                    WHERE c.meter_id IN ({placeholders}){time_condition}""",
+                    (*chunk, *time_params))
+                max_ids.append(cursor.fetchone()[0])
+                # One entry of meter_modified per meter (loose index scan)
+                cursor.execute(
+                    f"""SELECT meter_id, MAX(modify_timestamp) FROM consumption_data
+                    WHERE meter_id IN ({placeholders})
+                    GROUP BY meter_id""",
+                    tuple(chunk))
+                modified += [row[1] for row in cursor.fetchall() if row[1] is not None]
+            max_id = max((value for value in max_ids if value is not None), default=None)
+            max_modified = max(modified) if modified else None
+
+        cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM consumption_tombstones""")
+        tombstone_id = cursor.fetchone()[0]
+        retention = get_retention_cutoff(cursor)
+
+    return max_id, max_modified, tombstone_id, retention[0] if retention else 0
+
+
+def get_consumption_data_for_user_in_db(user_id, start: datetime = None,
+                                        end: datetime = None, validator: tuple = None):
+    """Retrieve a data from the database by its ID.
+
+    The user's meters come from the meter cache, so only consumption_data
+    is queried. Recent ranges are served from the hot store if it is as
+    current as the validator from get_consumption_validator.
+    """
     try:
-        with get_db_connection() as conn:
+        meters = {meter['id']: meter['meter_id'] for meter in get_meters(user_id=user_id)}
+        if not meters:
+            return []
+
+        if validator is not None:
+            data = hot_store.get_readings(list(meters), start, end, validator)
+            if data is not None:
+                for row in data:
+                    row['meter_id'] = meters[row['meter_id']]
+                return data
+
+        placeholders = ", ".join(["%s"] * len(meters))
+        time_condition, time_params = time_range_condition(start, end)
+        with get_db_connection(read_only=True) as conn:
             cursor = conn.cursor(dictionary=True)
             cursor.execute(
-                """SELECT 
+                f"""SELECT 
                 c.id,
-                m.meter_id,
+                c.meter_id,
                 c.consumption_kwh,
                 c.timestamp,
                 c.modify_timestamp
                 FROM consumption_data c
-                INNER JOIN meters m
-                ON c.meter_id = m.id
-                WHERE owner_id = %s""",
-                (user_id,))
+                WHERE c.meter_id IN ({placeholders}){time_condition}
+                ORDER BY c.id""",
+                (*meters, *time_params))
             data = cursor.fetchall()
+
+        # Replace the internal meter ID with the external one
+        for row in data:
+            row['meter_id'] = meters[row['meter_id']]
         return data
 
     except Exception as e:
@@ -71,17 +239,16 @@ def get_consumption_data_for_user_in_db(user_id):
 
 
 def add_consumption_data_in_db(data: dict) -> bool:
-    """Create a new data in the database"""
+    """Create a new data in the database.
+
+    Readings without a timestamp are stored with the current time, so
+    only readings with a timestamp can be deduplicated on retries.
+    """
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute(
-                """INSERT INTO consumption_data (
-                    meter_id,
-                    consumption_kwh)
-                VALUES (%s, %s)""",
-                (data['meter_id'], data['consumption_kwh']))
-            conn.commit()
+        timestamp = data.get('timestamp') or \
+            datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        add_consumption_batch_in_db(
+            [(int(data['meter_id']), Decimal(str(data['consumption_kwh'])), timestamp)])
         return True
 
     except Exception as e:
@@ -98,18 +265,369 @@ def update_consumption_data_in_db(data: dict) -> bool:
                 """
                 UPDATE consumption_data
                 SET consumption_kwh = %s,
-                modify_timestamp = %s
+                modify_timestamp = CURRENT_TIMESTAMP
                 WHERE id = %s
                 """,
                 (
                     data["consumption_kwh"],
-                    datetime.now(),
                     data["id"],
                 ),
             )
+            refresh_rollups_for_ids(conn, [data["id"]])
             conn.commit()
+        hot_store.wake()
         return True
 
     except Exception as e:
         print(f"Error updating data: {str(e)}")
         return False
+
+
+def parse_batch_payload(given_request, max_readings: int) -> list:
+    """Parse a batch of readings from a JSON array or NDJSON body."""
+    content_type = given_request.mimetype or ''
+
+    if content_type in ('application/x-ndjson', 'application/ndjson'):
+        readings = []
+        for line_number, line in enumerate(
+                given_request.get_data(as_text=True).splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                readings.append(json.loads(line))
+            except ValueError as e:
+                raise BadRequest(f"Invalid JSON on line {line_number}: {e}") from e
+    else:
+        readings = given_request.get_json(force=True)
+        if isinstance(readings, dict):
+            readings = readings.get('readings')
+
+    if not isinstance(readings, list) or not readings:
+        raise BadRequest("Request payload must contain a list of readings.")
+
+    if len(readings) > max_readings:
+        raise BadRequest(f"A batch may contain at most {max_readings} readings.")
+
+    return readings
+
+
+def parse_time_range(args) -> tuple:
+    """Parse the optional start and end query arguments.
+
+    Raises:
+        ValueError: If start or end is not a valid ISO 8601 date
+    """
+    start = args.get('start')
+    end = args.get('end')
+    return (parse_timestamp(start) if start else None,
+            parse_timestamp(end) if end else None)
+
+
+def parse_timestamp(value) -> datetime:
+    """Parse an ISO 8601 date into a naive UTC datetime.
+
+    Raises:
+        ValueError: If the value is not a valid ISO 8601 date
+    """
+    timestamp = datetime.fromisoformat(str(value))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def validate_reading(reading) -> tuple:
+    """Validate a single reading of a batch.
+
+    Returns:
+        tuple: (meter_id, consumption_kwh, timestamp), error message or None
+    """
+    if not isinstance(reading, dict):
+        return None, "Reading must be an object"
+
+    missing_fields = [field for field in ['meter_id', 'consumption_kwh', 'timestamp']
+                      if reading.get(field) in (None, '')]
+    if missing_fields:
+        return None, f"Missing required fields: {', '.join(missing_fields)}"
+
+    try:
+        consumption_kwh = Decimal(str(reading['consumption_kwh']))
+    except InvalidOperation:
+        return None, "consumption_kwh must be a number"
+    if not consumption_kwh.is_finite() or consumption_kwh < 0:
+        return None, "consumption_kwh must be a non-negative number"
+    # Stored rounded to two decimals, which must not overflow the column
+    if consumption_kwh >= MAX_KWH or consumption_kwh.quantize(KWH_STEP) >= MAX_KWH:
+        return None, f"consumption_kwh must be less than {MAX_KWH:f}"
+
+    meter_id = str(reading['meter_id'])
+    if len(meter_id) > METER_ID_MAX_LENGTH:
+        return None, f"meter_id must be at most {METER_ID_MAX_LENGTH} characters"
+
+    try:
+        # Stored with second precision, which is part of the reading's identity
+        timestamp = parse_timestamp(reading['timestamp']).replace(microsecond=0)
+    except (ValueError, OverflowError):
+        return None, "timestamp must be an ISO 8601 date"
+    if not MIN_TIMESTAMP <= timestamp <= MAX_TIMESTAMP:
+        return None, (f"timestamp must be between {MIN_TIMESTAMP.isoformat()} "
+                      f"and {MAX_TIMESTAMP.isoformat()} (UTC)")
+
+    return (meter_id, consumption_kwh, timestamp), None
+
+
+def get_meter_ids_in_db(meter_ids) -> dict:
+    """Resolve external meter IDs to their database IDs and owners.
+
+    Returns:
+        dict: meter_id -> {'id': ..., 'owner_id': ...}
+    """
+    meter_ids = list(set(meter_ids))
+    if not meter_ids:
+        return {}
+
+    placeholders = ", ".join(["%s"] * len(meter_ids))
+    with get_db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f"""SELECT id, meter_id, owner_id
+            FROM meters WHERE meter_id IN ({placeholders})""",
+            tuple(meter_ids))
+        rows = cursor.fetchall()
+
+    return {row['meter_id']: {'id': row['id'], 'owner_id': row['owner_id']}
+            for row in rows}
+
+
+def write_readings_in_db(rows: list, chunk_size: int = 1000, update_rollups: bool = True):
+    """Upsert readings in a single transaction.
+
+    A reading is identified by meter and timestamp. If it is already
+    stored, its value is updated instead of adding a duplicate. Rows are
+    written in key order so concurrent writers lock rows in the same
+    order; deadlocks are retried.
+
+    Args:
+        rows: List of (meter_id, consumption_kwh, timestamp) tuples using database meter IDs
+        chunk_size: Number of rows per multi-row INSERT
+        update_rollups: Refresh the rollups of the written hours and days in the same transaction
+    """
+    rows = sorted(rows, key=lambda row: (row[0], row[2]))
+
+    for attempt in range(DEADLOCK_RETRIES):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                for start in range(0, len(rows), chunk_size):
+                    cursor.executemany(
+                        """INSERT INTO consumption_data (
+                            meter_id,
+                            consumption_kwh,
+                            timestamp)
+                        VALUES (%s, %s, %s) AS new
+                        ON DUPLICATE KEY UPDATE
+                            modify_timestamp = IF(
+                                consumption_data.consumption_kwh = new.consumption_kwh,
+                                consumption_data.modify_timestamp, CURRENT_TIMESTAMP),
+                            consumption_kwh = new.consumption_kwh""",
+                        rows[start:start + chunk_size])
+                if update_rollups:
+                    refresh_rollups(conn, [(meter_id, timestamp)
+                                           for meter_id, _, timestamp in rows])
+                conn.commit()
+                return
+            except mysql.connector.Error as e:
+                conn.rollback()
+                if e.errno != errorcode.ER_LOCK_DEADLOCK or attempt == DEADLOCK_RETRIES - 1:
+                    raise
+            except Exception:
+                conn.rollback()
+                raise
+
+
+def add_consumption_batch_in_db(rows: list, chunk_size: int = 1000) -> int:
+    """Store many readings in a single transaction.
+
+    Retried uploads are harmless, see write_readings_in_db: the unique key
+    on (meter_id, timestamp) deduplicates them in the database.
+
+    Args:
+        rows: List of (meter_id, consumption_kwh, timestamp) tuples using database meter IDs
+        chunk_size: Number of rows per multi-row INSERT
+
+    Returns:
+        int: Number of readings written, repeats within rows are not counted
+    """
+    # Repeated readings are collapsed into the last one
+    latest = {}
+    for meter_id, consumption_kwh, timestamp in rows:
+        latest[(meter_id, timestamp)] = consumption_kwh
+    rows = [(meter_id, consumption_kwh, timestamp)
+            for (meter_id, timestamp), consumption_kwh in latest.items()]
+    if not rows:
+        return 0
+
+    write_readings_in_db(rows, chunk_size)
+
+    hot_store.add_readings(rows)
+    # IDs of multi-row inserts are not known here, the events go without
+    feed_broker.publish([{'meter_id': meter_id, 'consumption_kwh': consumption_kwh,
+                          'timestamp': timestamp}
+                         for meter_id, consumption_kwh, timestamp in rows])
+    return len(rows)
+
+
+EXPORT_COLUMNS = ['id', 'meter_id', 'consumption_kwh', 'timestamp', 'modify_timestamp']
+
+
+def _export_value(value):
+    """Convert a database value to a JSON/CSV friendly value."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def format_export_rows(rows, export_format: str = 'ndjson'):
+    """Yield the given rows as NDJSON or CSV lines."""
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow([_export_value(row[column]) for column in EXPORT_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    for row in rows:
+        yield json.dumps({column: _export_value(row[column])
+                          for column in EXPORT_COLUMNS}) + "\n"
+
+
+def format_feed_events(subscription, user_id, heartbeat: float, max_duration: float):
+    """Yield the events of a live feed subscription as server-sent events.
+
+    Sends a comment every heartbeat seconds so proxies keep the connection
+    open, and ends the stream after max_duration seconds; clients reconnect
+    and the worker can be recycled. Dropped events are announced with a
+    "dropped" event so the client can resync through /consumption/changes.
+    Events carry the external meter ID of the meters of user_id (all
+    meters if None), and the reading ID only if the feed polls.
+    """
+    meters = {}
+    deadline = time.monotonic() + max_duration
+    try:
+        yield "retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            events, dropped = subscription.get(timeout=heartbeat)
+            if dropped:
+                yield f"event: dropped\ndata: {json.dumps({'count': dropped})}\n\n"
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                if event['meter_id'] not in meters:
+                    # Meters created since the stream started
+                    meters = {meter['id']: meter['meter_id']
+                              for meter in get_meters(user_id=user_id)}
+                event = dict(event, meter_id=meters.get(event['meter_id']))
+                data = json.dumps({column: _export_value(value)
+                                   for column, value in event.items()})
+                yield f"event: reading\ndata: {data}\n\n"
+    finally:
+        feed_broker.unsubscribe(subscription)
+
+
+# SQL expressions mapping a timestamp to the start of its bucket
+AGGREGATE_BUCKETS = {
+    'hour': "DATE_FORMAT(c.timestamp, '%Y-%m-%d %H:00:00')",
+    'day': "DATE_FORMAT(c.timestamp, '%Y-%m-%d 00:00:00')",
+    'week': "DATE_FORMAT(DATE_SUB(c.timestamp, INTERVAL WEEKDAY(c.timestamp) DAY), '%Y-%m-%d 00:00:00')",
+    'month': "DATE_FORMAT(c.timestamp, '%Y-%m-01 00:00:00')",
+}
+
+
+def get_consumption_aggregate_in_db(bucket: str, start: datetime = None,
+                                    end: datetime = None, user_id=None,
+                                    meter_id: str = None):
+    """Aggregate consumption data per time bucket in the database.
+
+    When rollups are enabled the data is read from the rollup tables and
+    the range filter applies to bucket starts (hour or day granularity).
+    Ranges within the last HOT_STORE_DAYS are answered by the hot store if
+    it is as current as get_consumption_validator.
+
+    Args:
+        bucket: One of hour, day, week or month
+        start: Include readings from this time on
+        end: Include readings before this time
+        user_id: Only include meters owned by this user
+        meter_id: Only include this (external) meter ID
+
+    Returns:
+        list: One dict per bucket with sum, min, max, avg and count
+    """
+    use_rollups = current_app.config['CONSUMPTION_USE_ROLLUPS']
+
+    # Recent ranges of the hot store need no query, only the validator
+    if hot_store.answers(start):
+        scope = get_meters(user_id=user_id) if user_id is not None else get_meters()
+        if meter_id is not None:
+            scope = [meter for meter in scope if meter['meter_id'] == meter_id]
+        meter_ids = [meter['id'] for meter in scope]
+        data = hot_store.get_aggregate(bucket, meter_ids, start, end, use_rollups,
+                                       get_consumption_validator(meter_ids, start, end))
+        if data is not None:
+            return data
+
+    time_column = 'c.bucket_start' if use_rollups else 'c.timestamp'
+
+    where, params = time_range_condition(start, end, time_column)
+    if user_id is not None:
+        where += " AND m.owner_id = %s"
+        params += (user_id,)
+    if meter_id is not None:
+        where += " AND m.meter_id = %s"
+        params += (meter_id,)
+    where = f"WHERE 1 = 1{where}"
+    bucket_sql = AGGREGATE_BUCKETS[bucket].replace('c.timestamp', time_column)
+
+    if use_rollups:
+        # Hourly buckets come from the hourly rollup, all others from the daily one
+        rollup_table = ROLLUP_TABLES['hour' if bucket == 'hour' else 'day']
+        query = f"""SELECT
+            {bucket_sql} AS bucket,
+            SUM(c.sum_kwh) AS sum_kwh,
+            MIN(c.min_kwh) AS min_kwh,
+            MAX(c.max_kwh) AS max_kwh,
+            SUM(c.sum_kwh) / SUM(c.count) AS avg_kwh,
+            SUM(c.count) AS count
+            FROM {rollup_table} c
+            INNER JOIN meters m
+            ON c.meter_id = m.id
+            {where}
+            GROUP BY bucket
+            ORDER BY bucket"""
+    else:
+        query = f"""SELECT
+            {bucket_sql} AS bucket,
+            SUM(c.consumption_kwh) AS sum_kwh,
+            MIN(c.consumption_kwh) AS min_kwh,
+            MAX(c.consumption_kwh) AS max_kwh,
+            AVG(c.consumption_kwh) AS avg_kwh,
+            COUNT(*) AS count
+            FROM consumption_data c
+            INNER JOIN meters m
+            ON c.meter_id = m.id
+            {where}
+            GROUP BY bucket
+            ORDER BY bucket"""
+
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(query, params)
+        data = cursor.fetchall()
+    return data
@@ -1,11 +1,564 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
 import mysql.connector
-from flask import current_app
+from flask import current_app, g, has_app_context, has_request_context, request
+
+import instrumentation
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out within the timeout."""
+
+
+def _record_query(duration: float):
+    """Add a query to the statistics of the current request."""
+    if has_app_context():
+        stats = g.setdefault('db_stats', {'queries': 0, 'time': 0.0})
+        stats['queries'] += 1
+        stats['time'] += duration
+
+
+def get_query_stats() -> dict:
+    """Return the number of queries and their total time in seconds for the current request."""
+    return dict(g.get('db_stats', {'queries': 0, 'time': 0.0}))
+
+
+# Statements recorded by capture_statements, per thread
+_capture = threading.local()
+
+# Statements that only read, run even while capturing
+READ_STATEMENTS = ('SELECT', 'SHOW')
+
+
+@contextmanager
+def capture_statements():
+    """Record the statements run through pooled connections in this thread.
+
+    Yields a list receiving an (operation, params) tuple per statement, the
+    first parameter set for executemany. Only statements that read are
+    executed, the others are recorded and skipped, so the helpers of the
+    app can be called for their SQL without changing any data (see
+    ``flask db explain``).
+    """
+    # Unpooled connections are not instrumented, their writes would run
+    if current_app.extensions.get('db_pool') is None:
+        raise RuntimeError("Statements can only be captured with a connection pool")
+    statements = []
+    _capture.statements = statements
+    try:
+        yield statements
+    finally:
+        _capture.statements = None
+
+
+def _captured(operation, params) -> bool:
+    """Record a statement if capturing. Returns whether it has to be skipped."""
+    statements = getattr(_capture, 'statements', None)
+    if statements is None:
+        return False
+    statements.append((operation, params))
+    keyword = operation.lstrip().split(None, 1)[0].upper() if operation.strip() else ''
+    return keyword not in READ_STATEMENTS
+
+
+class InstrumentedCursor:
+    """Cursor wrapper recording the queries of the current request.
+
+    With instrumentation enabled, each statement is also recorded with
+    its duration and the number of rows it changed or returned.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._statement = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            instrumentation.record_rows(self._statement, 1)
+            yield row
+
+    def _timed(self, method, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(operation, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            _record_query(duration)
+            self._statement = operation
+            # Rows of a SELECT are counted as they are fetched
+            rows = None if getattr(self._cursor, 'with_rows', False) else self._cursor.rowcount
+            instrumentation.record_statement(operation, duration, rows)
+
+    def execute(self, operation, params=None, *args, **kwargs):
+        if _captured(operation, params or ()):
+            return None
+        return self._timed(self._cursor.execute, operation, params, *args, **kwargs)
+
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        if _captured(operation, seq_params[0] if seq_params else ()):
+            return None
+        return self._timed(self._cursor.executemany, operation, seq_params, *args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            instrumentation.record_rows(self._statement, 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        instrumentation.record_rows(self._statement, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        instrumentation.record_rows(self._statement, len(rows))
+        return rows
+
+
+class PooledConnection:
+    """Wrapper around a pooled connection.
+
+    Behaves like a regular MySQL connection, but closing it (or leaving
+    a ``with`` block) returns the underlying connection to the pool.
+    """
+
+    def __init__(self, pool, raw_conn, created_at):
+        self._pool = pool
+        self._conn = raw_conn
+        self.created_at = created_at
+        # Set when the connection is (re)wrapped, i.e. when it was returned
+        self.last_used = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def close(self):
+        """Return the connection to the pool instead of closing it."""
+        if self._conn is not None:
+            self._pool.release(self)
+
+    def raw_connection(self):
+        """Return the wrapped mysql.connector connection."""
+        return self._conn
+
+
+class ConnectionPool:
+    """Thread-safe MySQL connection pool.
+
+    Keeps up to ``size`` idle connections and allows ``max_overflow``
+    additional connections under load. Idle connections older than
+    ``recycle`` seconds or unused for ``idle_timeout`` seconds are
+    replaced, and connections are pinged on checkout when ``pre_ping``
+    is enabled.
+    """
+
+    def __init__(self, db_config: dict, size: int = 5, max_overflow: int = 10,
+                 recycle: int = 3600, timeout: float = 30,
+                 pre_ping: bool = True, idle_timeout: int = 300):
+        self.db_config = db_config
+        self.size = size
+        self.max_overflow = max_overflow
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size + max_overflow)
+        self._stats = {
+            'checkouts': 0,
+            'checkins': 0,
+            'connects': 0,
+            'recycled': 0,
+            'ping_failures': 0,
+            'timeouts': 0,
+            'in_use': 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _connect(self):
+        self._count('connects')
+        return mysql.connector.connect(**self.db_config), time.monotonic()
+
+    def _is_usable(self, pooled: PooledConnection) -> bool:
+        """Check whether an idle connection may be handed out again."""
+        now = time.monotonic()
+        if self.recycle and now - pooled.created_at > self.recycle:
+            self._count('recycled')
+            return False
+
+        # The server may have dropped it (wait_timeout) or a firewall may
+        # have forgotten it, replacing it is cheaper than a failed ping
+        if self.idle_timeout and now - pooled.last_used > self.idle_timeout:
+            self._count('recycled')
+            return False
+
+        if self.pre_ping:
+            try:
+                pooled.raw_connection().ping(reconnect=False)
+            except Exception:
+                self._count('ping_failures')
+                return False
+
+        return True
+
+    @staticmethod
+    def _discard(raw_conn):
+        try:
+            raw_conn.close()
+        except Exception:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        """Check out a connection, waiting up to ``timeout`` seconds."""
+        with instrumentation.span('db-acquire', 'sm_db_acquire_duration_seconds'):
+            return self._acquire()
+
+    def _acquire(self) -> PooledConnection:
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('timeouts')
+            raise PoolTimeoutError(
+                f"No database connection available within {self.timeout}s")
+
+        try:
+            while True:
+                try:
+                    pooled = self._idle.get_nowait()
+                except Empty:
+                    raw_conn, created_at = self._connect()
+                    pooled = PooledConnection(self, raw_conn, created_at)
+                    break
+
+                if self._is_usable(pooled):
+                    break
+                self._discard(pooled.raw_connection())
 
+        except Exception:
+            self._slots.release()
+            raise
 
-def get_db_connection():
-    """Create and return a new database connection.
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+        return pooled
+
+    def release(self, pooled: PooledConnection):
+        """Return a connection to the pool or close it if the pool is full."""
+        raw_conn = pooled.raw_connection()
+        pooled._conn = None
+
+        try:
+            # Drop any uncommitted work so the next user starts clean
+            raw_conn.rollback()
+            reusable = True
+        except Exception:
+            reusable = False
+
+        if reusable:
+            fresh = PooledConnection(self, raw_conn, pooled.created_at)
+            try:
+                self._idle.put_nowait(fresh)
+            except Exception:
+                self._discard(raw_conn)
+        else:
+            self._discard(raw_conn)
+
+        with self._lock:
+            self._stats['checkins'] += 1
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    def dispose(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(pooled.raw_connection())
+
+    def stats(self) -> dict:
+        """Return a snapshot of the pool statistics."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({
+            'size': self.size,
+            'max_overflow': self.max_overflow,
+            'idle': self._idle.qsize(),
+        })
+        return stats
+
+
+class Replica:
+    """A read replica and its last known state."""
+
+    def __init__(self, name: str, pool: ConnectionPool):
+        self.name = name
+        self.pool = pool
+        self.lag = None
+        self.available = False
+        self.error = None
+
+
+class ReplicaSet:
+    """Read replicas with health and replication lag checks.
+
+    Replicas that cannot be reached, do not replicate or lag more than
+    ``max_lag`` seconds behind the primary are taken out of rotation until
+    a later check finds them healthy again. Each worker process checks
+    every ``check_interval`` seconds in a background thread.
+    """
+
+    def __init__(self, replicas: list, strategy: str = 'round_robin',
+                 max_lag: float = 5, check_interval: float = 5):
+        self.replicas = replicas
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self._checked = False
+        self._thread = None
+        self._thread_pid = None
+
+    def _start(self):
+        with self._lock:
+            if not self._checked:
+                self.check()
+                self._checked = True
+            # Threads do not survive a fork, so each worker process starts its own
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='replica-check',
+                                                daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
+
+    def check(self):
+        """Update the replication lag and availability of every replica."""
+        for replica in self.replicas:
+            try:
+                with replica.pool.acquire() as conn:
+                    cursor = conn.cursor(dictionary=True)
+                    cursor.execute("""SHOW REPLICA STATUS""")
+                    status = cursor.fetchone()
+                    cursor.fetchall()
+            except Exception as e:
+                replica.lag, replica.available, replica.error = None, False, str(e)
+                continue
+
+            if status is None:
+                replica.lag, replica.available = None, False
+                replica.error = "Not configured as a replica"
+                continue
+            # None while replication is stopped
+            replica.lag = status.get('Seconds_Behind_Source')
+            replica.available = replica.lag is not None and replica.lag <= self.max_lag
+            replica.error = status.get('Last_Error') or None
+
+    def choose(self):
+        """Return a replica in rotation, or None if there is none."""
+        if self._thread_pid != os.getpid():
+            self._start()
+
+        candidates = [replica for replica in self.replicas if replica.available]
+        if not candidates:
+            return None
+        if self.strategy == 'least_connections':
+            return min(candidates, key=lambda replica: replica.pool.stats()['in_use'])
+        return candidates[next(self._counter) % len(candidates)]
+
+    def stats(self) -> list:
+        """Return the state of every replica."""
+        return [{'name': replica.name, 'available': replica.available,
+                 'lag': replica.lag, 'error': replica.error,
+                 **replica.pool.stats()}
+                for replica in self.replicas]
+
+
+# Nesting depth of use_primary() per thread
+_primary_only = threading.local()
+
+# HTTP methods that do not change data
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@contextmanager
+def use_primary():
+    """Send the read-only queries of the block to the primary."""
+    _primary_only.depth = getattr(_primary_only, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _primary_only.depth -= 1
+
+
+def _request_user_id():
+    claims = g.get('token_claims')
+    return claims[1].get('userId') if claims else None
+
+
+def _writer_key(user_id) -> str:
+    return f'db-writer:{user_id}'
+
+
+def _requires_primary() -> bool:
+    """Whether reads of the current request have to see its user's writes."""
+    if getattr(_primary_only, 'depth', 0):
+        return True
+    if not has_request_context():
+        return False
+
+    pinned = g.get('db_pinned')
+    if pinned is None:
+        writers = current_app.extensions.get('db_writers')
+        user_id = _request_user_id()
+        pinned = request.method not in SAFE_METHODS or (
+            writers is not None and user_id is not None
+            and writers.backend.get(_writer_key(user_id))[0])
+        g.db_pinned = pinned
+    return pinned
+
+
+def _remember_writer(response):
+    """Pin the reads of a user who changed data to the primary for a while."""
+    if request.method not in SAFE_METHODS and response.status_code < 400:
+        writers = current_app.extensions.get('db_writers')
+        user_id = _request_user_id()
+        if writers is not None and user_id is not None:
+            writers.backend.set(_writer_key(user_id), True,
+                                current_app.config['DB_READ_YOUR_WRITES_SECONDS'])
+    return response
+
+
+def _create_pool(app, db_config: dict) -> ConnectionPool:
+    return ConnectionPool(
+        db_config,
+        size=app.config['DB_POOL_SIZE'],
+        max_overflow=app.config['DB_POOL_MAX_OVERFLOW'],
+        recycle=app.config['DB_POOL_RECYCLE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        pre_ping=app.config['DB_POOL_PRE_PING'],
+        idle_timeout=app.config['DB_POOL_IDLE_TIMEOUT'])
+
+
+def init_db(app, cache=None):
+    """Create the connection pools for the given app.
+
+    Args:
+        app: The application
+        cache: Shared cache remembering which users just changed data, so
+            their reads go to the primary. Passed in as the cache uses
+            this module; without it only the writing request is pinned
+    """
+    app.extensions['db_pool'] = _create_pool(app, app.config['DB_CONFIG'])
+
+    replica_configs = app.config['DB_REPLICAS'] + [
+        dict(app.config['DB_CONFIG'], host=host) for host in app.config['DB_REPLICA_HOSTS']]
+    if replica_configs:
+        replicas = [Replica(f"{replica_config['host']}:{replica_config.get('port', 3306)}",
+                            _create_pool(app, replica_config))
+                    for replica_config in replica_configs]
+        app.extensions['db_replicas'] = ReplicaSet(
+            replicas,
+            strategy=app.config['DB_REPLICA_STRATEGY'],
+            max_lag=app.config['DB_REPLICA_MAX_LAG'],
+            check_interval=app.config['DB_REPLICA_CHECK_INTERVAL'])
+        # Its backend is read per request, the cache is set up after this
+        app.extensions['db_writers'] = cache
+        app.after_request(_remember_writer)
+
+    if app.config['DB_REPORT_QUERIES']:
+        app.after_request(_add_query_headers)
+
+
+def _add_query_headers(response):
+    # Streamed responses only report the queries run before the first chunk
+    stats = get_query_stats()
+    response.headers['X-DB-Queries'] = str(stats['queries'])
+    response.headers['X-DB-Time'] = f"{stats['time'] * 1000:.2f}"
+    return response
+
+
+def get_pool_stats() -> dict:
+    """Return the statistics of the current app's connection pool."""
+    pool = current_app.extensions.get('db_pool')
+    return pool.stats() if pool else {}
+
+
+def get_replica_stats() -> list:
+    """Return the state of the current app's read replicas."""
+    replicas = current_app.extensions.get('db_replicas')
+    return replicas.stats() if replicas else []
+
+
+def _acquire_replica(replicas: ReplicaSet):
+    # All reads of a request use the same replica, so e.g. an ETag and
+    # the data it validates come from the same state
+    replica = g.get('db_replica')
+    if replica is None:
+        replica = replicas.choose()
+        if replica is None:
+            return None
+        g.db_replica = replica
+
+    try:
+        return replica.pool.acquire()
+    except (PoolTimeoutError, mysql.connector.Error) as e:
+        replica.available, replica.error = False, str(e)
+        g.pop('db_replica', None)
+        return None
+
+
+def get_db_connection(read_only: bool = False):
+    """Check out a database connection.
+
+    Uses the app's connection pool if one was set up in create_app,
+    otherwise a new connection is opened.
+
+    Args:
+        read_only: The caller only reads and tolerates a replication lag of
+            up to DB_REPLICA_MAX_LAG seconds. Such reads go to a replica
+            unless the request changes data, its user changed data in the
+            last DB_READ_YOUR_WRITES_SECONDS or no replica is available.
 
     Returns:
-        mysql.connector.connection.MySQLConnection: Database connection object
+        PooledConnection | mysql.connector.connection.MySQLConnection: Database connection object
     """
-    return mysql.connector.connect(**current_app.config['DB_CONFIG'])
+    pool = current_app.extensions.get('db_pool')
+    if pool is None:
+        return mysql.connector.connect(**current_app.config['DB_CONFIG'])
+
+    replicas = current_app.extensions.get('db_replicas')
+    if read_only and replicas is not None and not _requires_primary():
+        conn = _acquire_replica(replicas)
+        if conn is not None:
+            return conn
+    return pool.acquire()
@@ -0,0 +1,494 @@
+import os
+import random
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import click
+from auth.utils import create_token
+from billing.engine import load_hourly
+from billing.utils import get_invoices_in_db
+from cache import ALL_METERS_KEY, cache, user_key, user_meters_key
+from consumption.anomalies import get_anomalies_in_db, load_series, pending_meters
+from consumption.changes import decode_cursor, get_changes_in_db
+from consumption.hot_store import HotStore, hot_store
+from consumption.rollups import rebuild_rollups, refresh_rollups
+from consumption.utils import (get_consumption_aggregate_in_db, get_consumption_data,
+                               get_consumption_data_for_user_in_db, get_consumption_validator,
+                               get_meter_ids_in_db, update_consumption_data_in_db,
+                               write_readings_in_db)
+from database import capture_statements, get_db_connection
+from flask import current_app
+from flask.cli import AppGroup
+from instrumentation import statement_fingerprint
+from meters.utils import get_meters
+
+db_cli = AppGroup('db', help='Database migrations and checks.')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_.+\.sql$')
+
+# Stored in plain text, hashed on the first login like legacy passwords
+SYNTHETIC_PASSWORD = 'Synthetic1!'
+
+
+def _with_cursor(function, *args):
+    """Call a helper that takes a cursor with one of a pooled connection."""
+    with get_db_connection() as conn:
+        return function(conn.cursor(), *args)
+
+
+def _with_connection(function, *args):
+    with get_db_connection() as conn:
+        return function(conn, *args)
+
+
+def _uncached(keys: list, function, *args, **kwargs):
+    """Call a helper after dropping the cache entries it would be served from."""
+    cache.invalidate(*keys)
+    return function(*args, **kwargs)
+
+
+def _aggregate(use_rollups: bool, *args, **kwargs):
+    """Call get_consumption_aggregate_in_db with or without the rollups."""
+    config = current_app.config
+    previous = config['CONSUMPTION_USE_ROLLUPS']
+    config['CONSUMPTION_USE_ROLLUPS'] = use_rollups
+    try:
+        return get_consumption_aggregate_in_db(*args, **kwargs)
+    finally:
+        config['CONSUMPTION_USE_ROLLUPS'] = previous
+
+
+def _request(method: str, path: str, token: str = None, json: dict = None):
+    """Call an endpoint of the current app, for the SQL that lives in routes."""
+    headers = {'Authorization': token} if token else {}
+    current_app.test_client().open(path, method=method, headers=headers, json=json)
+
+
+# Hot queries of the backend. Each entry calls the code that runs them with
+# sample values from the seeded data (see _sample_values), its statements are
+# captured and EXPLAINed. A statement is checked once, under the first entry
+# that runs it. Each entry: (name, call, full scan allowed)
+HOT_QUERIES = [
+    # meters/utils.py
+    ('meters.get_meters (user)',
+     lambda s: _uncached([user_meters_key(s['owner_id'])], get_meters, s['owner_id']), False),
+    ('meters.get_meters (admin)',
+     lambda s: _uncached([ALL_METERS_KEY], get_meters), True),
+    # consumption/utils.py
+    ('consumption.get_consumption_data',
+     lambda s: get_consumption_data(1000, s['consumption_id'], s['start'], s['end']), False),
+    ('consumption.get_consumption_data_for_user_in_db',
+     lambda s: get_consumption_data_for_user_in_db(s['owner_id'], s['start'], s['end']), False),
+    ('consumption.get_consumption_validator (user)',
+     lambda s: get_consumption_validator([s['meter_id']], s['start'], s['end']), False),
+    ('consumption.get_consumption_validator (admin)',
+     lambda s: get_consumption_validator(start=s['recent'], end=s['end']), False),
+    ('consumption.get_meter_ids_in_db',
+     lambda s: get_meter_ids_in_db([s['meter_name']]), False),
+    ('consumption.write_readings_in_db',
+     lambda s: write_readings_in_db([(s['meter_id'], Decimal('1.00'), s['end'])]), False),
+    ('consumption.update_consumption_data_in_db',
+     lambda s: update_consumption_data_in_db(
+         {'id': s['consumption_id'], 'consumption_kwh': Decimal('1.00')}), False),
+    ('consumption.get_consumption_aggregate_in_db (raw, user)',
+     lambda s: _aggregate(False, 'day', s['start'], s['end'], user_id=s['owner_id']), False),
+    ('consumption.get_consumption_aggregate_in_db (raw, admin)',
+     lambda s: _aggregate(False, 'hour', s['recent'], s['end']), False),
+    ('consumption.get_consumption_aggregate_in_db (rollup, user)',
+     lambda s: _aggregate(True, 'month', s['start'], s['end'], user_id=s['owner_id']), False),
+    ('consumption.get_consumption_aggregate_in_db (rollup hourly, admin)',
+     lambda s: _aggregate(True, 'hour', s['recent'], s['end']), False),
+    ('consumption.get_consumption_aggregate_in_db (rollup daily, admin)',
+     lambda s: _aggregate(True, 'day', s['recent'], s['end']), False),
+    # consumption/rollups.py
+    ('consumption.rollups.refresh_rollups',
+     lambda s: _with_connection(refresh_rollups, [(s['meter_id'], s['start']),
+                                                  (s['meter_id'], s['end'])]), False),
+    # consumption/changes.py
+    ('consumption.changes.get_changes_in_db (user)',
+     lambda s: get_changes_in_db(s['position'], [s['meter_id']], s['owner_id']), False),
+    ('consumption.changes.get_changes_in_db (admin)',
+     lambda s: get_changes_in_db(s['position']), False),
+    # consumption/anomalies.py
+    ('consumption.anomalies.get_anomalies_in_db',
+     lambda s: get_anomalies_in_db(start=s['start']), False),
+    ('consumption.anomalies.load_series',
+     lambda s: _with_cursor(load_series, s['meter_id'], s['start']), False),
+    ('consumption.anomalies.pending_meters',
+     lambda s: _with_cursor(pending_meters, s['consumption_id'] - 1, s['consumption_id']),
+     False),
+    # consumption/hot_store.py, warm lists all meters once per worker
+    ('consumption.hot_store.load_meters',
+     lambda s: s['hot_store'].load_meters([s['meter_id']], s['start']), False),
+    ('consumption.hot_store.warm', lambda s: s['hot_store'].warm(), True),
+    ('consumption.hot_store.sync', lambda s: s['hot_store'].sync(), False),
+    # billing/engine.py and billing/utils.py
+    ('billing.engine.load_hourly (rollups)',
+     lambda s: _with_cursor(load_hourly, [s['meter_id']], s['start'], s['end'], True), False),
+    ('billing.engine.load_hourly (raw)',
+     lambda s: _with_cursor(load_hourly, [s['meter_id']], s['start'], s['end'], False), False),
+    ('billing.get_invoices_in_db (user)',
+     lambda s: get_invoices_in_db(user_id=s['owner_id']), False),
+    # user/routes.py
+    ('user.get_user',
+     lambda s: _uncached([user_key(s['owner_id'])], _request, 'GET', '/user/get_user',
+                         s['token']), False),
+    ('user.update_user',
+     lambda s: _request('POST', '/user/update_user', s['token'], {
+         'id': s['owner_id'], 'email': s['email'], 'first_name': 'Synthetic',
+         'last_name': 'User', 'phone': '0000000000', 'address': 'Teststraße 1',
+         'city': 'Berlin', 'zip_code': '10115'}), False),
+    ('user.get_all', lambda s: _request('GET', '/user/get_all', s['admin_token']), True),
+    # auth/routes.py and auth/utils.py
+    ('auth.login',
+     lambda s: _request('POST', '/auth/login', json={'username': s['username'],
+                                                     'password': SYNTHETIC_PASSWORD}), False),
+    ('auth.login (lock)',
+     lambda s: _request('POST', '/auth/login', json={'username': s['username'],
+                                                     'password': 'wrong'}), False),
+    ('auth.create_user',
+     lambda s: _request('POST', '/auth/signup', json={
+         'username': f"{s['username']}-explain", 'password': SYNTHETIC_PASSWORD,
+         'email': s['email'], 'firstName': 'Synthetic', 'lastName': 'User',
+         'phone': '0000000000', 'address': 'Teststraße 1', 'city': 'Berlin',
+         'zipCode': '10115'}), False),
+    ('auth.delete_user',
+     lambda s: _request('DELETE', '/auth/delete_user', s['token'],
+                        {'username': s['username']}), False),
+]
+
+# Statements EXPLAIN accepts
+EXPLAINABLE = ('SELECT', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE')
+# Rows of an EXPLAIN that describe the table written by an INSERT
+INSERT_TARGETS = ('INSERT', 'REPLACE')
+
+# EXPLAIN access types that read a whole table or index
+FULL_SCAN_TYPES = ('ALL', 'index')
+
+
+def _read_migrations():
+    """Return the migration files as (version, name, path), ordered by version."""
+    migrations = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(name)
+        if match:
+            migrations.append((int(match.group(1)), name, os.path.join(MIGRATIONS_DIR, name)))
+    return sorted(migrations)
+
+
+DELIMITER_LINE = re.compile(r'DELIMITER[ \t]+(\S+)[^\n]*(\n|$)', re.IGNORECASE)
+
+
+def _skip_quoted(sql: str, index: int) -> int:
+    """Return the index after the string literal or quoted identifier at index."""
+    quote = sql[index]
+    index += 1
+    while index < len(sql):
+        if sql[index] == '\\' and quote != '`':
+            index += 2
+        elif sql[index] == quote:
+            # A doubled quote stands for the quote itself
+            if not sql.startswith(quote, index + 1):
+                return index + 1
+            index += 2
+        else:
+            index += 1
+    return index
+
+
+def _split_statements(sql):
+    """Split a migration file into single statements.
+
+    Statements end at ';' outside of string literals, quoted identifiers
+    and comments, which are removed. As in the mysql client, a line
+    ``DELIMITER $$`` between statements changes the terminator, e.g. for
+    triggers whose body contains ';'.
+    """
+    statements = []
+    parts = []
+    delimiter = ';'
+    start = index = 0
+    # Nothing but whitespace and comments since the last statement
+    blank = True
+    while index < len(sql):
+        if blank:
+            match = DELIMITER_LINE.match(sql, index)
+            if match:
+                delimiter = match.group(1)
+                start = index = match.end()
+                continue
+
+        char = sql[index]
+        if char in '\'"`':
+            blank = False
+            index = _skip_quoted(sql, index)
+        elif char == '#' or (sql.startswith('--', index)
+                             and sql[index + 2:index + 3] in ('', ' ', '\t', '\n', '\r')):
+            parts.append(sql[start:index])
+            end = sql.find('\n', index)
+            start = index = len(sql) if end < 0 else end
+        elif sql.startswith('/*', index):
+            parts.append(sql[start:index])
+            end = sql.find('*/', index + 2)
+            start = index = len(sql) if end < 0 else end + 2
+        elif sql.startswith(delimiter, index):
+            statements.append(''.join(parts) + sql[start:index])
+            parts = []
+            start = index = index + len(delimiter)
+            blank = True
+        else:
+            blank = blank and char.isspace()
+            index += 1
+    statements.append(''.join(parts) + sql[start:])
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def apply_migrations() -> list:
+    """Apply all migrations that are not recorded in schema_migrations yet.
+
+    Returns:
+        list: Names of the applied migrations
+    """
+    applied = []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        cursor.execute("""SELECT version FROM schema_migrations""")
+        done = {row[0] for row in cursor.fetchall()}
+
+        for version, name, path in _read_migrations():
+            if version in done:
+                continue
+            with open(path, encoding='utf-8') as migration_file:
+                for statement in _split_statements(migration_file.read()):
+                    cursor.execute(statement)
+            cursor.execute(
+                """INSERT INTO schema_migrations (version, name) VALUES (%s, %s)""",
+                (version, name))
+            conn.commit()
+            applied.append(name)
+
+    return applied
+
+
+def seed_synthetic_data(users: int, meters_per_user: int, readings_per_meter: int,
+                        interval_minutes: int = 15, chunk_size: int = 5000,
+                        admins: int = 0) -> dict:
+    """Insert synthetic users, meters and readings.
+
+    Readings end at the current time and are spaced by interval_minutes.
+    Users log in as ``<prefix>-<n>``, admins as ``<prefix>-admin-<n>``, all
+    with the password SYNTHETIC_PASSWORD.
+
+    Returns:
+        dict: Login prefix and number of inserted users, admins, meters and readings
+    """
+    prefix = datetime.now().strftime('synthetic-%Y%m%d%H%M%S')
+    end = datetime.now().replace(second=0, microsecond=0)
+    inserted_readings = 0
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        for admin_number in range(admins):
+            cursor.execute(
+                """INSERT INTO users (
+                first_name, last_name, phone, email, address, city, zip_code)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                ('Synthetic', f'Admin {admin_number}', '0000000000',
+                 f'{prefix}-admin-{admin_number}@example.com', 'Teststraße 1', 'Berlin', '10115'))
+            cursor.execute(
+                """INSERT INTO login (
+                login_username, login_password, user_id, role_id)
+                VALUES (%s, %s, %s, %s)""",
+                (f'{prefix}-admin-{admin_number}', SYNTHETIC_PASSWORD, cursor.lastrowid, 99))
+
+        user_ids = []
+        for user_number in range(users):
+            cursor.execute(
+                """INSERT INTO users (
+                first_name, last_name, phone, email, address, city, zip_code)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                ('Synthetic', f'User {user_number}', '0000000000',
+                 f'{prefix}-{user_number}@example.com', 'Teststraße 1', 'Berlin', '10115'))
+            user_ids.append(cursor.lastrowid)
+            cursor.execute(
+                """INSERT INTO login (
+                login_username, login_password, user_id, role_id)
+                VALUES (%s, %s, %s, %s)""",
+                (f'{prefix}-{user_number}', SYNTHETIC_PASSWORD, cursor.lastrowid, 1))
+        conn.commit()
+
+        meter_ids = []
+        for user_id in user_ids:
+            for meter_number in range(meters_per_user):
+                cursor.execute(
+                    """INSERT INTO meters (meter_id, owner_id, created_by)
+                    VALUES (%s, %s, %s)""",
+                    (f'{prefix}-{user_id}-{meter_number}', user_id, user_id))
+                meter_ids.append(cursor.lastrowid)
+        conn.commit()
+
+        for meter_id in meter_ids:
+            rows = [(meter_id,
+                     round(random.uniform(0, 2), 2),
+                     end - timedelta(minutes=interval_minutes * reading_number))
+                    for reading_number in range(readings_per_meter)]
+            for start in range(0, len(rows), chunk_size):
+                cursor.executemany(
+                    """INSERT INTO consumption_data (meter_id, consumption_kwh, timestamp)
+                    VALUES (%s, %s, %s)""",
+                    rows[start:start + chunk_size])
+            conn.commit()
+            inserted_readings += len(rows)
+
+        cursor.execute("""ANALYZE TABLE users, login, meters, consumption_data""")
+        cursor.fetchall()
+
+    return {'prefix': prefix, 'users': len(user_ids), 'admins': admins,
+            'meters': len(meter_ids), 'readings': inserted_readings}
+
+
+def _sample_values(cursor) -> dict:
+    """Pick existing values to run the hot queries with."""
+    cursor.execute(
+        """SELECT m.id, m.meter_id, m.owner_id, u.email, l.login_username, l.role_id
+        FROM meters m
+        INNER JOIN users u ON u.id = m.owner_id
+        INNER JOIN login l ON l.user_id = u.id
+        ORDER BY m.id DESC LIMIT 1""")
+    meter_id, meter_name, owner_id, email, username, role_id = cursor.fetchone()
+
+    cursor.execute(
+        """SELECT MAX(id), MAX(timestamp) FROM consumption_data WHERE meter_id = %s""",
+        (meter_id,))
+    consumption_id, last_timestamp = cursor.fetchone()
+    last_timestamp = last_timestamp or datetime.now()
+    start = last_timestamp.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=30)
+    consumption_id = (consumption_id or 1) // 2
+
+    return {
+        'meter_id': meter_id,
+        'meter_name': meter_name,
+        'owner_id': owner_id,
+        'email': email,
+        'username': username,
+        'token': create_token(owner_id, username, role_id),
+        'admin_token': create_token(owner_id, username, 99),
+        'consumption_id': consumption_id,
+        'start': start,
+        # Queries over all meters are asked for short ranges
+        'recent': last_timestamp - timedelta(hours=1),
+        'end': last_timestamp,
+        'position': dict(decode_cursor(None), last_id=consumption_id, settled_id=consumption_id,
+                         modified=start.isoformat()),
+    }
+
+
+def _explain(cursor, statement, params) -> tuple:
+    """Return the plan of a statement and the tables it reads in full."""
+    cursor.execute(f"EXPLAIN {statement}", params)
+    plan = cursor.fetchall()
+    full_scans = [row['table'] for row in plan
+                  if row['type'] in FULL_SCAN_TYPES and row['select_type'] not in INSERT_TARGETS]
+    return plan, full_scans
+
+
+def explain_hot_queries(app) -> list:
+    """Run the hot queries of app and EXPLAIN the statements they send.
+
+    Statements that change data are recorded but not executed, see
+    capture_statements. The hot store of this process is disabled, so
+    reads go to the database; its statements are run by a separate store.
+
+    Args:
+        app: The application, its context must be pushed
+
+    Returns:
+        list: One dict per statement with the plan and whether it does a full scan
+    """
+    hot_store.configure(app, app.config['HOT_STORE_DAYS'], 0, app.config['HOT_STORE_SYNC_INTERVAL'])
+    # A store of one batch of meters, its sync is not started
+    store = HotStore()
+    store.configure(app, app.config['HOT_STORE_DAYS'], 1, app.config['HOT_STORE_SYNC_INTERVAL'])
+
+    with get_db_connection() as conn:
+        samples = dict(_sample_values(conn.cursor()), hot_store=store)
+
+    captured = []
+    for name, call, full_scan_allowed in HOT_QUERIES:
+        with capture_statements() as statements:
+            try:
+                call(samples)
+            except Exception as e:
+                click.echo(f"{name} failed: {e}", err=True)
+        captured.append((name, statements, full_scan_allowed))
+
+    results = []
+    checked = set()
+    with get_db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        for name, statements, full_scan_allowed in captured:
+            for statement, params in statements:
+                fingerprint = statement_fingerprint(statement)
+                keyword = statement.lstrip().split(None, 1)[0].upper()
+                if fingerprint in checked or keyword not in EXPLAINABLE:
+                    continue
+                checked.add(fingerprint)
+                plan, full_scans = _explain(cursor, statement, params)
+                results.append({
+                    'name': name,
+                    'statement': fingerprint,
+                    'plan': plan,
+                    'full_scans': full_scans,
+                    'failed': bool(full_scans) and not full_scan_allowed,
+                })
+
+    return results
+
+
+@db_cli.command('upgrade')
+def upgrade_command():
+    """Apply all pending schema migrations."""
+    applied = apply_migrations()
+    for name in applied:
+        click.echo(f"Applied {name}")
+    if not applied:
+        click.echo("Database is up to date")
+
+
+@db_cli.command('seed')
+@click.option('--users', type=int, default=200, show_default=True)
+@click.option('--meters', 'meters_per_user', type=int, default=2, show_default=True,
+              help='Meters per user.')
+@click.option('--readings', 'readings_per_meter', type=int, default=500, show_default=True,
+              help='Readings per meter.')
+@click.option('--admins', type=int, default=0, show_default=True)
+def seed_command(users, meters_per_user, readings_per_meter, admins):
+    """Load a synthetic dataset into the database."""
+    counts = seed_synthetic_data(users, meters_per_user, readings_per_meter, admins=admins)
+    rebuild_rollups()
+    click.echo(f"Inserted {counts['users']} users, {counts['admins']} admins, "
+               f"{counts['meters']} meters and {counts['readings']} readings "
+               f"(logins {counts['prefix']}-*)")
+
+
+@db_cli.command('explain')
+@click.pass_obj
+def explain_command(script_info):
+    """Fail if a hot query falls back to a full table scan."""
+    results = explain_hot_queries(script_info.load_app())
+    for result in results:
+        status = 'FAIL' if result['failed'] else 'ok'
+        access = ', '.join(f"{row['table']}:{row['type']}:{row['key']}" for row in result['plan'])
+        click.echo(f"[{status}] {result['name']} ({access})\n    {result['statement']}")
+
+    failed = [result['name'] for result in results if result['failed']]
+    if failed:
+        raise click.ClickException(f"Full table scans in: {', '.join(failed)}")
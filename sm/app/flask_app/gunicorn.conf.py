@@ -0,0 +1,54 @@
+"""Gunicorn settings. Every value can be overridden by an environment variable."""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+
+# Pre-fork workers, each with threads for requests waiting on MySQL. Every open
+# live feed (/consumption/stream) holds a thread, keep this above
+# CONSUMPTION_FEED_MAX_SUBSCRIBERS
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Read by the workers when they create the app (config.worker_processes), which
+# shares its caches and rate limits between workers when there are several
+os.environ['GUNICORN_WORKERS'] = str(workers)
+
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_class = 'gthread'
+
+# Recycle workers after a number of requests; the jitter avoids restarting all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+# Time a worker gets to finish its requests on reload (SIGHUP) or shutdown
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+# Counters of stopped workers are folded into one metrics snapshot, recycled
+# workers would otherwise leave a file each in METRICS_DIR
+def on_starting(server):
+    """Export the final worker count (it can be set on the command line) and
+    fold the metrics snapshots left by the workers of an earlier run."""
+    os.environ['GUNICORN_WORKERS'] = str(server.cfg.workers)
+    from config import Config
+    if Config.INSTRUMENTATION_ENABLED:
+        from instrumentation import retire_snapshots
+        retire_snapshots(Config.METRICS_DIR)
+
+
+def worker_exit(server, worker):
+    """Write the last metrics snapshot of a stopping worker."""
+    from instrumentation import metrics
+    metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    """Fold the metrics snapshot of a stopped worker."""
+    from config import Config
+    if Config.INSTRUMENTATION_ENABLED:
+        from instrumentation import retire_snapshots
+        retire_snapshots(Config.METRICS_DIR, [worker.pid])
@@ -0,0 +1,36 @@
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts) -> str:
+    """Build an ETag from the given validator values."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def conditional_response(etag: str, last_modified, build_response):
+    """Answer 304 if the client's copy is current, otherwise build the response.
+
+    The validator must be cheap to compute; build_response is only called
+    if the client does not have the current representation.
+
+    Args:
+        etag: ETag of the current representation
+        last_modified: Time of the last change or None
+        build_response: Function returning the full response
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = build_response()
+    else:
+        response = Response(status=304)
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    # Responses depend on the user, clients have to revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Authorization')
+    return response
@@ -0,0 +1,525 @@
+import ipaddress
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, current_app, g, has_app_context, request
+
+# Upper bounds in seconds of the latency histograms
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'sm_http_requests_total': ('counter', 'HTTP requests by endpoint, method and status.'),
+    'sm_http_request_duration_seconds': ('histogram', 'Time to build the response.'),
+    'sm_span_seconds_total': ('counter', 'Time spent per request phase (db, db-acquire, jwt, bcrypt).'),
+    'sm_db_queries_total': ('counter', 'Database statements by endpoint.'),
+    'sm_db_statement_duration_seconds': ('histogram', 'Duration of database statements.'),
+    'sm_db_statement_rows_total': ('counter', 'Rows fetched or changed by database statements.'),
+    'sm_db_acquire_duration_seconds': ('histogram', 'Time to check out a pooled connection.'),
+    'sm_db_pool_connections': ('gauge', 'Pooled connections by state.'),
+    'sm_db_pool_events_total': ('counter', 'Connection pool events.'),
+    'sm_db_replica_available': ('gauge', 'Whether a read replica is in rotation.'),
+    'sm_db_replica_lag_seconds': ('gauge', 'Replication lag of a read replica.'),
+    'sm_cache_events_total': ('counter', 'Lookup cache hits, misses and invalidations.'),
+    'sm_feed_subscribers': ('gauge', 'Open live feed streams.'),
+    'sm_hot_store_events_total': ('counter', 'Hot store hits, misses and evicted meters.'),
+    'sm_hot_store_bytes': ('gauge', 'Memory held by the hot stores of the workers.'),
+    'sm_hot_store_meters': ('gauge', 'Meters kept in the hot stores of the workers.'),
+    'sm_ingest_pending_readings': ('gauge', 'Readings waiting in the ingest write-ahead log.'),
+}
+
+# Gauges that describe a shared resource, every worker reports the same
+# value; the others are summed over the workers
+SHARED_GAUGES = ('sm_db_replica_available', 'sm_db_replica_lag_seconds')
+
+# IN lists have a variable number of placeholders
+PLACEHOLDER_LIST = re.compile(r'%s(\s*,\s*%s)+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def statement_fingerprint(sql) -> str:
+    """Normalize a statement into a low-cardinality label."""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = PLACEHOLDER_LIST.sub('%s, ...', WHITESPACE.sub(' ', sql).strip())
+    return sql[:160]
+
+
+class Metrics:
+    """Counters and histograms of one worker process.
+
+    Each worker writes a snapshot to ``directory`` from time to time;
+    /metrics sums the snapshots of all workers. The counters and
+    histograms of stopped workers are folded into one snapshot without
+    gauges (see retire_snapshots), so counters never go backwards.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.flush_interval = 5.0
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._last_flush = 0.0
+        # Set by init_instrumentation; the span and record hooks cost nothing while False
+        self.enabled = False
+
+    def configure(self, directory: str = None, flush_interval: float = 5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._collectors = []
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def add_collector(self, collector):
+        """Register a function returning gauges and counters read at snapshot time.
+
+        The function returns a list of (name, labels dict, value) tuples.
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name: str, labels: dict = None, amount: float = 1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self) -> dict:
+        gauges = {}
+        counters = {}
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                key = (name, tuple(sorted(labels.items())))
+                if METRICS[name][0] == 'gauge':
+                    gauges[key] = value
+                else:
+                    counters[key] = value
+
+        with self._lock:
+            counters.update(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), value]
+                           for (name, labels), value in histograms.items()],
+            'gauges': [[name, list(labels), value] for (name, labels), value in gauges.items()],
+        }
+
+    def flush(self, force: bool = False):
+        """Write the snapshot of this worker, at most every flush_interval seconds."""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        _write_snapshot(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+
+    def collect(self) -> list:
+        """Return the snapshots of all workers."""
+        if not self.directory:
+            return [self.snapshot()]
+
+        self.flush(force=True)
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                continue
+
+        # A worker folded by retire_snapshots whose file is about to go
+        retired = [snapshot for snapshot in snapshots if snapshot['pid'] is None]
+        folded = set(retired[0]['folded']) if retired else set()
+        return [snapshot for snapshot in snapshots if snapshot['pid'] not in folded]
+
+
+RETIRED_SNAPSHOT = 'retired.json'
+
+
+def _add_totals(counters: dict, histograms: dict, snapshot: dict):
+    """Add the counters and histograms of a snapshot to the totals."""
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, value in snapshot['histograms']:
+        key = (name, tuple(tuple(label) for label in labels))
+        total = histograms.setdefault(key, [0] * len(value))
+        for index, part in enumerate(value):
+            total[index] += part
+
+
+def _write_snapshot(path: str, snapshot: dict):
+    with open(path + '.tmp', 'w', encoding='utf-8') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(path + '.tmp', path)
+
+
+def retire_snapshots(directory: str, pids: list = None):
+    """Fold the snapshots of stopped workers into the retired snapshot and delete them.
+
+    Run by the gunicorn master only (see gunicorn.conf.py), so the retired
+    snapshot has a single writer. It lists the folded workers until their
+    files are gone, /metrics skips those files instead of counting them twice.
+
+    Args:
+        directory: METRICS_DIR
+        pids: Workers that stopped, all workers if None (none is running)
+    """
+    if not directory or not os.path.isdir(directory):
+        return
+    path = os.path.join(directory, RETIRED_SNAPSHOT)
+    if pids is None:
+        pids = [int(name[:-5]) for name in os.listdir(directory)
+                if name.endswith('.json') and name[:-5].isdigit()]
+
+    counters, histograms = {}, {}
+    try:
+        with open(path, encoding='utf-8') as snapshot_file:
+            _add_totals(counters, histograms, json.load(snapshot_file))
+    except (OSError, ValueError):
+        pass
+    folded = []
+    for pid in pids:
+        try:
+            with open(os.path.join(directory, f'{pid}.json'), encoding='utf-8') as snapshot_file:
+                _add_totals(counters, histograms, json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+        folded.append(pid)
+    if not folded:
+        return
+
+    snapshot = {
+        'pid': None,
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), value]
+                       for (name, labels), value in histograms.items()],
+        'gauges': [],
+    }
+    _write_snapshot(path, dict(snapshot, folded=folded))
+    for pid in folded:
+        try:
+            os.remove(os.path.join(directory, f'{pid}.json'))
+        except FileNotFoundError:
+            pass
+    # A new worker may get the pid of a folded one
+    _write_snapshot(path, dict(snapshot, folded=[]))
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus(snapshots: list) -> str:
+    """Sum the snapshots of all workers in the Prometheus text format."""
+    counters, histograms, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        _add_totals(counters, histograms, snapshot)
+        for name, labels, value in snapshot['gauges']:
+            key = (name, tuple(tuple(label) for label in labels))
+            if name in SHARED_GAUGES:
+                gauges[key] = max(gauges.get(key, value), value)
+            else:
+                gauges[key] = gauges.get(key, 0) + value
+
+    lines = []
+    for metric, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        if metric_type == 'histogram':
+            for (name, labels), value in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                for bound, count in zip(DURATION_BUCKETS, value):
+                    bucket_labels = labels + (('le', str(bound)),)
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {value[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+        else:
+            values = gauges if metric_type == 'gauge' else counters
+            for (name, labels), value in sorted(values.items()):
+                if name == metric:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving requests.
+
+    While a request is running, its thread's stack is sampled every
+    ``interval`` seconds. If the request took longer than ``threshold``
+    seconds, the samples are written as folded stacks (one
+    ``frame;frame;frame count`` line per stack), the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.threshold = None
+        self.interval = 0.005
+        self._lock = threading.Lock()
+        self._active = {}
+        self._thread = None
+        self._thread_pid = None
+
+    def configure(self, directory: str, threshold: float = None, interval: float = 0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        if directory and threshold is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.threshold is not None
+
+    def start(self):
+        """Start sampling the current thread."""
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            # Threads do not survive a fork, so each worker process starts its own
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._sample, name='profiler',
+                                                daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def stop(self, duration: float, label: str):
+        """Stop sampling the current thread and dump the samples of a slow request."""
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or duration < self.threshold:
+            return
+
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(duration * 1000)}ms-" \
+               f"{re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')}-{os.getpid()}.folded"
+        with open(os.path.join(self.directory, name), 'w', encoding='utf-8') as folded_file:
+            for stack, count in samples.most_common():
+                folded_file.write(f'{stack} {count}\n')
+
+    @staticmethod
+    def _fold(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self._fold(frame)] += 1
+
+
+metrics = Metrics()
+profiler = SamplingProfiler()
+
+
+def record_span(name: str, duration: float):
+    """Add time spent in a phase (db, jwt, bcrypt, ...) to the current request."""
+    if metrics.enabled and has_app_context():
+        spans = g.setdefault('spans', {})
+        spans[name] = spans.get(name, 0.0) + duration
+
+
+@contextmanager
+def span(name: str, histogram: str = None):
+    """Time a block as a phase of the current request.
+
+    Args:
+        name: Name of the phase in the Server-Timing header
+        histogram: Optional histogram metric to also observe the duration in
+    """
+    if not metrics.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        record_span(name, duration)
+        if histogram:
+            metrics.observe(histogram, duration)
+
+
+def record_statement(sql, duration: float, rows: int = None):
+    """Record a database statement. Called by the instrumented cursor."""
+    if not metrics.enabled:
+        return
+    statement = statement_fingerprint(sql)
+    metrics.observe('sm_db_statement_duration_seconds', duration, {'statement': statement})
+    if rows is not None and rows >= 0:
+        metrics.inc('sm_db_statement_rows_total', {'statement': statement}, rows)
+
+
+def record_rows(sql, rows: int):
+    """Add fetched rows to a statement."""
+    if metrics.enabled and rows and sql is not None:
+        metrics.inc('sm_db_statement_rows_total', {'statement': statement_fingerprint(sql)}, rows)
+
+
+def _endpoint_label() -> str:
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    if profiler.enabled:
+        profiler.start()
+
+
+def _after_request(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    endpoint = _endpoint_label()
+
+    metrics.inc('sm_http_requests_total', {'endpoint': endpoint, 'method': request.method,
+                                           'status': str(response.status_code)})
+    metrics.observe('sm_http_request_duration_seconds', duration, {'endpoint': endpoint})
+
+    db_stats = g.get('db_stats', {'queries': 0, 'time': 0.0})
+    metrics.inc('sm_db_queries_total', {'endpoint': endpoint}, db_stats['queries'])
+    spans = dict(g.get('spans', {}), db=db_stats['time'])
+    for name, seconds in spans.items():
+        metrics.inc('sm_span_seconds_total', {'endpoint': endpoint, 'span': name}, seconds)
+
+    # Streamed responses only report the time until the first chunk
+    timings = [f'app;dur={duration * 1000:.2f}',
+               f'db;dur={db_stats["time"] * 1000:.2f};desc="{db_stats["queries"]} queries"']
+    timings.extend(f'{name};dur={seconds * 1000:.2f}'
+                   for name, seconds in sorted(spans.items()) if name != 'db')
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    if profiler.enabled:
+        profiler.stop(duration, f'{request.method} {endpoint}')
+    metrics.flush()
+    return response
+
+
+def _metrics_allowed() -> bool:
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        return request.headers.get('Authorization') == f'Bearer {token}'
+    # Without a token only local scrapers are allowed
+    try:
+        return ipaddress.ip_address(request.remote_addr).is_loopback
+    except ValueError:
+        return False
+
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of all worker processes"""
+    if not _metrics_allowed():
+        return Response(status=403)
+    return Response(render_prometheus(metrics.collect()),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def _collect_app_stats(app, cache, feed_broker, hot_store, ingest_queue):
+    """Gauges and counters owned by other modules, read at snapshot time."""
+    pool = app.extensions.get('db_pool')
+    replicas = app.extensions.get('db_replicas')
+
+    def collect():
+        values = []
+        if pool is not None:
+            stats = pool.stats()
+            values.append(('sm_db_pool_connections', {'state': 'in_use'}, stats['in_use']))
+            values.append(('sm_db_pool_connections', {'state': 'idle'}, stats['idle']))
+            for event in ('checkouts', 'connects', 'recycled', 'ping_failures', 'timeouts'):
+                values.append(('sm_db_pool_events_total', {'event': event}, stats[event]))
+        if replicas is not None:
+            for replica in replicas.replicas:
+                labels = {'replica': replica.name}
+                values.append(('sm_db_replica_available', labels, int(replica.available)))
+                if replica.lag is not None:
+                    values.append(('sm_db_replica_lag_seconds', labels, replica.lag))
+        if cache is not None:
+            cache_stats = cache.stats()
+            for event in ('hits', 'misses', 'invalidations'):
+                values.append(('sm_cache_events_total', {'event': event}, cache_stats[event]))
+        if feed_broker is not None:
+            values.append(('sm_feed_subscribers', {}, feed_broker.subscriber_count()))
+        if hot_store is not None and hot_store.enabled:
+            store_stats = hot_store.stats()
+            for event in ('hits', 'misses', 'evictions'):
+                values.append(('sm_hot_store_events_total', {'event': event},
+                               store_stats[event]))
+            values.append(('sm_hot_store_bytes', {}, store_stats['bytes']))
+            values.append(('sm_hot_store_meters', {}, store_stats['meters']))
+        if ingest_queue is not None and ingest_queue.enabled:
+            values.append(('sm_ingest_pending_readings', {}, ingest_queue.stats()['pending']))
+        return values
+
+    return collect
+
+
+def init_instrumentation(app, cache=None, feed_broker=None, hot_store=None,
+                         ingest_queue=None):
+    """Enable request timing, /metrics and the profiler if configured.
+
+    The cache, feed broker, hot store and ingest queue are passed in
+    rather than imported, as they use the hooks of this module. Their
+    stats are exported when given.
+    """
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+
+    metrics.configure(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+    metrics.enabled = True
+    metrics.add_collector(_collect_app_stats(app, cache, feed_broker, hot_store,
+                                             ingest_queue))
+    slow_request_ms = app.config['PROFILE_SLOW_REQUEST_MS']
+    profiler.configure(app.config['PROFILE_DIR'],
+                       slow_request_ms / 1000 if slow_request_ms is not None else None,
+                       app.config['PROFILE_INTERVAL_MS'] / 1000)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.register_blueprint(metrics_bp)
@@ -0,0 +1,97 @@
+import dataclasses
+import datetime
+import decimal
+import uuid
+
+import orjson
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def http_date(value: datetime.date) -> str:
+    """Format a date like werkzeug.http.http_date, several times faster.
+
+    Naive datetimes are taken as UTC.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        time_part = f'{value.hour:02d}:{value.minute:02d}:{value.second:02d}'
+    else:
+        time_part = '00:00:00'
+    return (f'{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} '
+            f'{value.year:04d} {time_part} GMT')
+
+
+def _default(value):
+    """Serialize the types orjson does not support natively, like Flask does."""
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, datetime.date):
+        return http_date(value)
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson.
+
+    Produces the same output as Flask's default provider: sorted keys,
+    Decimals as strings and dates in the HTTP date format. With
+    ``datetime_format = 'iso'`` dates are serialized as ISO 8601 by
+    orjson itself, which is several times faster than formatting them
+    in Python.
+    """
+
+    mimetype = 'application/json'
+    datetime_format = 'http'
+    sort_keys = True
+
+    def _options(self) -> int:
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if self.datetime_format == 'http':
+            options |= orjson.OPT_PASSTHROUGH_DATETIME
+        else:
+            options |= orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+        return options
+
+    def dumps(self, obj, **_kwargs) -> str:
+        return orjson.dumps(obj, default=_default, option=self._options()).decode('utf-8')
+
+    def loads(self, s, **_kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=self._options()) + b'\n',
+            mimetype=self.mimetype)
+
+
+def columnar(rows: list) -> dict:
+    """Convert a list of row dicts into {"columns": [...], "rows": [[...]]}.
+
+    The compact shape does not repeat the key names in every row.
+    """
+    if not rows:
+        return {'columns': [], 'rows': []}
+    columns = list(rows[0])
+    return {'columns': columns, 'rows': [list(row.values()) for row in rows]}
+
+
+def init_json(app):
+    """Use the JSON provider selected in the app config."""
+    if app.config['JSON_PROVIDER'] == 'orjson':
+        provider = OrjsonProvider(app)
+        provider.datetime_format = app.config['JSON_DATETIME_FORMAT']
+    else:
+        provider = DefaultJSONProvider(app)
+    app.json = provider
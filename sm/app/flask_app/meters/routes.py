@@ -1,12 +1,11 @@
 from auth.utils import (error_response, require_auth, require_special_auth,
                         validate_request_data, user_is_authorized)
 from flask import Blueprint, jsonify, request
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from http_cache import conditional_response, make_etag
+from rate_limit import limiter
 from meters.utils import (get_user_id, get_meters, create_meter_in_db)
 
 meters_bp = Blueprint('meters', __name__)
-limiter = Limiter(get_remote_address)
 
 
 @meters_bp.route('/get_data', methods=['GET'])
@@ -18,13 +17,17 @@ def get_data():
 
         # Get all data if user is admin
         if user_is_authorized(request.headers.get('Authorization'), [99]):
-            return jsonify(get_meters()), 200
+            data = get_meters()
+            return conditional_response(make_etag('all', data), None,
+                                        lambda: jsonify(data))
 
-        # Else get data for user only
+        # Else get data for user only. The meters come from the cache, so
+        # hashing them is cheaper than sending them again
         user_id = get_user_id(request.headers.get('Authorization'))
         if user_id:
             data = get_meters(user_id=user_id)
-            return jsonify(data), 200
+            return conditional_response(make_etag(user_id, data), None,
+                                        lambda: jsonify(data))
 
         return error_response("Unauthorized user", 403)
 
@@ -1,4 +1,5 @@
 from auth.utils import get_data_from_token, user_is_authorized
+from cache import ALL_METERS_KEY, cache, user_meters_key
 from database import get_db_connection
 
 
@@ -26,19 +27,23 @@ def get_user_id(token, input_data=None):
 def get_meters(user_id: int = None):
     """Retrieve meters"""
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor(dictionary=True)
+    def load():
+        with get_db_connection(read_only=True) as conn:
+            cursor = conn.cursor(dictionary=True)
 
-        if user_id is not None:
-            cursor.execute(
-                """SELECT * FROM meters WHERE owner_id = %s""",
-                (user_id,)
-            )
-        else:
-            cursor.execute(
-                """SELECT * FROM meters""")
-        results = cursor.fetchall()
-        return results
+            if user_id is not None:
+                cursor.execute(
+                    """SELECT * FROM meters WHERE owner_id = %s""",
+                    (user_id,)
+                )
+            else:
+                cursor.execute(
+                    """SELECT * FROM meters""")
+            results = cursor.fetchall()
+            return results
+
+    key = user_meters_key(user_id) if user_id is not None else ALL_METERS_KEY
+    return cache.get_or_load(key, load)
 
 
 def create_meter_in_db(owner_id, meter_id, created_by):
@@ -55,6 +60,8 @@ def create_meter_in_db(owner_id, meter_id, created_by):
                 VALUES (%s, %s, %s)""",
                 (meter_id, owner_id, created_by,))
             conn.commit()
+
+        cache.invalidate(user_meters_key(owner_id), ALL_METERS_KEY)
         return True
 
     except Exception:
@@ -0,0 +1,23 @@
+-- Pre-aggregated consumption per meter and hour / day (see consumption/rollups.py).
+-- Run `flask rollups rebuild` afterwards to backfill existing data.
+CREATE TABLE IF NOT EXISTS `consumption_rollup_hourly` (
+  `meter_id` int NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `sum_kwh` decimal(20,2) NOT NULL,
+  `min_kwh` decimal(20,2) NOT NULL,
+  `max_kwh` decimal(20,2) NOT NULL,
+  `count` int NOT NULL,
+  PRIMARY KEY (`meter_id`,`bucket_start`),
+  CONSTRAINT `consumption_rollup_hourly_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `consumption_rollup_daily` (
+  `meter_id` int NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `sum_kwh` decimal(20,2) NOT NULL,
+  `min_kwh` decimal(20,2) NOT NULL,
+  `max_kwh` decimal(20,2) NOT NULL,
+  `count` int NOT NULL,
+  PRIMARY KEY (`meter_id`,`bucket_start`),
+  CONSTRAINT `consumption_rollup_daily_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
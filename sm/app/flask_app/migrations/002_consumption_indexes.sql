@@ -0,0 +1,10 @@
+-- Composite index for per-meter time range queries. It also covers the
+-- aggregation queries (consumption_kwh) and replaces the single column
+-- meter_id index used by the foreign key.
+ALTER TABLE `consumption_data`
+  ADD KEY `meter_timestamp` (`meter_id`,`timestamp`,`consumption_kwh`),
+  DROP KEY `meter_id`;
+
+-- Time range queries over all meters (admin views, retention)
+ALTER TABLE `consumption_data`
+  ADD KEY `timestamp` (`timestamp`);
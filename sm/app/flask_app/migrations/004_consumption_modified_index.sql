@@ -0,0 +1,4 @@
+-- Lets the ETag validators of the read endpoints find the latest
+-- modification per meter without reading the rows.
+ALTER TABLE `consumption_data`
+  ADD KEY `meter_modified` (`meter_id`,`modify_timestamp`);
@@ -0,0 +1,17 @@
+-- Deleted readings for the delta sync endpoint (/consumption/changes).
+-- Filled by a trigger, pruned by `flask partitions maintain`.
+CREATE TABLE IF NOT EXISTS `consumption_tombstones` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `consumption_id` int NOT NULL,
+  `meter_id` int NOT NULL,
+  `owner_id` int DEFAULT NULL,
+  `deleted_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `owner_id` (`owner_id`,`id`),
+  KEY `deleted_at` (`deleted_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TRIGGER `consumption_data_after_delete` AFTER DELETE ON `consumption_data`
+FOR EACH ROW
+  INSERT INTO `consumption_tombstones` (`consumption_id`, `meter_id`, `owner_id`)
+  VALUES (OLD.id, OLD.meter_id, (SELECT `owner_id` FROM `meters` WHERE `id` = OLD.meter_id));
@@ -0,0 +1,10 @@
+-- A reading is identified by its meter and timestamp, so retried uploads
+-- update the stored reading instead of adding a duplicate. Existing
+-- duplicates are removed first, keeping the oldest row. Rebuild the rollups
+-- afterwards with `flask rollups rebuild`.
+DELETE c FROM `consumption_data` c
+  INNER JOIN `consumption_data` d
+  ON d.meter_id = c.meter_id AND d.timestamp = c.timestamp AND d.id < c.id;
+
+ALTER TABLE `consumption_data`
+  ADD UNIQUE KEY `meter_reading` (`meter_id`,`timestamp`);
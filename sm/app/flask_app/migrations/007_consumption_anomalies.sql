@@ -0,0 +1,29 @@
+-- Anomalies found by `flask anomalies scan` (consumption/anomalies.py),
+-- one row per meter, kind and start. Incremental scans continue after the
+-- last consumption_data ID of the previous scan.
+CREATE TABLE IF NOT EXISTS `consumption_anomalies` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `meter_id` int NOT NULL,
+  `kind` varchar(20) NOT NULL,
+  `start_timestamp` timestamp NOT NULL,
+  `end_timestamp` timestamp NOT NULL,
+  `score` double NOT NULL,
+  `detail` varchar(255) NOT NULL DEFAULT '',
+  `detected_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `meter_anomaly` (`meter_id`,`kind`,`start_timestamp`),
+  KEY `start_timestamp` (`start_timestamp`),
+  CONSTRAINT `consumption_anomalies_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `consumption_anomaly_scans` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `mode` varchar(20) NOT NULL,
+  `last_consumption_id` int NOT NULL,
+  `meters` int NOT NULL,
+  `readings` int NOT NULL,
+  `anomalies` int NOT NULL,
+  `started_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
@@ -0,0 +1,91 @@
+-- Tariffs and invoices for the billing run (`flask billing run`, billing/).
+-- A tariff prices energy either by time of use (tariff_rates, hours in
+-- BILLING_TIMEZONE, days as a bitmask with Monday = 1) or by the
+-- consumption of the billing period (tariff_tiers).
+CREATE TABLE IF NOT EXISTS `tariffs` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `name` varchar(100) NOT NULL,
+  `base_fee` decimal(10,2) NOT NULL DEFAULT '0.00',
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `tariff_rates` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `days` tinyint NOT NULL DEFAULT '127',
+  `start_hour` tinyint NOT NULL,
+  `end_hour` tinyint NOT NULL,
+  `price_per_kwh` decimal(10,4) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `tariff_id` (`tariff_id`),
+  CONSTRAINT `tariff_rates_ibfk_1` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `tariff_tiers` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `from_kwh` decimal(20,2) NOT NULL,
+  `price_per_kwh` decimal(10,4) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `tariff_tier` (`tariff_id`,`from_kwh`),
+  CONSTRAINT `tariff_tiers_ibfk_1` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `meter_tariffs` (
+  `meter_id` int NOT NULL,
+  `tariff_id` int NOT NULL,
+  PRIMARY KEY (`meter_id`),
+  KEY `tariff_id` (`tariff_id`),
+  CONSTRAINT `meter_tariffs_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE,
+  CONSTRAINT `meter_tariffs_ibfk_2` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+-- One run per billing period. Meters are priced in batches, a restarted
+-- run skips the meters that already have charges.
+CREATE TABLE IF NOT EXISTS `billing_runs` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `period_start` date NOT NULL,
+  `period_end` date NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'running',
+  `started_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `period` (`period_start`,`period_end`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `billing_charges` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `run_id` int NOT NULL,
+  `meter_id` int NOT NULL,
+  `owner_id` int NOT NULL,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `kwh` decimal(20,2) NOT NULL,
+  `price_per_kwh` decimal(10,4) DEFAULT NULL,
+  `amount` decimal(12,2) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `run_meter_label` (`run_id`,`meter_id`,`label`),
+  KEY `run_owner` (`run_id`,`owner_id`),
+  CONSTRAINT `billing_charges_ibfk_1` FOREIGN KEY (`run_id`) REFERENCES `billing_runs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+
+CREATE TABLE IF NOT EXISTS `invoices` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `run_id` int NOT NULL,
+  `user_id` int NOT NULL,
+  `period_start` date NOT NULL,
+  `period_end` date NOT NULL,
+  `currency` char(3) NOT NULL,
+  `kwh` decimal(20,2) NOT NULL,
+  `amount` decimal(12,2) NOT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `run_user` (`run_id`,`user_id`),
+  KEY `user_id` (`user_id`,`id`),
+  CONSTRAINT `invoices_ibfk_1` FOREIGN KEY (`run_id`) REFERENCES `billing_runs` (`id`) ON DELETE CASCADE,
+  CONSTRAINT `invoices_ibfk_2` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
@@ -0,0 +1,4 @@
+-- Lets the hot store (consumption/hot_store.py) of every worker find the
+-- readings modified since its last sync without scanning the table.
+ALTER TABLE `consumption_data`
+  ADD KEY `modify_timestamp` (`modify_timestamp`);
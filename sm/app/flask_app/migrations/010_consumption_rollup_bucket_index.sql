@@ -0,0 +1,7 @@
+-- Time range aggregates over all meters (admin views) read the rollups by
+-- bucket instead of scanning them.
+ALTER TABLE `consumption_rollup_hourly`
+  ADD KEY `bucket_start` (`bucket_start`);
+
+ALTER TABLE `consumption_rollup_daily`
+  ADD KEY `bucket_start` (`bucket_start`);
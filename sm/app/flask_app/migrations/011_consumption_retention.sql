@@ -0,0 +1,10 @@
+-- Retention watermarks. Dropping a partition of consumption_data does not
+-- fire the tombstone trigger, so `flask partitions maintain` records the
+-- bound of every dropped partition here. Delta sync clients and the hot
+-- stores drop their copies of readings before the cutoff.
+CREATE TABLE IF NOT EXISTS `consumption_retention` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `cutoff` datetime NOT NULL,
+  `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
@@ -0,0 +1,6 @@
+-- Scans of a single meter (`flask anomalies scan --meter-id`) record the
+-- meter and no watermark, incremental scans continue after the last scan
+-- of all meters.
+ALTER TABLE `consumption_anomaly_scans`
+  ADD COLUMN `meter_id` int DEFAULT NULL AFTER `mode`,
+  MODIFY `last_consumption_id` int DEFAULT NULL;
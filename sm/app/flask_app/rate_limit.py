@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import threading
+import time
+
+from auth.utils import decode_token
+from config import worker_processes
+from flask import request
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from limits.storage import Storage
+
+
+def rate_limit_key():
+    """Rate limit per user for authenticated requests, per client IP otherwise."""
+    claims = decode_token(request.headers.get('Authorization'))
+    if claims is not None and 'userId' in claims:
+        return f"user:{claims['userId']}"
+    return f"ip:{get_remote_address()}"
+
+
+limiter = Limiter(key_func=rate_limit_key)
+
+
+class SQLiteStorage(Storage):
+    """Rate limit counters shared by all worker processes of a host.
+
+    Counter increments are collected in memory and written to the SQLite
+    file in one transaction every ``flush_interval`` seconds or after
+    ``batch_size`` hits. Between flushes a worker adds its own pending hits
+    to the last shared value it has seen, so limits may be exceeded by at
+    most the hits of one batch per worker.
+
+    Only supports the fixed-window strategies.
+
+    URI: ``sqlite:///path/to/file.db``. flush_interval and batch_size are
+    set through RATELIMIT_STORAGE_OPTIONS.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False,
+                 flush_interval: float = 0.5, batch_size: int = 50, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri.split('://', 1)[1] or ':memory:'
+        self.flush_interval = float(flush_interval)
+        self.batch_size = int(batch_size)
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._pending = {}
+        self._pending_hits = 0
+        self._shared = {}
+        self._last_flush = 0.0
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        # SQLite connections must not be shared across a fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                    key TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    expiry REAL NOT NULL)""")
+            self._conn_pid = os.getpid()
+            self._pending.clear()
+            self._pending_hits = 0
+            self._shared.clear()
+        return self._conn
+
+    def _flush(self, keys=()):
+        """Write pending increments and refresh the shared values of the given keys."""
+        conn = self._connection()
+        now = time.time()
+        pending = self._pending
+        self._pending = {}
+        self._pending_hits = 0
+        self._last_flush = now
+
+        refresh = set(keys) | set(pending)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, (amount, expiry) in pending.items():
+                conn.execute(
+                    """INSERT INTO rate_limit_counters (key, count, expiry)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        count = CASE WHEN expiry <= ? THEN excluded.count
+                                     ELSE count + excluded.count END,
+                        expiry = CASE WHEN expiry <= ? THEN excluded.expiry
+                                      ELSE expiry END""",
+                    (key, amount, now + expiry, now, now))
+            for key in refresh:
+                row = conn.execute(
+                    """SELECT count, expiry FROM rate_limit_counters
+                    WHERE key = ? AND expiry > ?""",
+                    (key, now)).fetchone()
+                self._shared[key] = row if row else (0, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _current(self, key):
+        count, expiry = self._shared.get(key, (0, 0.0))
+        if expiry <= time.time():
+            count = 0
+        return count + self._pending.get(key, (0, 0))[0]
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        with self._lock:
+            self._connection()
+            pending_amount, _ = self._pending.get(key, (0, expiry))
+            self._pending[key] = (pending_amount + amount, expiry)
+            self._pending_hits += amount
+
+            if (key not in self._shared
+                    or self._pending_hits >= self.batch_size
+                    or time.time() - self._last_flush >= self.flush_interval):
+                self._flush([key])
+            return self._current(key)
+
+    def get(self, key: str) -> int:
+        with self._lock:
+            if key not in self._shared:
+                self._flush([key])
+            return self._current(key)
+
+    def get_expiry(self, key: str) -> float:
+        with self._lock:
+            if key not in self._shared:
+                self._flush([key])
+            count, expiry = self._shared[key]
+            return expiry if count else time.time()
+
+    def check(self) -> bool:
+        try:
+            with self._lock:
+                self._connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            self._pending_hits = 0
+            self._shared.clear()
+            return self._connection().execute("DELETE FROM rate_limit_counters").rowcount
+
+    def clear(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._shared.pop(key, None)
+            self._connection().execute(
+                "DELETE FROM rate_limit_counters WHERE key = ?", (key,))
+
+
+def init_limiter(app):
+    """Attach the shared limiter to the app.
+
+    Storage and strategy come from RATELIMIT_STORAGE_URI and RATELIMIT_STRATEGY.
+    Without a storage URI the counters are kept in memory for a single worker
+    process and in the SQLite file RATELIMIT_SQLITE_PATH for several.
+
+    Raises:
+        RuntimeError: If memory:// is configured for several worker processes
+    """
+    uri = app.config['RATELIMIT_STORAGE_URI']
+    workers = worker_processes(app.config)
+    if uri is None:
+        uri = f"sqlite://{app.config['RATELIMIT_SQLITE_PATH']}" if workers > 1 else 'memory://'
+    elif uri.startswith('memory://') and workers > 1:
+        raise RuntimeError(f"RATELIMIT_STORAGE_URI memory:// is per process and cannot be used "
+                           f"with {workers} worker processes, use sqlite:// or redis://")
+    app.config['RATELIMIT_STORAGE_URI'] = uri
+    if app.config['RATELIMIT_STRATEGY'] is None:
+        # The SQLite storage only supports fixed windows
+        app.config['RATELIMIT_STRATEGY'] = ('fixed-window' if uri.startswith('sqlite://')
+                                            else 'moving-window')
+    limiter.init_app(app)
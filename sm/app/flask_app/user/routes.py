@@ -1,12 +1,11 @@
 from auth.utils import (error_response, get_data_from_token, require_auth,
                         user_is_authorized, validate_request_data, require_special_auth)
+from cache import cache, user_key
 from database import get_db_connection
 from flask import Blueprint, jsonify, request
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from rate_limit import limiter
 
 user_bp = Blueprint('user', __name__)
-limiter = Limiter(get_remote_address)
 
 
 @user_bp.route('/get_user', methods=['GET'])
@@ -18,15 +17,18 @@ def get_user():
         authenticated_user_id = get_data_from_token(
             request.headers.get('Authorization'), 'userId')
 
-        with get_db_connection() as conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute(
-                """SELECT id, first_name, last_name, email, 
-                    phone, address, city, zip_code
-                    FROM users WHERE id = %s""",
-                (authenticated_user_id,)
-            )
-            user = cursor.fetchone()
+        def load_user():
+            with get_db_connection(read_only=True) as conn:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(
+                    """SELECT id, first_name, last_name, email, 
+                        phone, address, city, zip_code
+                        FROM users WHERE id = %s""",
+                    (authenticated_user_id,)
+                )
+                return cursor.fetchone()
+
+        user = cache.get_or_load(user_key(authenticated_user_id), load_user)
 
         return jsonify(user), 200
 
@@ -68,6 +70,8 @@ def update_user():
             )
             conn.commit()
 
+        cache.invalidate(user_key(user_id))
+
         return jsonify({"message": "User updated successfully"}), 200
 
     except Exception as e:
@@ -80,7 +84,7 @@ def update_user():
 def get_all():
     """Get all users"""
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(read_only=True) as conn:
             cursor = conn.cursor(dictionary=True)
             cursor.execute(
                 """SELECT id, first_name, last_name FROM users"""
@@ -0,0 +1,13 @@
+"""WSGI entry point for production servers (gunicorn, mod_wsgi)."""
+from app import create_app
+from consumption.hot_store import hot_store
+from consumption.ingest import ingest_queue
+
+app = create_app()
+application = app
+
+# Start the ingest writer, which also replays write-ahead logs left by a crash
+ingest_queue.start()
+
+# Warm the store of recent readings in the background
+hot_store.start()
@@ -0,0 +1,28 @@
+# Sourced by the MySQL entrypoint on the first start of the replica.
+# Copies the primary's database together with its GTID state, then
+# replicates from the primary with GTID auto positioning.
+
+SOURCE_HOST="${SOURCE_HOST:-db}"
+
+until mysqladmin ping -h "$SOURCE_HOST" -uroot -p"$MYSQL_ROOT_PASSWORD" \
+        --ssl-mode=REQUIRED --silent; do
+    mysql_note "Waiting for $SOURCE_HOST"
+    sleep 2
+done
+
+# The dump sets GTID_PURGED, which requires an empty GTID history
+docker_process_sql <<<"RESET MASTER"
+
+mysqldump -h "$SOURCE_HOST" -uroot -p"$MYSQL_ROOT_PASSWORD" --ssl-mode=REQUIRED \
+    --single-transaction --set-gtid-purged=ON --triggers --routines --events \
+    --databases sm | docker_process_sql
+
+docker_process_sql <<EOSQL
+CHANGE REPLICATION SOURCE TO
+    SOURCE_HOST = '$SOURCE_HOST',
+    SOURCE_USER = 'root',
+    SOURCE_PASSWORD = '$MYSQL_ROOT_PASSWORD',
+    SOURCE_SSL = 1,
+    SOURCE_AUTO_POSITION = 1;
+START REPLICA;
+EOSQL
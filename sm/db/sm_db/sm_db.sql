@@ -23,6 +23,93 @@ CREATE DATABASE /*!32312 IF NOT EXISTS*/ `sm` /*!40100 DEFAULT CHARACTER SET utf
 
 USE `sm`;
 
+--
+-- Table structure for table `billing_charges`
+--
+
+DROP TABLE IF EXISTS `billing_charges`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `billing_charges` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `run_id` int NOT NULL,
+  `meter_id` int NOT NULL,
+  `owner_id` int NOT NULL,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `kwh` decimal(20,2) NOT NULL,
+  `price_per_kwh` decimal(10,4) DEFAULT NULL,
+  `amount` decimal(12,2) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `run_meter_label` (`run_id`,`meter_id`,`label`),
+  KEY `run_owner` (`run_id`,`owner_id`),
+  CONSTRAINT `billing_charges_ibfk_1` FOREIGN KEY (`run_id`) REFERENCES `billing_runs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `billing_runs`
+--
+
+DROP TABLE IF EXISTS `billing_runs`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `billing_runs` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `period_start` date NOT NULL,
+  `period_end` date NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'running',
+  `started_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `period` (`period_start`,`period_end`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `consumption_anomalies`
+--
+
+DROP TABLE IF EXISTS `consumption_anomalies`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_anomalies` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `meter_id` int NOT NULL,
+  `kind` varchar(20) NOT NULL,
+  `start_timestamp` timestamp NOT NULL,
+  `end_timestamp` timestamp NOT NULL,
+  `score` double NOT NULL,
+  `detail` varchar(255) NOT NULL DEFAULT '',
+  `detected_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `meter_anomaly` (`meter_id`,`kind`,`start_timestamp`),
+  KEY `start_timestamp` (`start_timestamp`),
+  CONSTRAINT `consumption_anomalies_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `consumption_anomaly_scans`
+--
+
+DROP TABLE IF EXISTS `consumption_anomaly_scans`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_anomaly_scans` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `mode` varchar(20) NOT NULL,
+  `meter_id` int DEFAULT NULL,
+  `last_consumption_id` int DEFAULT NULL,
+  `meters` int NOT NULL,
+  `readings` int NOT NULL,
+  `anomalies` int NOT NULL,
+  `started_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `consumption_data`
 --
@@ -33,13 +120,43 @@ DROP TABLE IF EXISTS `consumption_data`;
 CREATE TABLE `consumption_data` (
   `id` int NOT NULL AUTO_INCREMENT,
   `meter_id` int NOT NULL,
-  `timestamp` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `timestamp` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `modify_timestamp` timestamp NULL DEFAULT NULL,
   `consumption_kwh` decimal(20,2) NOT NULL,
-  PRIMARY KEY (`id`),
-  KEY `meter_id` (`meter_id`),
-  CONSTRAINT `consumption_data_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
-) ENGINE=InnoDB AUTO_INCREMENT=7 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+  PRIMARY KEY (`id`,`timestamp`),
+  UNIQUE KEY `meter_reading` (`meter_id`,`timestamp`),
+  KEY `meter_timestamp` (`meter_id`,`timestamp`,`consumption_kwh`),
+  KEY `timestamp` (`timestamp`),
+  KEY `meter_modified` (`meter_id`,`modify_timestamp`),
+  KEY `modify_timestamp` (`modify_timestamp`)
+) ENGINE=InnoDB AUTO_INCREMENT=7 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y'
+/*!50100 PARTITION BY RANGE (unix_timestamp(`timestamp`))
+(PARTITION p_old VALUES LESS THAN (UNIX_TIMESTAMP('2025-01-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202501 VALUES LESS THAN (UNIX_TIMESTAMP('2025-02-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202502 VALUES LESS THAN (UNIX_TIMESTAMP('2025-03-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202503 VALUES LESS THAN (UNIX_TIMESTAMP('2025-04-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202504 VALUES LESS THAN (UNIX_TIMESTAMP('2025-05-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202505 VALUES LESS THAN (UNIX_TIMESTAMP('2025-06-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202506 VALUES LESS THAN (UNIX_TIMESTAMP('2025-07-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202507 VALUES LESS THAN (UNIX_TIMESTAMP('2025-08-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202508 VALUES LESS THAN (UNIX_TIMESTAMP('2025-09-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202509 VALUES LESS THAN (UNIX_TIMESTAMP('2025-10-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202510 VALUES LESS THAN (UNIX_TIMESTAMP('2025-11-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202511 VALUES LESS THAN (UNIX_TIMESTAMP('2025-12-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202512 VALUES LESS THAN (UNIX_TIMESTAMP('2026-01-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202601 VALUES LESS THAN (UNIX_TIMESTAMP('2026-02-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202602 VALUES LESS THAN (UNIX_TIMESTAMP('2026-03-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202603 VALUES LESS THAN (UNIX_TIMESTAMP('2026-04-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202604 VALUES LESS THAN (UNIX_TIMESTAMP('2026-05-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202605 VALUES LESS THAN (UNIX_TIMESTAMP('2026-06-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202606 VALUES LESS THAN (UNIX_TIMESTAMP('2026-07-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202607 VALUES LESS THAN (UNIX_TIMESTAMP('2026-08-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202608 VALUES LESS THAN (UNIX_TIMESTAMP('2026-09-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202609 VALUES LESS THAN (UNIX_TIMESTAMP('2026-10-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202610 VALUES LESS THAN (UNIX_TIMESTAMP('2026-11-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202611 VALUES LESS THAN (UNIX_TIMESTAMP('2026-12-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION p202612 VALUES LESS THAN (UNIX_TIMESTAMP('2027-01-01 00:00:00')) ENGINE = InnoDB,
+ PARTITION pmax VALUES LESS THAN MAXVALUE ENGINE = InnoDB) */;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
 --
@@ -52,6 +169,133 @@ INSERT INTO `consumption_data` VALUES (1,1,'2025-02-19 08:00:00','2025-02-19 09:
 /*!40000 ALTER TABLE `consumption_data` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Trigger for table `consumption_data`
+--
+
+DELIMITER ;;
+/*!50003 CREATE TRIGGER `consumption_data_after_delete` AFTER DELETE ON `consumption_data` FOR EACH ROW INSERT INTO `consumption_tombstones` (`consumption_id`, `meter_id`, `owner_id`) VALUES (OLD.id, OLD.meter_id, (SELECT `owner_id` FROM `meters` WHERE `id` = OLD.meter_id)) */;;
+DELIMITER ;
+
+--
+-- Table structure for table `consumption_retention`
+--
+
+DROP TABLE IF EXISTS `consumption_retention`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_retention` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `cutoff` datetime NOT NULL,
+  `applied_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `consumption_rollup_hourly`
+--
+
+DROP TABLE IF EXISTS `consumption_rollup_hourly`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_rollup_hourly` (
+  `meter_id` int NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `sum_kwh` decimal(20,2) NOT NULL,
+  `min_kwh` decimal(20,2) NOT NULL,
+  `max_kwh` decimal(20,2) NOT NULL,
+  `count` int NOT NULL,
+  PRIMARY KEY (`meter_id`,`bucket_start`),
+  KEY `bucket_start` (`bucket_start`),
+  CONSTRAINT `consumption_rollup_hourly_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `consumption_rollup_hourly`
+--
+
+LOCK TABLES `consumption_rollup_hourly` WRITE;
+/*!40000 ALTER TABLE `consumption_rollup_hourly` DISABLE KEYS */;
+INSERT INTO `consumption_rollup_hourly` VALUES (1,'2025-02-19 08:00:00',5.30,5.30,5.30,1),(1,'2025-02-19 12:00:00',3.80,3.80,3.80,1),(1,'2025-02-19 16:00:00',6.10,6.10,6.10,1),(2,'2025-02-19 08:00:00',4.20,4.20,4.20,1),(2,'2025-02-19 12:00:00',5.70,5.70,5.70,1),(2,'2025-02-19 16:00:00',4.90,4.90,4.90,1);
+/*!40000 ALTER TABLE `consumption_rollup_hourly` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `consumption_rollup_daily`
+--
+
+DROP TABLE IF EXISTS `consumption_rollup_daily`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_rollup_daily` (
+  `meter_id` int NOT NULL,
+  `bucket_start` datetime NOT NULL,
+  `sum_kwh` decimal(20,2) NOT NULL,
+  `min_kwh` decimal(20,2) NOT NULL,
+  `max_kwh` decimal(20,2) NOT NULL,
+  `count` int NOT NULL,
+  PRIMARY KEY (`meter_id`,`bucket_start`),
+  KEY `bucket_start` (`bucket_start`),
+  CONSTRAINT `consumption_rollup_daily_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `consumption_rollup_daily`
+--
+
+LOCK TABLES `consumption_rollup_daily` WRITE;
+/*!40000 ALTER TABLE `consumption_rollup_daily` DISABLE KEYS */;
+INSERT INTO `consumption_rollup_daily` VALUES (1,'2025-02-19 00:00:00',15.20,3.80,6.10,3),(2,'2025-02-19 00:00:00',14.80,4.20,5.70,3);
+/*!40000 ALTER TABLE `consumption_rollup_daily` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `consumption_tombstones`
+--
+
+DROP TABLE IF EXISTS `consumption_tombstones`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `consumption_tombstones` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `consumption_id` int NOT NULL,
+  `meter_id` int NOT NULL,
+  `owner_id` int DEFAULT NULL,
+  `deleted_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `owner_id` (`owner_id`,`id`),
+  KEY `deleted_at` (`deleted_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `invoices`
+--
+
+DROP TABLE IF EXISTS `invoices`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `invoices` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `run_id` int NOT NULL,
+  `user_id` int NOT NULL,
+  `period_start` date NOT NULL,
+  `period_end` date NOT NULL,
+  `currency` char(3) NOT NULL,
+  `kwh` decimal(20,2) NOT NULL,
+  `amount` decimal(12,2) NOT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `run_user` (`run_id`,`user_id`),
+  KEY `user_id` (`user_id`,`id`),
+  CONSTRAINT `invoices_ibfk_1` FOREIGN KEY (`run_id`) REFERENCES `billing_runs` (`id`) ON DELETE CASCADE,
+  CONSTRAINT `invoices_ibfk_2` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `login`
 --
@@ -87,6 +331,23 @@ INSERT INTO `login` VALUES (1,1000001,'kunde1','password123',0,NULL,1,'2025-02-2
 /*!40000 ALTER TABLE `login` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `meter_tariffs`
+--
+
+DROP TABLE IF EXISTS `meter_tariffs`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `meter_tariffs` (
+  `meter_id` int NOT NULL,
+  `tariff_id` int NOT NULL,
+  PRIMARY KEY (`meter_id`),
+  KEY `tariff_id` (`tariff_id`),
+  CONSTRAINT `meter_tariffs_ibfk_1` FOREIGN KEY (`meter_id`) REFERENCES `meters` (`id`) ON DELETE CASCADE,
+  CONSTRAINT `meter_tariffs_ibfk_2` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `meters`
 --
@@ -141,6 +402,88 @@ INSERT INTO `roles` VALUES (1,'Endnutzer'),(99,'Messstellenbetreiber');
 /*!40000 ALTER TABLE `roles` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `schema_migrations`
+--
+
+DROP TABLE IF EXISTS `schema_migrations`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `schema_migrations` (
+  `version` int NOT NULL,
+  `name` varchar(255) NOT NULL,
+  `applied_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `schema_migrations`
+--
+
+LOCK TABLES `schema_migrations` WRITE;
+/*!40000 ALTER TABLE `schema_migrations` DISABLE KEYS */;
+INSERT INTO `schema_migrations` (`version`, `name`) VALUES (1,'001_consumption_rollups.sql'),(2,'002_consumption_indexes.sql'),(3,'003_consumption_partitions.sql'),(4,'004_consumption_modified_index.sql'),(5,'005_consumption_tombstones.sql'),(6,'006_consumption_unique_reading.sql'),(7,'007_consumption_anomalies.sql'),(8,'008_billing.sql'),(9,'009_consumption_modify_timestamp_index.sql'),(10,'010_consumption_rollup_bucket_index.sql'),(11,'011_consumption_retention.sql'),(12,'012_consumption_anomaly_scan_meter.sql');
+/*!40000 ALTER TABLE `schema_migrations` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `tariff_rates`
+--
+
+DROP TABLE IF EXISTS `tariff_rates`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `tariff_rates` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `days` tinyint NOT NULL DEFAULT '127',
+  `start_hour` tinyint NOT NULL,
+  `end_hour` tinyint NOT NULL,
+  `price_per_kwh` decimal(10,4) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `tariff_id` (`tariff_id`),
+  CONSTRAINT `tariff_rates_ibfk_1` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `tariff_tiers`
+--
+
+DROP TABLE IF EXISTS `tariff_tiers`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `tariff_tiers` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `tariff_id` int NOT NULL,
+  `label` varchar(50) NOT NULL,
+  `from_kwh` decimal(20,2) NOT NULL,
+  `price_per_kwh` decimal(10,4) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `tariff_tier` (`tariff_id`,`from_kwh`),
+  CONSTRAINT `tariff_tiers_ibfk_1` FOREIGN KEY (`tariff_id`) REFERENCES `tariffs` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `tariffs`
+--
+
+DROP TABLE IF EXISTS `tariffs`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!50503 SET character_set_client = utf8mb4 */;
+CREATE TABLE `tariffs` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `name` varchar(100) NOT NULL,
+  `base_fee` decimal(10,2) NOT NULL DEFAULT '0.00',
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci ENCRYPTION='Y';
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `users`
 --